@@ -1,345 +1,41 @@
-from flask import Flask, request, abort
-from linebot.v3.messaging import (
-    MessagingApi, Configuration, ApiClient,
-    TextMessage, MessageAction, CarouselColumn, CarouselTemplate, TemplateMessage, ReplyMessageRequest
-)
-from linebot.v3.webhook import WebhookHandler
+from flask import Flask, Response, request, abort, stream_with_context
+# linebot.v3.messaging (import ~1 วินาที) import เมื่อใช้ครั้งแรกเท่านั้น: ข้อความ text ส่งเป็น JSON เอง
+# และ carousel โหลดจาก picker snapshot ได้ (ดู coldstart.py)
+from linebot.v3.webhook import WebhookHandler, WebhookParser
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.webhooks import MessageEvent, TextMessageContent
-from linebot.models import QuickReplyButton, PostbackAction
+from linebot.v3.webhooks import MessageEvent, PostbackEvent, TextMessageContent
 import os
 import re
+import abc
+import atexit
 import math
 import random
 import logging
-
-DRUG_DATABASE = {
-    "Amoxicillin": {
-        "concentration_mg_per_ml": 250 / 5,
-        "bottle_size_ml": 60,
-        "indications": {
-            "Pharyngitis/Tonsillitis": [
-                {
-                    "sub_indication": "Group A Streptococcus",
-                    "dose_mg_per_kg_per_day": 50,
-                    "frequency": [1, 2],
-                    "duration_days": 10,
-                    "max_mg_per_day": 1000,
-                    "note": "📌 ใช้ได้ทั้งแบบวันละครั้งหรือแบ่งวันละ 2 ครั้ง × 10 วัน ตามความสะดวก"
-                }
-            ],
-            "Otitis media, acute (AOM)": [
-                {
-                    "label": "High-dose regimen",
-                    "dose_mg_per_kg_per_day": [80, 90],
-                    "frequency": 2,
-                    "duration_days": 10,
-                    "max_mg_per_day": 4000,
-                    "note": "เหมาะในสหรัฐอเมริกา หรือเมื่อมี S. pneumoniae ดื้อเพนนิซิลลิน"
-                },
-                {
-                    "label": "Standard-dose regimen",
-                    "dose_mg_per_kg_per_day": [40, 50],
-                    "frequency": 2,
-                    "duration_days": 7,
-                    "max_mg_per_day": 1500,
-                    "note": "ใช้ได้เฉพาะในพื้นที่ที่เชื้อ S. pneumoniae ดื้อต่อ penicillin < 10% เท่านั้น"
-                }
-            ],
-            "Pneumonia, community acquired": [
-                {
-                    "label": "Empiric therapy (bacterial pneumonia)",
-                    "dose_mg_per_kg_per_day": 90,
-                    "frequency": 2,
-                    "duration_days": 5,
-                    "max_mg_per_day": 4000
-                },
-                {
-                    "label": "Group A Streptococcus, mild",
-                    "dose_mg_per_kg_per_day": [50, 75],
-                    "frequency": 2,
-                    "duration_days": 7,
-                    "max_mg_per_day": 4000
-                },
-                {
-                    "label": "H. influenzae, mild",
-                    "dose_mg_per_kg_per_day": [75, 100],
-                    "frequency": 3,
-                    "duration_days": 7,
-                    "max_mg_per_day": 4000
-                },
-                {
-                    "label": "S. pneumoniae, MIC ≤2",
-                    "dose_mg_per_kg_per_day": 90,
-                    "frequency": [2, 3],
-                    "duration_days": 7,
-                    "max_mg_per_day": 4000,
-                    "note": "เลือกความถี่ตาม MIC: 12 ชม หรือ 8 ชม"
-                },
-                {
-                    "label": "S. pneumoniae, MIC = 2 mcg/mL",
-                    "dose_mg_per_kg_per_day": [90, 100],
-                    "frequency": 3,
-                    "duration_days": 7,
-                    "max_mg_per_day": 4000,
-                    "note": "ใช้เพื่อให้ time > MIC ได้ตามเป้าหมาย"
-                }
-            ],
-            "Anthrax": [
-                {
-                    "title": "Postexposure prophylaxis, exposure to aerosolized spores",
-                    "dose_mg_per_kg_per_day": 75,
-                    "frequency": 3,
-                    "duration_days": 60,
-                    "max_mg_per_dose": 1000
-                },
-                {
-                    "title": "Cutaneous, without systemic involvement",
-                    "dose_mg_per_kg_per_day": 75,
-                    "frequency": 3,
-                    "duration_days_range": [7, 10],
-                    "max_mg_per_dose": 1000,
-                    "note": "ใช้ในกรณี naturally acquired infection"
-                },
-                {
-                    "title": "Systemic, oral step-down therapy",
-                    "dose_mg_per_kg_per_day": 75,
-                    "frequency": 3,
-                    "duration_days": 60,
-                    "max_mg_per_dose": 1000,
-                    "note": "เป็นส่วนหนึ่งของ combination therapy เพื่อให้ครบ 60 วัน"
-                }
-            ],
-            "Helicobacter pylori eradication": [
-                {
-                    "name": "Standard-dose (weight-based)",
-                    "dose_mg_per_kg_per_day": 50,
-                    "frequency": 2,
-                    "duration_days": 14,
-                    "max_mg_per_dose": 1000,
-                    "note": "ใช้ร่วมกับยาฆ่าเชื้อชนิดอื่นตาม guideline"
-                },
-                {
-                    "name": "Standard-dose (fixed dosing)",
-                    "fixed_dose_by_weight": [
-                        {"min_weight": 15, "max_weight": 24.9, "dose_mg": 500},
-                        {"min_weight": 25, "max_weight": 34.9, "dose_mg": 750},
-                        {"min_weight": 35, "max_weight": 999, "dose_mg": 1000}
-                    ],
-                    "frequency": 2,
-                    "duration_days": 14,
-                    "note": "Fixed dosing ตามน้ำหนักช่วง (twice daily × 14 วัน)"
-                },
-                {
-                    "name": "High-dose (fixed dosing)",
-                    "fixed_dose_by_weight": [
-                        {"min_weight": 15, "max_weight": 24.9, "dose_mg": 750},
-                        {"min_weight": 25, "max_weight": 34.9, "dose_mg": 1000},
-                        {"min_weight": 35, "max_weight": 999, "dose_mg": 1500}
-                    ],
-                    "frequency": 2,
-                    "duration_days": 14,
-                    "note": "ใช้กรณีดื้อ clarithromycin และ metronidazole"
-                }
-            ],
-            "Lyme disease (Borrelia spp. infection)": [
-                {
-                    "name": "Erythema migrans / Borrelial lymphocytoma",
-                    "dose_mg_per_kg_per_day": 50,
-                    "frequency": 3,
-                    "duration_days": 14,
-                    "max_mg_per_dose": 500,
-                    "note": "รักษานาน 14 วัน"
-                },
-                {
-                    "name": "Carditis",
-                    "dose_mg_per_kg_per_day": 50,
-                    "frequency": 3,
-                    "duration_days": 21,
-                    "max_mg_per_dose": 500,
-                    "note": "รักษานาน 14–21 วัน"
-                },
-                {
-                    "name": "Arthritis (initial, recurrent, or refractory)",
-                    "dose_mg_per_kg_per_day": 50,
-                    "frequency": 3,
-                    "duration_days": 28,
-                    "max_mg_per_dose": 500,
-                    "note": "รักษานาน 28 วัน"
-                },
-                {
-                    "name": "Acrodermatitis chronica atrophicans",
-                    "dose_mg_per_kg_per_day": 50,
-                    "frequency": 3,
-                    "duration_days": 28,
-                    "max_mg_per_dose": 500,
-                    "note": "รักษานาน 21–28 วัน"
-                }
-            ],
-            "Urinary tract infection": [
-                {
-                    "sub_indication": "Infants",
-                    "dose_mg_per_kg_per_day": 50,
-                    "frequency": 2,
-                    "duration_days": 7,
-                    "note": "📌 แนะนำใช้เฉพาะในกรณีที่เชื้อไวต่อ amoxicillin"
-                },
-                {
-                    "sub_indication": "Infants (severe)",
-                    "dose_mg_per_kg_per_day": 100,
-                    "frequency": 2,
-                    "duration_days": 10,
-                    "note": "📌 อาจใช้ในกรณี moderate/severe infection"
-                },
-                {
-                    "sub_indication": "Children and Adolescents",
-                    "dose_mg_per_kg_per_day": 50,
-                    "frequency": 3,
-                    "duration_days": 7,
-                    "max_mg_per_dose": 500,
-                    "note": "📌 แนะนำระยะเวลา 7–14 วัน หรือ 3–5 วันใน cystitis ที่ไม่ซับซ้อน (≥2 ปี)"
-                },
-                {
-                    "sub_indication": "Children and Adolescents (high dose)",
-                    "dose_mg_per_kg_per_day": 100,
-                    "frequency": 3,
-                    "duration_days": 10,
-                    "max_mg_per_dose": 500,
-                    "note": "📌 สำหรับ moderate/severe infection ที่ตอบสนองช้า"
-                },
-                {
-                    "sub_indication": "Children (uncomplicated cystitis)",
-                    "dose_mg_per_kg_per_day": 30,
-                    "frequency": 3,
-                    "duration_days": 3,
-                    "note": "📌 ใช้ได้ในเด็ก ≥2 ปี ที่มี uncomplicated cystitis"
-                }
-            ],
-            "Rhinosinusitis": [
-                {
-                    "sub_indication": "Standard-dose regimen (พื้นที่ที่ S. pneumoniae ไวต่อ penicillin)",
-                    "dose_mg_per_kg_per_day": 45,
-                    "frequency": 2,
-                    "duration_days": 10,
-                    "note": "📌 สำหรับผู้ป่วยที่ไม่ได้รับยาปฏิชีวนะใน 30 วันที่ผ่านมา และไม่ได้ไปศูนย์ดูแลเด็ก (AAP guideline)"
-                },
-                {
-                    "sub_indication": "High-dose regimen (พื้นที่ที่ S. pneumoniae ดื้อต่อ penicillin ≥10%)",
-                    "dose_mg_per_kg_per_day": 80,
-                    "frequency": 2,
-                    "duration_days": 10,
-                    "max_mg_per_dose": 2000,
-                    "note": "📌 แนะนำโดย IDSA และใช้ในพื้นที่ที่มีเชื้อดื้อมาก"
-                }
-            ]
-        }
-    },
-    "Cephalexin": {
-        "concentration_mg_per_ml": 125 / 5,
-        "bottle_size_ml": 60,
-        "indications": {
-            "SSTI": {"dose_mg_per_kg_per_day": 50, "frequency": 4, "duration_days": 7, "max_mg_per_day": None},
-            "Pharyngitis": {"dose_mg_per_kg_per_day": 50, "frequency": 2, "duration_days": 10, "max_mg_per_day": None},
-            "UTI": {"dose_mg_per_kg_per_day": 100, "frequency": 4, "duration_days": 7, "max_mg_per_day": None}
-        }
-    },
-    "Cefdinir": {
-        "concentration_mg_per_ml": 125 / 5,
-        "bottle_size_ml": 30,
-        "indications": {
-            "Otitis Media": {"dose_mg_per_kg_per_day": 14, "frequency": 2, "duration_days": 10, "max_mg_per_day": 600},
-            "Pharyngitis": {"dose_mg_per_kg_per_day": 14, "frequency": 2, "duration_days": 10, "max_mg_per_day": 600},
-            "Rhinosinusitis": {"dose_mg_per_kg_per_day": 14, "frequency": 2, "duration_days": 10, "max_mg_per_day": 600}
-        }
-    },
-    "Cefixime": {
-        "concentration_mg_per_ml": 100 / 5,
-        "bottle_size_ml": 30,
-        "indications": {
-            "Febrile Neutropenia": {"dose_mg_per_kg_per_day": 8, "frequency": 1, "duration_days": 7, "max_mg_per_day": 400},
-            "Otitis Media": {"dose_mg_per_kg_per_day": 8, "frequency": 1, "duration_days": 7, "max_mg_per_day": 400},
-            "Rhinosinusitis": {"dose_mg_per_kg_per_day": 8, "frequency": 1, "duration_days": 7, "max_mg_per_day": 400},
-            "Strep Pharyngitis": {"dose_mg_per_kg_per_day": 8, "frequency": 1, "duration_days": 10, "max_mg_per_day": 400},
-            "Typhoid Fever": {"dose_mg_per_kg_per_day": 17.5, "frequency": 2, "duration_days": 10, "max_mg_per_day": None},
-            "UTI": {"dose_mg_per_kg_per_day": 8, "frequency": 2, "duration_days": 7, "max_mg_per_day": 400}
-        }
-    },
-    "Augmentin": {
-        "concentration_mg_per_ml": 600 / 5,
-        "bottle_size_ml": 70,
-        "indications": {
-            "Impetigo": {"dose_mg_per_kg_per_day": 35, "frequency": 2, "duration_days": 7, "max_mg_per_day": 500},
-            "Osteoarticular Infection": {  "dose_mg_per_kg_per_day": 120,"frequency": 3, "duration_days": 21,"max_mg_per_day": 1000 },
-            "Otitis Media": {"dose_mg_per_kg_per_day": 85,"frequency": 2, "duration_days": 10, "max_mg_per_day": 2000 },
-            "Pneumonia": { "dose_mg_per_kg_per_day": 90,"frequency": 2, "duration_days": 7, "max_mg_per_day": 2000 },
-            "Rhinosinusitis": {"dose_mg_per_kg_per_day": 90,"frequency": 2,"duration_days": 10,"max_mg_per_day": 2000 },
-            "Strep Carriage": { "dose_mg_per_kg_per_day": 40, "frequency": 3, "duration_days": 10,"max_mg_per_day": 2000 },
-            "UTI": { "dose_mg_per_kg_per_day": 35, "frequency": 2, "duration_days": 7, "max_mg_per_day": 1750 }
-        }
-    },
-    "Azithromycin": {
-        "concentration_mg_per_ml": 200 / 5,
-        "bottle_size_ml": 15,
-        "indications": {
-            "Pertussis": [
-                {"day_range": "Day 1", "dose_mg_per_kg_per_day": 10, "frequency": 1, "duration_days": 1, "max_mg_per_day": 500},
-                {"day_range": "Day 2–5", "dose_mg_per_kg_per_day": 5, "frequency": 1, "duration_days": 4, "max_mg_per_day": 250}
-            ],
-            "Pneumonia (Atypical)": [
-                {"day_range": "Day 1", "dose_mg_per_kg_per_day": 10, "frequency": 1, "duration_days": 1, "max_mg_per_day": 500},
-                {"day_range": "Day 2–5", "dose_mg_per_kg_per_day": 5, "frequency": 1, "duration_days": 4, "max_mg_per_day": 250}
-            ],
-            "Strep Pharyngitis": {
-                "dose_mg_per_kg_per_day": 12, "frequency": 1, "duration_days": 5, "max_mg_per_dose": 500
-            },
-            "Typhoid Fever": {
-                "dose_mg_per_kg_per_day": 15, "frequency": 1, "duration_days": 7, "max_mg_per_dose": 1000
-            },
-            "UTI (Off-label)": {
-                "dose_mg_per_kg_per_day": 10, "frequency": 1, "duration_days": 3, "max_mg_per_dose": 500
-            },
-            "Rhinosinusitis": {
-                "dose_mg_per_kg_per_day": 10, "frequency": 1, "duration_days": 3, "max_mg_per_dose": 500
-            },
-            "Chlamydia": {
-                "dose_mg_per_kg_per_day": 20, "frequency": 1, "duration_days": 1, "max_mg_per_dose": 1000
-            },
-            "Diarrhea (Campylobacter)": {
-                "dose_mg_per_kg_per_day": 10, "frequency": 1, "duration_days": 3, "max_mg_per_dose": 500
-            },
-            "Diarrhea (Shigella)": [
-                {"day_range": "Day 1", "dose_mg_per_kg_per_day": 12, "frequency": 1, "duration_days": 1, "max_mg_per_day": 500},
-                {"day_range": "Day 2–5", "dose_mg_per_kg_per_day": 5, "frequency": 1, "duration_days": 4, "max_mg_per_day": 250}
-            ],
-            "Cholera": {
-                "dose_mg_per_kg_per_day": 20, "frequency": 1, "duration_days": 1, "max_mg_per_dose": 1000
-            },
-            "Babesiosis": [
-                {"day_range": "Day 1", "dose_mg_per_kg_per_day": 10, "frequency": 1, "duration_days": 1, "max_mg_per_day": 500},
-                {"day_range": "Day 2–5", "dose_mg_per_kg_per_day": 5, "frequency": 1, "duration_days": 4, "max_mg_per_day": 250}
-            ],
-            "Cat Scratch Disease": [
-                {"day_range": "Day 1", "dose_mg_per_kg_per_day": 10, "frequency": 1, "duration_days": 1, "max_mg_per_day": 500},
-                {"day_range": "Day 2–5", "dose_mg_per_kg_per_day": 5, "frequency": 1, "duration_days": 4, "max_mg_per_day": 250}
-            ],
-            "MAC (Mycobacterium avium, prophylaxis)": {
-                "dose_mg_per_kg_per_day": 20, "frequency": 1, "duration_days": 7, "max_mg_per_dose": 1200
-            },
-            "NTM Pulmonary Infection": {
-                "dose_mg_per_kg_per_day": 10, "frequency": 1, "duration_days": 14, "max_mg_per_dose": 500
-            },
-            "Cystic Fibrosis (maintenance)": {
-                "dose_mg_per_kg_per_day": 10, "frequency": 3, "duration_days": 14, "max_mg_per_dose": 500
-            },
-            "Asthma (Adjunct)": {
-                "dose_mg_per_kg_per_day": 10, "frequency": 3, "duration_days": 14, "max_mg_per_dose": 500
-            },
-            "Other": "INDICATION_OTHERS"
-        },
-        "common_indications": ["Pneumonia (Atypical)", "Strep Pharyngitis","Rhinosinusitis","Chlamydia" ]
-    }
-}
-
+import queue
+import threading
+import multiprocessing
+import multiprocessing.util
+import zlib
+import json
+import base64
+import string
+import codecs
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import time
+import sqlite3
+import hashlib
+import hmac
+import secrets
+import mmap
+import pickle
+import bisect
+import itertools
+import socket
+from collections import OrderedDict, deque
+import numpy as np
+import urllib3
 
 logging.basicConfig(
     level=logging.INFO,  # เปลี่ยนเป็น DEBUG ถ้าต้องการ log ละเอียด
@@ -354,284 +50,1169 @@ app = Flask(__name__)
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET = os.environ.get("LINE_CHANNEL_SECRET")
 
-if not LINE_CHANNEL_ACCESS_TOKEN or not LINE_CHANNEL_SECRET:
+# โหมด offline (LINE_BOT_OFFLINE=1, เช่น dosebatch.py): ใช้แค่ตัวคำนวณ ไม่ต้องมี token ของ LINE
+# webhook ได้ secret สุ่มแทน จึงไม่มี request ใดผ่านการตรวจ signature
+LINE_BOT_OFFLINE = os.environ.get("LINE_BOT_OFFLINE") == "1"
+
+if LINE_BOT_OFFLINE:
+    LINE_CHANNEL_SECRET = LINE_CHANNEL_SECRET or secrets.token_hex(32)
+elif not LINE_CHANNEL_ACCESS_TOKEN or not LINE_CHANNEL_SECRET:
     raise ValueError("Missing LINE_CHANNEL_ACCESS_TOKEN or LINE_CHANNEL_SECRET")
 
-configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-api_client = ApiClient(configuration)
-messaging_api = MessagingApi(api_client)
+# connection pool ไป LINE API: ขนาด pool ≥ จำนวน worker ที่ส่งพร้อมกัน, เปิด TCP keep-alive,
+# retry ทำเองใน OutboundDispatcher (urllib3 ไม่ต้อง retry ซ้ำ)
+LINE_POOL_MAXSIZE = int(os.environ.get("LINE_POOL_MAXSIZE", 16))
+LINE_CONNECT_TIMEOUT = float(os.environ.get("LINE_CONNECT_TIMEOUT", 3))
+LINE_READ_TIMEOUT = float(os.environ.get("LINE_READ_TIMEOUT", 10))
+
+line_pool_manager = urllib3.PoolManager(
+    maxsize=LINE_POOL_MAXSIZE,
+    retries=False,
+    socket_options=urllib3.connection.HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ],
+)
+
+
+@lru_cache(maxsize=None)
+def get_messaging_api():
+    """MessagingApi ของ SDK สำหรับ API อื่นนอกจาก reply (สร้างครั้งแรกที่เรียก)"""
+    from linebot.v3.messaging import ApiClient, Configuration, MessagingApi
+    configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
+    configuration.connection_pool_maxsize = LINE_POOL_MAXSIZE
+    return MessagingApi(ApiClient(configuration))
+
+
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
+# parser ที่ไม่ตรวจ signature ซ้ำ ใช้หลัง parse_webhook() ตรวจเองแล้ว (เพื่อจับเวลาแยกกัน)
+event_parser = WebhookParser(LINE_CHANNEL_SECRET, skip_signature_verification=lambda: True)
+
+# ตัววัดเวลาแต่ละขั้นของ pipeline (export เป็น Prometheus text ที่ /metrics)
+# ค่าเป็นของ process นี้ (โหมด pre-fork ต้อง scrape แยกแต่ละ process)
+# process ลูกของ EVENT_WORKER_MODE=process และ /api/dose ส่งค่าที่นับได้กลับมารวมที่แม่ (drain_metrics / merge_metrics)
+METRICS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def drain(self):
+        """คืนค่าที่นับไว้แล้วเริ่มนับใหม่ (process ลูกของ /api/dose ส่งให้แม่ merge)"""
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def merge(self, values):
+        with self.lock:
+            for label_values, amount in values.items():
+                self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for label_values, value in items:
+            labels = ",".join(f'{k}="{_label_value(v)}"' for k, v in zip(self.labels, label_values))
+            lines.append(f"{self.name}{{{labels}}} {value}")
+        return lines
+
+
+class Histogram:
+    """histogram แบบ Prometheus 1 label เก็บจำนวนต่อ bucket ไว้ (render ตอนถูก scrape ค่อยรวมสะสม)"""
+
+    def __init__(self, name, help_text, label, buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        idx = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][idx] += 1
+            series[1] += seconds
+
+    def drain(self):
+        with self.lock:
+            series, self.series = self.series, {}
+        return series
+
+    def merge(self, series):
+        with self.lock:
+            for label_value, (counts, total) in series.items():
+                mine = self.series.get(label_value)
+                if mine is None:
+                    self.series[label_value] = [list(counts), total]
+                else:
+                    mine[0] = [a + b for a, b in zip(mine[0], counts)]
+                    mine[1] += total
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self.series.items())
+        for label_value, (counts, total) in items:
+            label = f'{self.label}="{_label_value(label_value)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else f"{bound:g}"
+                lines.append(f'{self.name}_bucket{{{label},le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {total:.6f}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("linebot_stage_seconds", "เวลาแต่ละขั้นของ webhook pipeline", "stage")
+EVENTS_TOTAL = Counter("linebot_events_total", "จำนวน webhook event ตามชนิด", ("type",))
+UNKNOWN_LABEL = "unknown"
+DOSE_CALCULATIONS_TOTAL = Counter("linebot_dose_calculations_total", "จำนวนการคำนวณขนาดยาต่อยาและข้อบ่งใช้", ("drug", "indication"))
+WARFARIN_ADJUSTMENTS_TOTAL = Counter("linebot_warfarin_adjustments_total", "จำนวนการปรับขนาด warfarin ตามช่วง INR", ("band",))
+DUPLICATE_EVENTS_TOTAL = Counter("linebot_duplicate_events_total", "จำนวน webhook event ซ้ำที่ทิ้งไป", ("redelivery",))
+AUDIT_RECORDS_TOTAL = Counter("linebot_audit_records_total", "จำนวนรายการ audit log ที่เขียนแล้ว / ต้องรอเขียนใหม่ / ทิ้งเพราะคิวเต็ม", ("status",))
+DOSE_API_ROWS_TOTAL = Counter("linebot_dose_api_rows_total", "จำนวนแถวที่ /api/dose ตอบ ตามผลลัพธ์", ("status",))
+METRICS = (
+    STAGE_SECONDS, EVENTS_TOTAL, DOSE_CALCULATIONS_TOTAL, WARFARIN_ADJUSTMENTS_TOTAL, DUPLICATE_EVENTS_TOTAL,
+    DOSE_API_ROWS_TOTAL, AUDIT_RECORDS_TOTAL,
+)
 
-user_drug_selection = {}
-user_sessions = {}
-user_ages = {}
 
+@contextmanager
+def stage_timer(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(stage, time.perf_counter() - started)
 
-SPECIAL_DRUGS = {
-    "Paracetamol": {
-    "concentration_mg_per_ml": 120 / 5,
-    "bottle_size_ml": 60,
-    "indications": {
-        "Fever": [
-            {
-                "min_age_years": 0,
-                "max_age_years": 6,
-                "dose_mg_per_kg_per_day": 60,
-                "frequency": 4,
-                "duration_days": 3,
-                "max_mg_per_dose": 250
-            },
-            {
-                "min_age_years": 6,
-                "max_age_years": 18,
-                "dose_mg_per_kg_per_day": 60,
-                "frequency": 4,
-                "duration_days": 3,
-                "max_mg_per_dose": 500
-            }
-        ]
-    },
-    "common_indications": ["Fever"]
-    },
-    "Cetirizine": {
-    "concentration_mg_per_ml": 5 / 5,
-    "bottle_size_ml": 60,
-    "indications": {
-      "Allergic rhinitis, perennial": {
-        "6_to_11_months": {
-          "dose_mg": 2.5,
-          "frequency": 1,
-          "max_mg_per_day": 2.5
-        },
-        "12_to_23_months": {
-          "initial_dose_mg": 2.5,
-          "frequency": 1,
-          "max_frequency": 2,
-          "max_mg_per_day": 5
-        }
-      },
-      "Allergic symptoms, hay fever": {
-        "2_to_5_years": {
-          "initial_dose_mg": 2.5,
-          "frequency": 1,
-          "options": [
-            {"dose_mg": 2.5, "frequency": 2},
-            {"dose_mg": 5, "frequency": 1}
-          ],
-          "max_mg_per_day": 5
-        },
-        "above_or_equal_6": {
-          "dose_mg_range": [5, 10],
-          "frequency": 1,
-          "max_mg_per_day": 10
-        }
-      },
-      "Anaphylaxis (adjunctive only)": {
-        "6_to_23_months": {
-          "dose_mg": 2.5,
-          "frequency": 1,
-          "max_mg_per_day": 2.5
-        },
-        "2_to_5_years": {
-          "dose_range_mg": [2.5, 5],
-          "frequency": 1,
-          "max_mg_per_day": 5
-        },
-        "above_5": {
-          "dose_range_mg": [5, 10],
-          "frequency": 1,
-          "max_mg_per_day": 10
-        }
-      },
-      "Urticaria, acute": {
-        "6_to_23_months": {
-          "dose_mg": 2.5,
-          "frequency": 1
-        },
-        "2_to_5_years": {
-          "dose_range_mg": [2.5, 5],
-          "frequency": 1
-        },
-        "above_5": {
-          "dose_range_mg": [5, 10],
-          "frequency": 1
-        }
-      },
-      "Urticaria, chronic spontaneous": {
-        "6_to_11_months": {
-          "dose_mg": 2.5,
-          "frequency": 1
-        },
-        "12_to_23_months": {
-          "initial_dose_mg": 2.5,
-          "frequency": 1,
-          "max_frequency": 2,
-          "max_mg_per_day": 5
-        },
-        "2_to_5_years": {
-          "initial_dose_mg": 2.5,
-          "frequency": 1,
-          "options": [
-            {"dose_mg": 2.5, "frequency": 2},
-            {"dose_mg": 5, "frequency": 1}
-          ],
-          "max_mg_per_day": 5
-        },
-        "6_to_11_years": {
-          "dose_mg": 5,
-          "frequency_options": [1, 2]
-        },
-        "above_or_equal_12": {
-          "dose_mg": 10,
-          "frequency": 1
-        }
-      }
-    },
-    "common_indications": [
-      "Allergic rhinitis, perennial",
-      "Allergic symptoms, hay fever",
-      "Anaphylaxis (adjunctive only)",
-      "Urticaria, acute",
-      "Urticaria, chronic spontaneous"
-    ]
-    },
-    "Hydroxyzine": {
-        "concentration_mg_per_ml": 10 / 5 ,
-        "bottle_size_ml": 60,
-        "indications": {
-        "Anxiety": {
-            "under_6": {
-            "dose_mg": 12.5,
-            "frequency": 4,
-            "max_mg_per_dose": 12.5
-            },
-            "above_or_equal_6": {
-            "dose_mg_range": [12.5, 25],
-            "frequency": 4,
-            "max_mg_per_dose": 25
-            }
-        },
-        "Pruritus (age-based)": {
-            "under_6": {
-            "dose_mg": 12.5,
-            "frequency": [3, 4],
-            "max_mg_per_dose": 12.5
-            },
-            "above_or_equal_6": {
-            "dose_mg_range": [12.5, 25],
-            "frequency": [3, 4],
-            "max_mg_per_dose": 25
-            }
-        },
-        "Pruritus (weight_based)": {
-            "≤40kg": {
-                "dose_mg_per_kg_per_day": 2,
-                "frequency": [6, 8],
-                "max_mg_per_dose": 25
-            },
-            ">40kg": {
-                "dose_mg_range": [25, 50],
-                "frequency": [1, 2],
-                "max_mg_per_dose": 50
-            }
-        },
-        "Pruritus from opioid": {
-            "all_ages": {
-            "dose_mg_per_kg_per_dose": 0.5,
-            "frequency": 6,
-            "max_mg_per_dose": 50
-            }
-        },
-        "Sedation": {
-            "all_ages": {
-            "dose_mg_per_kg": 0.6,
-            "max_mg_per_dose": 100
-            }
-        }
-        },
-        "common_indications": [
-        "Anxiety",
-        "Pruritus (age-based)",
-        "Pruritus (weight_based)",
-        "Pruritus from opioid",
-        "Sedation"
-        ]
-    },
-    "Ferrous drop": {
-        "concentration_mg_per_ml": 15 / 0.6 ,
-        "bottle_size_ml": 15,
-        "indications": {
-        "Iron deficiency, treatment": {
-            "all_ages": {
-            "initial_dose_mg_per_kg_per_day": 3,
-            "max_dose_range_mg_per_day": [60, 120],
-            "usual_max_mg_per_day": 150,
-            "absolute_max_mg_per_day": 200,
-            "frequency": [1, 3],
-            "note": "ให้ครั้งเดียว หรือแบ่งวันละ 1–3 ครั้งได้; การให้วันเว้นวันอาจช่วยดูดซึมดีขึ้น"
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def drain_metrics():
+    """ค่าที่นับไว้ของทุก metric (เรียงตาม METRICS) แล้วเริ่มนับใหม่ ใช้ใน process ลูกเพื่อส่งให้แม่"""
+    return tuple(metric.drain() for metric in METRICS)
+
+
+def merge_metrics(drained):
+    """รวมค่าจาก drain_metrics() ของ process ลูกเข้ากับ metric ของ process นี้"""
+    for metric, values in zip(METRICS, drained):
+        metric.merge(values)
+
+
+def parse_webhook(body, signature):
+    """
+    ตรวจ signature แล้ว parse event (จับเวลาแยกแต่ละขั้น) raise InvalidSignatureError ถ้าไม่ผ่าน
+    event ที่เคยรับแล้ว (LINE ส่งซ้ำ) ถูกตัดออกตรงนี้ ก่อนถึง session หรือการคำนวณใดๆ
+    """
+    with stage_timer("verify_signature"):
+        valid = handler.parser.signature_validator.validate(body, signature or "")
+    if not valid:
+        raise InvalidSignatureError(f"Invalid signature. signature={signature}")
+    with stage_timer("parse_events"):
+        events = event_parser.parse(body, signature)
+    for event in events:
+        EVENTS_TOTAL.inc(getattr(event, "type", "unknown"))
+    if event_dedup is not None:
+        with stage_timer("dedup"):
+            events = [event for event in events if not is_duplicate_event(event)]
+    return events
+
+
+def is_duplicate_event(event):
+    event_id = getattr(event, "webhook_event_id", None)
+    if not event_id or event_dedup.add(event_id):
+        return False
+    delivery = getattr(event, "delivery_context", None)
+    redelivery = bool(delivery and delivery.is_redelivery)
+    DUPLICATE_EVENTS_TOTAL.inc("true" if redelivery else "false")
+    logging.info("♻️ ทิ้ง webhook event ซ้ำ %s (redelivery=%s)", event_id, redelivery)
+    return True
+
+# session ของผู้ใช้ 1 record ต่อ user เช่น
+# {"flow": "warfarin", "step": "ask_twd", "inr": 2.5} หรือ {"drug": "Amoxicillin", "indication": "...", "age": 3.0}
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")  # memory หรือ sqlite
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", 30 * 60))
+SESSION_MAX_USERS = int(os.environ.get("SESSION_MAX_USERS", 10000))
+SESSION_DB_PATH = os.environ.get("SESSION_DB_PATH", "sessions.sqlite3")
+
+
+class SessionStore(abc.ABC):
+    """
+    ที่เก็บ session ของผู้ใช้ record ที่ได้จาก get() เป็นสำเนา แก้ไขแล้วต้องเรียก set() เสมอ
+    """
+
+    @abc.abstractmethod
+    def get(self, user_id):
+        """record ของ user_id หรือ None ถ้าไม่มีหรือหมดอายุแล้ว"""
+
+    @abc.abstractmethod
+    def set(self, user_id, record):
+        """บันทึก record และต่ออายุเป็น TTL เต็ม"""
+
+    @abc.abstractmethod
+    def delete(self, user_id):
+        """ลบ session (ไม่มีอยู่ก็ไม่ error)"""
+
+
+class MemorySessionStore(SessionStore):
+    """LRU + TTL ภายใน process เดียว จำกัดจำนวน user สูงสุด"""
+
+    def __init__(self, ttl_seconds, max_users):
+        self.ttl = ttl_seconds
+        self.max_users = max_users
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            item = self._data.get(user_id)
+            if item is None:
+                return None
+            expires_at, record = item
+            if expires_at <= time.monotonic():
+                del self._data[user_id]
+                return None
+            self._data.move_to_end(user_id)
+            return dict(record)
+
+    def set(self, user_id, record):
+        with self._lock:
+            self._data[user_id] = (time.monotonic() + self.ttl, dict(record))
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_users:
+                self._data.popitem(last=False)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+def sqlite_connection(local, path):
+    """1 connection ต่อ thread (เก็บใน threading.local) และสร้างใหม่หลัง fork"""
+    conn = getattr(local, "conn", None)
+    if conn is None or local.pid != os.getpid():
+        conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        local.conn = conn
+        local.pid = os.getpid()
+    return conn
+
+
+class SQLiteSessionStore(SessionStore):
+    """เก็บ session ในไฟล์ SQLite (WAL) ให้ gunicorn หลาย worker ใช้ร่วมกันได้"""
+
+    PURGE_EVERY = 256
+
+    def __init__(self, path, ttl_seconds, max_users):
+        self.path = path
+        self.ttl = ttl_seconds
+        self.max_users = max_users
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id TEXT PRIMARY KEY, record TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+
+    def _conn(self):
+        return sqlite_connection(self._local, self.path)
+
+    def get(self, user_id):
+        row = self._conn().execute(
+            "SELECT record FROM sessions WHERE user_id = ? AND expires_at > ?", (user_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, user_id, record):
+        conn = self._conn()
+        conn.execute(
+            "INSERT INTO sessions (user_id, record, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET record = excluded.record, expires_at = excluded.expires_at",
+            (user_id, json.dumps(record, separators=(",", ":"), ensure_ascii=False), time.time() + self.ttl)
+        )
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self.purge()
+
+    def delete(self, user_id):
+        self._conn().execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def purge(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM sessions WHERE user_id IN ("
+            "SELECT user_id FROM sessions ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_users,)
+        )
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+def create_session_store(backend):
+    if backend == "memory":
+        return MemorySessionStore(SESSION_TTL_SECONDS, SESSION_MAX_USERS)
+    if backend == "sqlite":
+        return SQLiteSessionStore(SESSION_DB_PATH, SESSION_TTL_SECONDS, SESSION_MAX_USERS)
+    raise ValueError(f"SESSION_BACKEND ไม่รองรับ: {backend}")
+
+
+sessions = create_session_store(SESSION_BACKEND)
+
+
+# กัน webhook ซ้ำ: LINE ส่ง event เดิมซ้ำ (deliveryContext.isRedelivery) เมื่อเราตอบช้า
+# ถ้าประมวลผลซ้ำ flow warfarin จะเดินหน้า 2 ขั้นจากข้อความเดียว จึงจำ webhookEventId ไว้ช่วงหนึ่ง
+DEDUP_BACKEND = os.environ.get("DEDUP_BACKEND", "memory")  # memory, sqlite หรือ off
+DEDUP_WINDOW_SECONDS = int(os.environ.get("DEDUP_WINDOW_SECONDS", 10 * 60))
+DEDUP_MAX_EVENTS = int(os.environ.get("DEDUP_MAX_EVENTS", 100000))
+DEDUP_DB_PATH = os.environ.get("DEDUP_DB_PATH", SESSION_DB_PATH)
+
+
+class EventDedup(abc.ABC):
+    """ดัชนี webhookEventId ที่รับแล้วภายในช่วงเวลา DEDUP_WINDOW_SECONDS"""
+
+    @abc.abstractmethod
+    def add(self, event_id):
+        """บันทึก event_id คืน True ถ้าเป็น event ใหม่ False ถ้าเคยรับแล้วในช่วงเวลา (ตรวจและบันทึกในขั้นเดียว)"""
+
+    @abc.abstractmethod
+    def forget(self, event_id):
+        """ลบ event_id ออก ให้ event ที่ LINE ส่งซ้ำครั้งหน้าถูกประมวลผล (เช่น รับไม่ได้เพราะคิวเต็ม)"""
+
+
+class MemoryEventDedup(EventDedup):
+    """ภายใน process เดียว: OrderedDict เรียงตามเวลารับ ลบตัวที่หมดเวลาจากหัวคิว จำกัดจำนวนสูงสุด"""
+
+    def __init__(self, window_seconds, max_events):
+        self.window = window_seconds
+        self.max_events = max_events
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, event_id):
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._seen.get(event_id)
+            if expires_at is not None and expires_at > now:
+                return False
+            # ลำดับใน dict คือลำดับเวลาหมดอายุ ตัวที่หมดเวลาแล้ว (รวมถึง event_id เดิม ถ้ามี) อยู่หัวคิวเสมอ
+            while self._seen:
+                oldest_id, oldest_expires_at = next(iter(self._seen.items()))
+                if oldest_expires_at > now and len(self._seen) < self.max_events:
+                    break
+                del self._seen[oldest_id]
+            self._seen[event_id] = now + self.window
+            return True
+
+    def forget(self, event_id):
+        with self._lock:
+            self._seen.pop(event_id, None)
+
+    def __len__(self):
+        return len(self._seen)
+
+
+class SQLiteEventDedup(EventDedup):
+    """เก็บใน SQLite (WAL) ให้ทุก worker บนเครื่องเดียวกันเห็นดัชนีเดียวกัน"""
+
+    PURGE_EVERY = 1024
+
+    def __init__(self, path, window_seconds, max_events):
+        self.path = path
+        self.window = window_seconds
+        self.max_events = max_events
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS webhook_events ("
+            "event_id TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS webhook_events_expires_at ON webhook_events (expires_at)")
+
+    def _conn(self):
+        return sqlite_connection(self._local, self.path)
+
+    def add(self, event_id):
+        now = time.time()
+        # insert ใหม่ หรือเขียนทับแถวที่หมดเวลาแล้ว; rowcount 0 = มีแถวที่ยังไม่หมดเวลาอยู่ (event ซ้ำ)
+        cursor = self._conn().execute(
+            "INSERT INTO webhook_events (event_id, expires_at) VALUES (?, ?) "
+            "ON CONFLICT(event_id) DO UPDATE SET expires_at = excluded.expires_at "
+            "WHERE webhook_events.expires_at <= ?",
+            (event_id, now + self.window, now)
+        )
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self.purge()
+        return cursor.rowcount == 1
+
+    def forget(self, event_id):
+        self._conn().execute("DELETE FROM webhook_events WHERE event_id = ?", (event_id,))
+
+    def purge(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM webhook_events WHERE expires_at <= ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM webhook_events WHERE event_id IN ("
+            "SELECT event_id FROM webhook_events ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_events,)
+        )
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM webhook_events").fetchone()[0]
+
+
+def create_event_dedup(backend):
+    if backend == "off":
+        return None
+    if backend == "memory":
+        return MemoryEventDedup(DEDUP_WINDOW_SECONDS, DEDUP_MAX_EVENTS)
+    if backend == "sqlite":
+        return SQLiteEventDedup(DEDUP_DB_PATH, DEDUP_WINDOW_SECONDS, DEDUP_MAX_EVENTS)
+    raise ValueError(f"DEDUP_BACKEND ไม่รองรับ: {backend}")
+
+
+event_dedup = create_event_dedup(DEDUP_BACKEND)
+
+
+# ตารางยาอยู่ในไฟล์ formulary.json (แก้ได้โดยไม่ต้อง deploy ใหม่)
+# ครั้งแรกที่โหลดจะ compile เป็น snapshot แบบ binary ไว้ข้างๆ worker อื่นๆ mmap ไฟล์เดียวกันแทนการ parse JSON
+FORMULARY_PATH = os.environ.get("FORMULARY_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "formulary.json"))
+FORMULARY_SNAPSHOT_PATH = os.environ.get("FORMULARY_SNAPSHOT_PATH", os.path.splitext(FORMULARY_PATH)[0] + ".bin")
+FORMULARY_WATCH_SECONDS = float(os.environ.get("FORMULARY_WATCH_SECONDS", 0))  # 0 = ไม่เฝ้าไฟล์
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+SNAPSHOT_MAGIC = b"FMLY2\n"  # เปลี่ยนเมื่อรูปแบบข้อมูลหลัง normalize เปลี่ยน
+
+
+class FormularyError(ValueError):
+    pass
+
+
+def parse_formulary(raw, path):
+    if path.endswith((".yaml", ".yml")):
+        import yaml  # ใช้เฉพาะเมื่อเก็บตารางยาเป็น YAML
+        data = yaml.safe_load(raw)
+    else:
+        data = json.loads(raw)
+    if not isinstance(data, dict) or not isinstance(data.get("drugs"), dict) or not isinstance(data.get("special_drugs"), dict):
+        raise FormularyError(f"{path}: ต้องมี key 'drugs' และ 'special_drugs' เป็น object")
+    return validate_formulary_tables(data["drugs"], path, normalize=True), validate_formulary_tables(data["special_drugs"], path)
+
+
+def validate_formulary_tables(drugs, path, normalize=False):
+    tables = {}
+    for drug, info in drugs.items():
+        if not isinstance(info, dict):
+            raise FormularyError(f"{path}: {drug} ต้องเป็น object")
+        info = dict(info)
+        # ความแรงเขียนเป็น mg ต่อ ml ตามฉลาก เช่น 250 mg / 5 ml
+        if "strength_mg" in info or "strength_ml" in info:
+            mg, ml = info.pop("strength_mg", None), info.pop("strength_ml", None)
+            if not mg or not ml or mg <= 0 or ml <= 0:
+                raise FormularyError(f"{path}: {drug} strength_mg / strength_ml ต้องเป็นตัวเลขมากกว่า 0")
+            info = {"concentration_mg_per_ml": mg / ml, **info}
+        conc = info.get("concentration_mg_per_ml")
+        if not isinstance(conc, (int, float)) or conc <= 0:
+            raise FormularyError(f"{path}: {drug} ไม่มีความแรงยา (strength_mg / strength_ml)")
+        bottle_size = info.get("bottle_size_ml")
+        if not isinstance(bottle_size, (int, float)) or bottle_size <= 0:
+            raise FormularyError(f"{path}: {drug} bottle_size_ml ต้องเป็นตัวเลขมากกว่า 0")
+        if not isinstance(info.get("indications"), dict) or not info["indications"]:
+            raise FormularyError(f"{path}: {drug} ต้องมี indications อย่างน้อย 1 รายการ")
+        for name in info.get("common_indications", []):
+            if name not in info["indications"]:
+                raise FormularyError(f"{path}: {drug} common_indications มี {name} ที่ไม่อยู่ใน indications")
+        if normalize:
+            info["indications"] = {
+                name: normalize_indication(value, f"{path}: {drug} / {name}")
+                for name, value in info["indications"].items()
             }
-        }
-        },
-        "common_indications": [
-        "Iron deficiency, treatment"
-        ]
-    }
+        tables[drug] = info
+    return tables
+
+
+INDICATION_OTHERS = "INDICATION_OTHERS"
+
+DOSE_ENTRY_KEYS = {
+    "label", "sub_indication", "title", "name", "day_range",
+    "dose_mg_per_kg_per_day", "fixed_dose_by_weight", "frequency",
+    "duration_days", "duration_days_range", "max_mg_per_day", "max_mg_per_dose", "note",
+}
+
+
+def _is_positive(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0
+
+
+def normalize_indication(value, where):
+    """
+    แปลง indication ของ DRUG_DATABASE ให้เหลือ 2 รูปแบบ: dict 1 entry หรือ list ของ entry
+    (sub-indication แบบ dict ซ้อน → list โดยใช้ชื่อ key เป็น title)
+    """
+    if value == INDICATION_OTHERS:
+        return value
+    if isinstance(value, list):
+        if not value:
+            raise FormularyError(f"{where}: ต้องมีอย่างน้อย 1 entry")
+        entries = [normalize_dose_entry(entry, f"{where} #{idx + 1}") for idx, entry in enumerate(value)]
+        with_day_range = sum(1 for entry in entries if entry["day_range"] is not None)
+        if 0 < with_day_range < len(entries):
+            raise FormularyError(f"{where}: ต้องมี day_range ทุก entry หรือไม่มีเลย")
+        return entries
+    if isinstance(value, dict) and value and all(isinstance(v, dict) for v in value.values()):
+        return [normalize_dose_entry(entry, f"{where} / {sub}", title=sub) for sub, entry in value.items()]
+    if isinstance(value, dict):
+        return normalize_dose_entry(value, where)
+    raise FormularyError(f"{where}: ต้องเป็น object หรือ list")
+
+
+def normalize_dose_entry(entry, where, title=None):
+    """ตรวจ entry ขนาดยาแล้วคืนค่าในรูปแบบเดียว (มีทุก key เสมอ ค่าที่ไม่มีเป็น None)"""
+    if not isinstance(entry, dict):
+        raise FormularyError(f"{where}: ต้องเป็น object")
+    unknown = set(entry) - DOSE_ENTRY_KEYS
+    if unknown:
+        raise FormularyError(f"{where}: ไม่รู้จัก key {', '.join(sorted(unknown))}")
+
+    dose = entry.get("dose_mg_per_kg_per_day")
+    fixed = entry.get("fixed_dose_by_weight")
+    if (dose is None) == (fixed is None):
+        raise FormularyError(f"{where}: ต้องมี dose_mg_per_kg_per_day หรือ fixed_dose_by_weight อย่างใดอย่างหนึ่ง")
+    if isinstance(dose, list):
+        if len(dose) != 2 or not all(_is_positive(d) for d in dose) or dose[0] > dose[1]:
+            raise FormularyError(f"{where}: dose_mg_per_kg_per_day แบบช่วงต้องเป็น [ต่ำสุด, สูงสุด]")
+    elif dose is not None and not _is_positive(dose):
+        raise FormularyError(f"{where}: dose_mg_per_kg_per_day ต้องเป็นตัวเลขมากกว่า 0")
+
+    bands = None
+    if fixed is not None:
+        if not isinstance(fixed, list) or not fixed:
+            raise FormularyError(f"{where}: fixed_dose_by_weight ต้องเป็น list ของช่วงน้ำหนัก")
+        bands = []
+        for band in fixed:
+            if not isinstance(band, dict) or not all(_is_positive(band.get(k)) for k in ("min_weight", "max_weight", "dose_mg")) \
+                    or band["min_weight"] > band["max_weight"]:
+                raise FormularyError(f"{where}: fixed_dose_by_weight ต้องมี min_weight ≤ max_weight และ dose_mg")
+            bands.append({"min_weight": band["min_weight"], "max_weight": band["max_weight"], "dose_mg": band["dose_mg"]})
+        bands.sort(key=lambda band: band["min_weight"])
+
+    frequency = entry.get("frequency")
+    freqs = frequency if isinstance(frequency, list) else [frequency]
+    if not freqs or not all(isinstance(f, int) and not isinstance(f, bool) and f > 0 for f in freqs):
+        raise FormularyError(f"{where}: frequency ต้องเป็นจำนวนครั้ง/วัน หรือ list ของจำนวนครั้ง/วัน")
+
+    days = entry.get("duration_days")
+    days_range = entry.get("duration_days_range")
+    if days_range is not None:
+        if not isinstance(days_range, list) or len(days_range) != 2 or not all(_is_positive(d) for d in days_range) \
+                or days_range[0] > days_range[1]:
+            raise FormularyError(f"{where}: duration_days_range ต้องเป็น [ต่ำสุด, สูงสุด]")
+        if days is None:
+            days = days_range[1]  # คิดปริมาณยาตามระยะเวลาที่นานที่สุด
+    if not _is_positive(days):
+        raise FormularyError(f"{where}: ต้องมี duration_days หรือ duration_days_range")
+
+    for key in ("max_mg_per_day", "max_mg_per_dose"):
+        if entry.get(key) is not None and not _is_positive(entry[key]):
+            raise FormularyError(f"{where}: {key} ต้องเป็นตัวเลขมากกว่า 0")
+
+    return {
+        "title": title or get_indication_title(entry),
+        "day_range": entry.get("day_range"),
+        "dose_mg_per_kg_per_day": dose,
+        "fixed_dose_by_weight": bands,
+        "frequency": freqs,
+        "duration_days": days,
+        "duration_days_range": days_range,
+        "max_mg_per_day": entry.get("max_mg_per_day"),
+        "max_mg_per_dose": entry.get("max_mg_per_dose"),
+        "note": entry.get("note"),
     }
 
+
+def load_formulary(path, snapshot_path):
+    """
+    คืนค่า (drug_database, special_drugs) จาก snapshot ถ้ายังตรงกับไฟล์ต้นฉบับ
+    ไม่เช่นนั้น parse + validate ไฟล์ต้นฉบับแล้วเขียน snapshot ใหม่
+    """
+    with open(path, "rb") as f:
+        raw = f.read()
+    digest = hashlib.sha256(raw).digest()
+
+    try:
+        with open(snapshot_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header_len = len(SNAPSHOT_MAGIC) + len(digest)
+            if mm[:len(SNAPSHOT_MAGIC)] == SNAPSHOT_MAGIC and mm[len(SNAPSHOT_MAGIC):header_len] == digest:
+                return pickle.loads(memoryview(mm)[header_len:])
+    except (OSError, ValueError, pickle.UnpicklingError):
+        pass
+
+    tables = parse_formulary(raw, path)
+    build_rule_index(*tables)  # ให้ compile ไม่ผ่านตั้งแต่ตอนโหลด ไม่ใช่ตอนคำนวณ
+    try:
+        tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_MAGIC + digest)
+            pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, snapshot_path)
+    except OSError as e:
+        logging.warning(f"⚠️ เขียน snapshot ตารางยาไม่ได้: {e}")
+    return tables
+
+
+def reload_formulary():
+    reload_drug_tables(*load_formulary(FORMULARY_PATH, FORMULARY_SNAPSHOT_PATH))
+
+
+def watch_formulary(interval):
+    """เฝ้าดูไฟล์ตารางยา แล้ว reload เมื่อไฟล์เปลี่ยน (ทุก worker process เฝ้าของตัวเอง)"""
+    def loop():
+        last = os.stat(FORMULARY_PATH).st_mtime_ns
+        while True:
+            time.sleep(interval)
+            try:
+                mtime = os.stat(FORMULARY_PATH).st_mtime_ns
+                if mtime != last:
+                    last = mtime
+                    reload_formulary()
+            except Exception as e:
+                logging.warning(f"⚠️ reload ตารางยาไม่สำเร็จ ใช้ชุดเดิมต่อ: {e}")
+
+    threading.Thread(target=loop, daemon=True, name="formulary-watcher").start()
+
+
 @app.route('/')
 def home():
     return 'LINE Bot is running!'
 
+# จำนวน worker ที่ดึง event จากคิว (0 = ประมวลผลใน request เหมือนเดิม)
+EVENT_WORKERS = int(os.environ.get("EVENT_WORKERS", 4))
+EVENT_WORKER_MODE = os.environ.get("EVENT_WORKER_MODE", "thread")  # thread หรือ process
+EVENT_QUEUE_MAX = int(os.environ.get("EVENT_QUEUE_MAX", 1000))
+
+
+class EventWorkerPool:
+    """
+    คิว event แบบจำกัดขนาด แยกเป็น shard ตาม user_id เพื่อให้ event ของ user เดียวกัน
+    ถูกประมวลผลตามลำดับโดย worker ตัวเดียวเสมอ
+    (โหมด process: session ของ user จึงอยู่ใน process เดียวกันตลอด
+    และ worker ส่ง metric ที่นับได้หลังแต่ละ event กลับมาให้ thread event-metrics ของแม่รวม)
+    """
+
+    def __init__(self, dispatch, workers, max_depth, mode="thread"):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"EVENT_WORKER_MODE ไม่รองรับ: {mode}")
+        self.dispatch = dispatch
+        self.workers = workers
+        self.mode = mode
+        self.shard_size = max(1, max_depth // workers)
+        self._ctx = multiprocessing.get_context("fork")
+        self._queues = []
+        self._runners = []
+        self._metrics = None  # โหมด process: คิว drain_metrics() จาก worker
+        self._metrics_thread = None
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.rejected = 0
+        self.max_depth_seen = 0
+        # ตัวนับฝั่ง worker ต้องแชร์ข้าม process ได้ในโหมด process
+        self.processed = self._ctx.Value("q", 0)
+        self.failed = self._ctx.Value("q", 0)
+
+    def start(self):
+        with self._lock:
+            if self._runners:
+                return
+            if self.mode == "process":
+                self._metrics = self._ctx.Queue()
+                self._metrics_thread = threading.Thread(
+                    target=self._merge_metrics, args=(self._metrics,), daemon=True, name="event-metrics"
+                )
+                self._metrics_thread.start()
+            for _ in range(self.workers):
+                if self.mode == "process":
+                    q = self._ctx.Queue(self.shard_size)
+                    runner = self._ctx.Process(target=self._run, args=(q,), daemon=True)
+                else:
+                    q = queue.Queue(self.shard_size)
+                    runner = threading.Thread(target=self._run, args=(q,), daemon=True)
+                self._queues.append(q)
+                self._runners.append(runner)
+            for runner in self._runners:
+                runner.start()
+        logging.info(f"🧵 เริ่ม event worker {self.workers} ตัว ({self.mode}), คิวละ {self.shard_size} event")
+
+    def _run(self, q):
+        metrics = self._metrics
+        if metrics is not None:
+            drain_metrics()  # ค่าที่ติดมาตอน fork เป็นของแม่
+        while True:
+            event = q.get()
+            if event is None:
+                return
+            try:
+                self.dispatch(event)
+                with self.processed.get_lock():
+                    self.processed.value += 1
+            except Exception as e:
+                with self.failed.get_lock():
+                    self.failed.value += 1
+                logging.info(f"❌ Exception occurred in worker: {e}")
+            if metrics is not None:
+                metrics.put(drain_metrics())
+
+    @staticmethod
+    def _merge_metrics(metrics):
+        while True:
+            drained = metrics.get()
+            if drained is None:
+                return
+            merge_metrics(drained)
+
+    def submit(self, event):
+        """ใส่ event ลงคิวของ user นั้น คืนค่า False ถ้าคิวเต็ม (เริ่ม worker ใน start_background_workers ไว้แล้ว)"""
+        if not self._runners:
+            self.start()
+        user_id = getattr(event.source, "user_id", None) or ""
+        q = self._queues[zlib.crc32(user_id.encode()) % self.workers]
+        try:
+            q.put_nowait(event)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            logging.warning(f"⚠️ คิว event เต็ม ({self.shard_size}) → ปฏิเสธ event")
+            return False
+        depth = q.qsize()
+        with self._lock:
+            self.enqueued += 1
+            self.max_depth_seen = max(self.max_depth_seen, depth)
+        return True
+
+    def stats(self):
+        depths = [q.qsize() for q in self._queues]
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "max_depth": self.shard_size * self.workers,
+            "depth": sum(depths),
+            "shard_depths": depths,
+            "max_depth_seen": self.max_depth_seen,
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "processed": self.processed.value,
+            "failed": self.failed.value,
+        }
+
+    def shutdown(self):
+        """ใส่ None ต่อท้ายคิว: worker ทำ event ที่ค้างอยู่ให้หมดก่อนแล้วจบ (เรียกซ้ำได้)"""
+        with self._lock:
+            runners, self._runners = self._runners, []
+            queues, self._queues = self._queues, []
+        for q in queues:
+            q.put(None)
+        for runner in runners:
+            runner.join()
+        # worker จบแล้ว metric ที่ส่งมาอยู่ในคิวครบ: None ต่อท้ายให้ thread รวมให้หมดแล้วจบ
+        metrics_thread, self._metrics_thread = self._metrics_thread, None
+        if metrics_thread is not None:
+            self._metrics.put(None)
+            metrics_thread.join()
+        logging.info(f"🧵 ปิด event worker {len(runners)} ตัวแล้ว")
+
+
+def dispatch_event(event):
+    if isinstance(event, MessageEvent):
+        handle_message(event)
+    elif isinstance(event, PostbackEvent):
+        handle_postback(event)
+
+
+event_pool = EventWorkerPool(dispatch_event, EVENT_WORKERS, EVENT_QUEUE_MAX, EVENT_WORKER_MODE) if EVENT_WORKERS > 0 else None
+
+
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers.get('X-Line-Signature')
     body = request.get_data(as_text=True)
 
+    if event_pool is None:
+        try:
+            for event in parse_webhook(body, signature):
+                dispatch_event(event)
+        except InvalidSignatureError:
+            abort(400)
+        except Exception as e:
+            logging.info(f"❌ Exception occurred: {e}")
+            abort(400)
+        return 'OK'
+
     try:
-        handler.handle(body, signature)
+        events = parse_webhook(body, signature)
     except InvalidSignatureError:
         abort(400)
     except Exception as e:
         logging.info(f"❌ Exception occurred: {e}")
         abort(400)
+
+    # ตอบ 200 ทันที ให้ worker คำนวณและ reply ทีหลัง
+    for idx, event in enumerate(events):
+        if not event_pool.submit(event):
+            # คิวเต็ม → ให้ LINE ส่ง webhook ซ้ำภายหลัง (event ที่ยังไม่ได้รับต้องไม่ถูกนับว่าซ้ำ)
+            if event_dedup is not None:
+                for rejected in events[idx:]:
+                    if getattr(rejected, "webhook_event_id", None):
+                        event_dedup.forget(rejected.webhook_event_id)
+            abort(503)
     return 'OK'
 
+@app.route("/admin/reload-formulary", methods=['POST'])
+def admin_reload_formulary():
+    if not admin_authorized(request.headers.get("Authorization")):
+        abort(403)
+    return reload_formulary_result()
+
+def admin_authorized(authorization):
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(authorization or "", f"Bearer {ADMIN_TOKEN}")
+
+def reload_formulary_result():
+    """reload ตารางยาให้ /admin/reload-formulary (Flask และ asgi.py) คืน (JSON, status)"""
+    try:
+        reload_formulary()
+    except Exception as e:
+        logging.warning(f"⚠️ reload ตารางยาไม่สำเร็จ ใช้ชุดเดิมต่อ: {e}")
+        return {"ok": False, "error": str(e)}, 400
+    return {"ok": True, "version": TABLES_VERSION}, 200
+
+def admin_or_local(remote_addr, authorization):
+    """/metrics และ /stats เปิดให้เฉพาะเครื่องเดียวกัน (Prometheus agent ข้างเครื่อง) หรือผู้ที่มี ADMIN_TOKEN"""
+    if remote_addr in ("127.0.0.1", "::1"):
+        return True
+    return admin_authorized(authorization)
+
+@app.route("/metrics")
+def metrics():
+    if not admin_or_local(request.remote_addr, request.headers.get("Authorization")):
+        abort(403)
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route("/stats")
+def stats():
+    if not admin_or_local(request.remote_addr, request.headers.get("Authorization")):
+        abort(403)
+    return stats_snapshot()
+
+def stats_snapshot():
+    return {
+        "event_queue": event_pool.stats() if event_pool else None,
+        "dedup": {"backend": DEDUP_BACKEND, "size": len(event_dedup)} if event_dedup is not None else None,
+        "reply_cache": reply_cache_stats(),
+        "outbound": outbound.stats(),
+        "audit": audit_log.stats() if audit_log is not None else None,
+    }
+
+LINE_REPLY_URL = os.environ.get("LINE_REPLY_URL", "https://api.line.me/v2/bot/message/reply")  # เปลี่ยนได้เพื่อชี้ไป LINE API จำลอง
+
+REPLY_MAX_MESSAGES = 5  # LINE รับได้ไม่เกิน 5 ข้อความต่อ reply token
+REPLY_MAX_RETRIES = int(os.environ.get("REPLY_MAX_RETRIES", 3))
+REPLY_RETRY_BASE_SECONDS = float(os.environ.get("REPLY_RETRY_BASE_SECONDS", 0.2))
+REPLY_RETRY_MAX_SECONDS = 5
+REPLY_LATENCY_SAMPLES = 2048
+
+
+class OutboundDispatcher:
+    """
+    รวมทุกข้อความที่สร้างระหว่างจัดการ event เดียวกันเป็น reply call เดียว (≤ 5 ข้อความ)
+    ส่งผ่าน connection pool ของ line_pool_manager, retry 5xx/429 แบบ exponential backoff + jitter
+    และเก็บ latency ของแต่ละ call ไว้คำนวณ percentile
+    """
+
+    def __init__(self, pool_manager, url, access_token, max_retries, retry_base):
+        self.pool_manager = pool_manager
+        self.url = url
+        self.headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+        }
+        self.timeout = urllib3.Timeout(connect=LINE_CONNECT_TIMEOUT, read=LINE_READ_TIMEOUT)
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=REPLY_LATENCY_SAMPLES)
+        self.counts = {"calls": 0, "retries": 0, "failed": 0, "dropped_messages": 0}
+
+    def collect(self, reply_token, send=True):
+        """
+        ใช้กับ with: ข้อความที่ add() ภายในบล็อกจะถูกส่งรวมกันตอนออกจากบล็อก
+        send=False เก็บไว้ใน scope.messages ให้ผู้เรียกส่งเอง (เช่นโหมด asyncio)
+        บล็อกที่ซ้อนอยู่ใน scope ของ reply token เดียวกันจะรวมเข้ากับ scope นอก
+        """
+        return _OutboxScope(self, reply_token, send)
+
+    def add(self, reply_token, messages_json):
+        """messages_json: list ของข้อความที่ serialize เป็น JSON แล้ว (ข้อความละ 1 string)"""
+        outbox = getattr(self.local, "outbox", None)
+        if outbox is not None and outbox[0] == reply_token:
+            outbox[1].extend(messages_json)
+        else:
+            self.reply(reply_token, messages_json)
+
+    def reply(self, reply_token, messages_json):
+        body = self.reply_body(reply_token, messages_json)
+        if body is not None:
+            self.post(body)
+
+    def reply_body(self, reply_token, messages_json):
+        if not messages_json:
+            return None
+        if len(messages_json) > REPLY_MAX_MESSAGES:
+            logging.warning(f"⚠️ ตัดข้อความตอบกลับเหลือ {REPLY_MAX_MESSAGES} จาก {len(messages_json)}")
+            with self.lock:
+                self.counts["dropped_messages"] += len(messages_json) - REPLY_MAX_MESSAGES
+            messages_json = messages_json[:REPLY_MAX_MESSAGES]
+        body = '{"replyToken":%s,"messages":[%s]}' % (json.dumps(reply_token), ",".join(messages_json))
+        return body.encode("utf-8")
+
+    def post(self, body):
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                r = self.pool_manager.request("POST", self.url, body=body, headers=self.headers, timeout=self.timeout)
+                status, reason, retry_after = r.status, r.reason, r.headers.get("Retry-After")
+            except urllib3.exceptions.HTTPError as e:
+                status, reason, retry_after = None, str(e), None
+            delay = self.record(attempt, time.perf_counter() - started, status, reason, retry_after)
+            if delay is None:
+                return
+            time.sleep(delay)
+
+    def record(self, attempt, elapsed, status, reason, retry_after):
+        """
+        บันทึกผล 1 call แล้วตัดสินใจ: คืน None ถ้าสำเร็จ, คืนเวลาที่ต้องรอถ้าควร retry,
+        raise ApiException ถ้าไม่ควร retry แล้ว (ใช้ร่วมกันทั้งโหมด thread และ asyncio)
+        """
+        STAGE_SECONDS.observe("reply_message", elapsed)
+        with self.lock:
+            self.counts["calls"] += 1
+            self.latencies.append(elapsed)
+
+        if status is not None and 200 <= status < 300:
+            return None
+        if (status is None or status == 429 or status >= 500) and attempt < self.max_retries:
+            # full jitter: สุ่มรอ 0 – base × 2^attempt วินาที (หรือตาม Retry-After ถ้ามี)
+            delay = random.uniform(0, self.retry_base * 2 ** attempt)
+            if retry_after and retry_after.isdigit():
+                # reply token หมดอายุเร็ว ไม่รอนานกว่า REPLY_RETRY_MAX_SECONDS
+                delay = min(max(delay, int(retry_after)), REPLY_RETRY_MAX_SECONDS)
+            with self.lock:
+                self.counts["retries"] += 1
+            logging.info("🔁 LINE API ตอบ %s ลองใหม่ใน %.2f วินาที", status or reason, delay)
+            return delay
+        with self.lock:
+            self.counts["failed"] += 1
+        from linebot.v3.messaging import ApiException
+        raise ApiException(status=status or 0, reason=reason)
+
+    def stats(self):
+        with self.lock:
+            samples = np.array(self.latencies) * 1000
+            stats = dict(self.counts)
+        if samples.size:
+            p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+            stats["latency_ms"] = {
+                "p50": round(float(p50), 1), "p90": round(float(p90), 1),
+                "p99": round(float(p99), 1), "max": round(float(samples.max()), 1),
+            }
+        return stats
+
+
+class _OutboxScope:
+    def __init__(self, dispatcher, reply_token, send):
+        self.dispatcher = dispatcher
+        self.reply_token = reply_token
+        self.send = send
+        self.nested = False
+        self.messages = []
+
+    def __enter__(self):
+        outbox = getattr(self.dispatcher.local, "outbox", None)
+        if outbox is not None and outbox[0] == self.reply_token:
+            self.nested = True
+        else:
+            self.dispatcher.local.outbox = (self.reply_token, self.messages)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.nested:
+            return
+        self.dispatcher.local.outbox = None
+        if exc_type is None and self.send:
+            self.dispatcher.reply(self.reply_token, self.messages)
+
+
+outbound = OutboundDispatcher(
+    line_pool_manager, LINE_REPLY_URL, LINE_CHANNEL_ACCESS_TOKEN,
+    REPLY_MAX_RETRIES, REPLY_RETRY_BASE_SECONDS,
+)
+
+
+def reply_text(event, text):
+    with stage_timer("build_messages"):
+        message = json.dumps({"type": "text", "text": text}, ensure_ascii=False)
+    outbound.add(event.reply_token, [message])
+
+
+# carousel เลือกยา/ข้อบ่งใช้ ขึ้นกับตารางยาอย่างเดียว จึงสร้างครั้งแรกที่ใช้แล้วเก็บ JSON ไว้ (ข้อความละ 1 string)
+# key: ("drugs",) / ("indications", drug, show_all) / ("special_indications", drug)
+PICKER_CACHE = {}
+
+
+def get_picker_payload(key, build_messages):
+    payload = PICKER_CACHE.get(key)
+    if payload is None:
+        with stage_timer("build_messages"):
+            payload = [
+                json.dumps(message.to_dict(), ensure_ascii=False, separators=(",", ":"))
+                for message in build_messages()
+            ]
+        PICKER_CACHE[key] = payload
+    return payload
+
+
+def warm_picker_cache():
+    """สร้าง carousel ทุกชุดไว้ล่วงหน้า (ก่อน fork หรือก่อนเขียน picker snapshot)"""
+    get_picker_payload(("drugs",), build_drug_selection_messages)
+    for drug_name, drug_info in DRUG_DATABASE.items():
+        for show_all in (False, True):
+            get_picker_payload(
+                ("indications", drug_name, show_all),
+                lambda: build_indication_messages(drug_name, drug_info, show_all)
+            )
+    for drug_name, drug_info in SPECIAL_DRUGS.items():
+        get_picker_payload(
+            ("special_indications", drug_name),
+            lambda: build_special_indication_messages(drug_name, drug_info)
+        )
+
+
+# picker snapshot: JSON ของ carousel ทุกชุดที่สร้างไว้ตอน build (python coldstart.py build)
+# ให้ process ใหม่ตอบ carousel แรกได้โดยไม่ต้อง import linebot.v3.messaging
+# ใช้ได้เมื่อทั้งตารางยาและโค้ดไฟล์นี้ตรงกับตอนสร้าง (ตรวจด้วย sha256 ของทั้งสองไฟล์)
+PICKER_SNAPSHOT_PATH = os.environ.get("PICKER_SNAPSHOT_PATH", os.path.splitext(FORMULARY_PATH)[0] + ".pickers.bin")
+PICKER_SNAPSHOT_MAGIC = b"PICK1\n"
+
+
+def picker_snapshot_digest():
+    digest = hashlib.sha256()
+    for path in (FORMULARY_PATH, os.path.abspath(__file__)):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    # โหมด postback: ปุ่มมี token ที่เซ็นด้วย key ของ deployment นี้
+    digest.update(PEDIATRIC_FLOW.encode("utf-8"))
+    if PEDIATRIC_FLOW == "postback":
+        digest.update(hmac.new(FLOW_TOKEN_KEY, b"picker-snapshot", hashlib.sha256).digest())
+    return digest.digest()
+
+
+def save_picker_snapshot(path=PICKER_SNAPSHOT_PATH):
+    warm_picker_cache()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(PICKER_SNAPSHOT_MAGIC + picker_snapshot_digest())
+        pickle.dump(dict(PICKER_CACHE), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    return len(PICKER_CACHE)
+
+
+def load_picker_snapshot(path=PICKER_SNAPSHOT_PATH):
+    """เติม PICKER_CACHE จาก snapshot คืนจำนวนชุดที่โหลด (0 ถ้าไม่มีหรือไม่ตรงกับตาราง/โค้ดปัจจุบัน)"""
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+    except OSError:
+        return 0
+    header = PICKER_SNAPSHOT_MAGIC + picker_snapshot_digest()
+    if not raw.startswith(header):
+        logging.info("ℹ️ picker snapshot ไม่ตรงกับตารางยา/โค้ดปัจจุบัน จะสร้าง carousel ใหม่เมื่อใช้")
+        return 0
+    try:
+        PICKER_CACHE.update(pickle.loads(memoryview(raw)[len(header):]))
+    except (EOFError, ValueError, pickle.UnpicklingError):
+        return 0
+    return len(PICKER_CACHE)
+
+
 def send_drug_selection(event):
+    outbound.add(event.reply_token, get_picker_payload(("drugs",), build_drug_selection_messages))
+
+
+def build_drug_selection_messages():
+    from linebot.v3.messaging import CarouselColumn, CarouselTemplate, TemplateMessage
     carousel1 = CarouselTemplate(columns=[
-        CarouselColumn(title='Amoxicillin', text='250 mg/5 ml', actions=[MessageAction(label='เลือก Amoxicillin', text='เลือกยา: Amoxicillin')]),
-        CarouselColumn(title='Cephalexin', text='125 mg/5 ml', actions=[MessageAction(label='เลือก Cephalexin', text='เลือกยา: Cephalexin')]),
-        CarouselColumn(title='Cefdinir', text='125 mg/5 ml', actions=[MessageAction(label='เลือก Cefdinir', text='เลือกยา: Cefdinir')]),
-        CarouselColumn(title='Cefixime', text='100 mg/5 ml', actions=[MessageAction(label='เลือก Cefixime', text='เลือกยา: Cefixime')]),
-        CarouselColumn(title='Augmentin', text='600 mg/5 ml', actions=[MessageAction(label='เลือก Augmentin', text='เลือกยา: Augmentin')]),
+        CarouselColumn(title='Amoxicillin', text='250 mg/5 ml', actions=[picker_action('เลือก Amoxicillin', 'เลือกยา: Amoxicillin', 'Amoxicillin')]),
+        CarouselColumn(title='Cephalexin', text='125 mg/5 ml', actions=[picker_action('เลือก Cephalexin', 'เลือกยา: Cephalexin', 'Cephalexin')]),
+        CarouselColumn(title='Cefdinir', text='125 mg/5 ml', actions=[picker_action('เลือก Cefdinir', 'เลือกยา: Cefdinir', 'Cefdinir')]),
+        CarouselColumn(title='Cefixime', text='100 mg/5 ml', actions=[picker_action('เลือก Cefixime', 'เลือกยา: Cefixime', 'Cefixime')]),
+        CarouselColumn(title='Augmentin', text='600 mg/5 ml', actions=[picker_action('เลือก Augmentin', 'เลือกยา: Augmentin', 'Augmentin')]),
     ])
     carousel2 = CarouselTemplate(columns=[
-        CarouselColumn(title='Azithromycin', text='200 mg/5 ml', actions=[MessageAction(label='เลือก Azithromycin', text='เลือกยา: Azithromycin')]),
-        CarouselColumn(title='Paracetamol', text='10–15 mg/kg/dose', actions=[MessageAction(label='เลือก Paracetamol', text='เลือกยา: Paracetamol')]),
-        CarouselColumn(title='Cetirizine', text='0.25 mg/kg/day', actions=[MessageAction(label='เลือก Cetirizine', text='เลือกยา: Cetirizine')]),
-        CarouselColumn(title='Hydroxyzine', text='10 mg/5 ml', actions=[MessageAction(label='เลือก Hydroxyzine', text='เลือกยา: Hydroxyzine')]),
-        CarouselColumn(title='Ferrous drop', text='15 mg/0.6 ml', actions=[MessageAction(label='เลือก Ferrous drop', text='เลือกยา: Ferrous drop')])
+        CarouselColumn(title='Azithromycin', text='200 mg/5 ml', actions=[picker_action('เลือก Azithromycin', 'เลือกยา: Azithromycin', 'Azithromycin')]),
+        CarouselColumn(title='Paracetamol', text='10–15 mg/kg/dose', actions=[picker_action('เลือก Paracetamol', 'เลือกยา: Paracetamol', 'Paracetamol')]),
+        CarouselColumn(title='Cetirizine', text='0.25 mg/kg/day', actions=[picker_action('เลือก Cetirizine', 'เลือกยา: Cetirizine', 'Cetirizine')]),
+        CarouselColumn(title='Hydroxyzine', text='10 mg/5 ml', actions=[picker_action('เลือก Hydroxyzine', 'เลือกยา: Hydroxyzine', 'Hydroxyzine')]),
+        CarouselColumn(title='Ferrous drop', text='15 mg/0.6 ml', actions=[picker_action('เลือก Ferrous drop', 'เลือกยา: Ferrous drop', 'Ferrous drop')])
     ])
-    messaging_api.reply_message(
-    ReplyMessageRequest(
-        reply_token=event.reply_token,
-        messages=[
-            TemplateMessage(alt_text="เลือกยากลุ่มแรก", template=carousel1),
-            TemplateMessage(alt_text="เลือกยากลุ่มเพิ่มเติม", template=carousel2)
-        ]
-    ))
-    return
+    return [
+        TemplateMessage(alt_text="เลือกยากลุ่มแรก", template=carousel1),
+        TemplateMessage(alt_text="เลือกยากลุ่มเพิ่มเติม", template=carousel2)
+    ]
 
 def send_indication_carousel(event, drug_name, show_all=False):
     drug_info = DRUG_DATABASE.get(drug_name)
     if not drug_info or "indications" not in drug_info:
-        messaging_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=f"ไม่พบข้อมูลสำหรับยา {drug_name}")]
-            )
-        )
+        reply_text(event, f"ไม่พบข้อมูลสำหรับยา {drug_name}")
         return
 
+    outbound.add(event.reply_token, get_picker_payload(
+        ("indications", drug_name, show_all),
+        lambda: build_indication_messages(drug_name, drug_info, show_all)
+    ))
+
+
+def build_indication_messages(drug_name, drug_info, show_all):
+    from linebot.v3.messaging import MessageAction, CarouselColumn, CarouselTemplate, TemplateMessage
     indications = drug_info["indications"]
     common = drug_info.get("common_indications", [])
 
@@ -648,16 +1229,17 @@ def send_indication_carousel(event, drug_name, show_all=False):
 
         if name != "Indication อื่นๆ":
             indication_info = indications[name]
-            if isinstance(indication_info, list):
-                text = f"{indication_info[0]['dose_mg_per_kg_per_day']} mg/kg/day"
+            entry = indication_info[0] if isinstance(indication_info, list) else indication_info
+            if entry["dose_mg_per_kg_per_day"] is None:
+                text = "ขนาดยาตามช่วงน้ำหนัก"
             else:
-                text = f"{indication_info['dose_mg_per_kg_per_day']} mg/kg/day"
-            action_text = f"Indication: {name}"
+                text = f"{entry['dose_mg_per_kg_per_day']} mg/kg/day"
+            action = picker_action(label, f"Indication: {name}", drug_name, name)
         else:
             text = "ดูข้อบ่งใช้อื่นทั้งหมด"
-            action_text = f"MoreIndication: {drug_name}"
+            action = MessageAction(label=label, text=f"MoreIndication: {drug_name}")
 
-        actions = [MessageAction(label=label, text=action_text)]
+        actions = [action]
         columns.append(CarouselColumn(title=title, text=text, actions=actions))
 
     carousel_chunks = [columns[i:i + 5] for i in range(0, len(columns), 5)]
@@ -674,335 +1256,923 @@ def send_indication_carousel(event, drug_name, show_all=False):
         except Exception as e:
             logging.info(f"⚠️ ผิดพลาดตอนสร้าง TemplateMessage: {e}")
 
-    logging.info(f"📤 ส่ง carousel ทั้งหมด: {len(messages)} ชุด")
-    try:
-        messaging_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=messages
-            )
-        )
-        return
-    except Exception as e:
-        logging.info(f"❌ ผิดพลาดตอนส่งข้อความ: {e}")
+    logging.debug("📤 สร้าง carousel ทั้งหมด: %d ชุด", len(messages))
+    return messages
 
 
-def calculate_warfarin(inr, twd, bleeding):
-    if bleeding == "yes":
-        return "🚨 มี major bleeding → หยุด Warfarin, ให้ Vitamin K1"
-    if inr < 1.5:
-        return f"🔹 INR < 1.5 → เพิ่มขนาดยา 10–20%\nขนาดยาใหม่: {twd * 1.1:.1f} – {twd * 1.2:.1f} mg/สัปดาห์"
-    elif 1.5 <= inr <= 1.9:
-        return f"🔹 INR 1.5–1.9 → เพิ่มขนาดยา 5–10%\nขนาดยาใหม่: {twd * 1.05:.1f} – {twd * 1.10:.1f} mg/สัปดาห์"
-    elif 2.0 <= inr <= 3.0:
-        return "✅ INR 2.0–3.0 → คงขนาดยาเดิม"
-    elif 4.0 <= inr <= 4.9:
-        return f"⚠️ INR 4.0–4.9 → หยุดยา 1 วัน และลดขนาดยา 10%\nขนาดยาใหม่: {twd * 0.9:.1f} mg/สัปดาห์"
-    else:
-        return "🚨 INR ≥ 5.0 → หยุดยา และพิจารณาให้ Vitamin K"
+# ตารางปรับขนาด Warfarin ตามช่วง INR (ค่า INR ปัดเป็นทศนิยม 1 ตำแหน่งตามที่แล็บรายงาน)
+# (INR ต่ำสุดของช่วง, ชื่อช่วง, icon, คำแนะนำ, % ปรับต่ำสุด, % ปรับสูงสุด, จำนวนวันที่หยุดยา)
+# % เป็น None = ยังไม่กำหนดขนาดใหม่, วันหยุดยาเป็น None = หยุดจนกว่า INR จะลดลง
+WARFARIN_BANDS = (
+    (-math.inf, "< 1.5", "🔹", "เพิ่มขนาดยา 10–20%", 10, 20, 0),
+    (1.5, "1.5–1.9", "🔹", "เพิ่มขนาดยา 5–10%", 5, 10, 0),
+    (2.0, "2.0–3.0", "✅", "คงขนาดยาเดิม", 0, 0, 0),
+    (3.1, "3.1–3.9", "🔸", "ลดขนาดยา 5–10%", -10, -5, 0),
+    (4.0, "4.0–4.9", "⚠️", "หยุดยา 1 วัน และลดขนาดยา 10%", -10, -10, 1),
+    (5.0, "≥ 5.0", "🚨", "หยุดยา และพิจารณาให้ Vitamin K", None, None, None),
+)
+WARFARIN_BLEEDING = (None, "major bleeding", "🚨", "หยุด Warfarin, ให้ Vitamin K1", None, None, None)
+WARFARIN_BAND_STARTS = [band[0] for band in WARFARIN_BANDS]
 
-def calculate_dose(drug, indication, weight):
-    drug_info = DRUG_DATABASE.get(drug)
-    if not drug_info:
-        return f"❌ ไม่พบข้อมูลยา {drug}"
 
-    indication_info = drug_info["indications"].get(indication)
-    if not indication_info:
-        return f"❌ ไม่พบ indication {indication} ใน {drug}"
+def inr_tenths(inr):
+    """
+    ปัด INR เป็นทศนิยม 1 ตำแหน่งแบบปัดครึ่งขึ้น (1.95 → 2.0) ก่อนหาช่วง
+    round() / np.round ปัดครึ่งไปหาเลขคู่และเห็นค่า float คนละแบบ ทำให้ค่าขอบช่วงตกคนละช่วงได้
+    adjust_warfarin และ adjust_warfarin_batch จึงใช้สูตรเดียวกันนี้
+    """
+    return math.floor(inr * 10 + 0.5) / 10
 
-    conc = drug_info["concentration_mg_per_ml"]
-    bottle_size = drug_info["bottle_size_ml"]
-    total_ml = 0
-    reply_lines = [f"{drug} - {indication} (น้ำหนัก {weight} kg):"]
-
-    # ✅ รองรับกรณี indication เป็น dict ซ้อน (sub-indications)
-    if all(isinstance(v, dict) for v in indication_info.values()):
-        for sub_ind, sub_info in indication_info.items():
-            dose_per_kg = sub_info["dose_mg_per_kg_per_day"]
-            freqs = sub_info["frequency"] if isinstance(sub_info["frequency"], list) else [sub_info["frequency"]]
-            days = sub_info["duration_days"]
-            max_mg_day = sub_info.get("max_mg_per_day")
-            max_mg_per_dose = sub_info.get("max_mg_per_dose")
-            note = sub_info.get("note")
-
-            if isinstance(dose_per_kg, list):
-                min_dose, max_dose = dose_per_kg
-                min_total_mg_day = weight * min_dose
-                max_total_mg_day = weight * max_dose
-
-                if max_mg_day:
-                    min_total_mg_day = min(min_total_mg_day, max_mg_day)
-                    max_total_mg_day = min(max_total_mg_day, max_mg_day)
-
-                ml_per_day_min = min_total_mg_day / conc
-                ml_per_day_max = max_total_mg_day / conc
-                ml_total = ml_per_day_max * days
-                total_ml += ml_total
-
-                min_freq = min(freqs)
-                max_freq = max(freqs)
-                reply_lines.append(
-                    f"📌 {sub_ind}: {min_dose} – {max_dose} mg/kg/day → {min_total_mg_day:.0f} – {max_total_mg_day:.0f} mg/day ≈ "
-                    f"{ml_per_day_min:.1f} – {ml_per_day_max:.1f} ml/day, แบ่งวันละ {min_freq} – {max_freq} ครั้ง × {days} วัน "
-                    f"(ครั้งละ ~{ml_per_day_max / max_freq:.1f} – {ml_per_day_min / min_freq:.1f} ml)"
-                )
-            else:
-                total_mg_day = weight * dose_per_kg
-                if max_mg_day:
-                    total_mg_day = min(total_mg_day, max_mg_day)
-                ml_per_day = total_mg_day / conc
-                ml_total = ml_per_day * days
-                total_ml += ml_total
-
-                if len(freqs) == 1:
-                    freq = freqs[0]
-                    ml_per_dose = ml_per_day / freq
-                    if max_mg_per_dose:
-                        ml_per_dose = min(ml_per_dose, max_mg_per_dose / conc)
-                    reply_lines.append(
-                        f"📌 {sub_ind}: {dose_per_kg} mg/kg/day → {total_mg_day:.0f} mg/day ≈ {ml_per_day:.1f} ml/day, "
-                        f"ครั้งละ ~{ml_per_dose:.1f} ml × {freq} ครั้ง/วัน × {days} วัน"
-                    )
-                else:
-                    min_freq = min(freqs)
-                    max_freq = max(freqs)
-                    reply_lines.append(
-                        f"📌 {sub_ind}: {dose_per_kg} mg/kg/day → {total_mg_day:.0f} mg/day ≈ {ml_per_day:.1f} ml/day, "
-                        f"แบ่งวันละ {min_freq} – {max_freq} ครั้ง × {days} วัน (ครั้งละ ~{ml_per_day / max_freq:.1f} – {ml_per_day / min_freq:.1f} ml)"
-                    )
-
-            if note:
-                reply_lines.append(f"📝 หมายเหตุ: {note}")
-
-    # ✅ รองรับหลายช่วงวัน (list)
-    elif isinstance(indication_info, list):
-        for phase in indication_info:
-            title = get_indication_title(phase)
-            if title:
-                reply_lines.append(f"\n🔹 {title}")
-            dose_per_kg = phase["dose_mg_per_kg_per_day"]
-            freqs = phase["frequency"] if isinstance(phase["frequency"], list) else [phase["frequency"]]
-            days = phase["duration_days"]
-            max_mg_day = phase.get("max_mg_per_day")
-
-            total_mg_day = weight * dose_per_kg
-            if max_mg_day:
-                total_mg_day = min(total_mg_day, max_mg_day)
-
-            ml_per_day = total_mg_day / conc
-            ml_phase = ml_per_day * days
-            total_ml += ml_phase
-
-            if len(freqs) == 1:
-                freq = freqs[0]
-                ml_per_dose = ml_per_day / freq
-                if "max_mg_per_dose" in phase:
-                    ml_per_dose = min(ml_per_dose, phase["max_mg_per_dose"] / conc)
-                reply_lines.append(
-                    f"📆 {phase['day_range']}: {dose_per_kg} mg/kg/day → {total_mg_day:.0f} mg/day ≈ {ml_per_day:.1f} ml/day, "
-                    f"ครั้งละ ~{ml_per_dose:.1f} ml × {freq} ครั้ง/วัน × {days} วัน"
-                )
-            else:
-                min_freq = min(freqs)
-                max_freq = max(freqs)
-                reply_lines.append(
-                    f"📆 {phase['day_range']}: {dose_per_kg} mg/kg/day → {total_mg_day:.0f} mg/day ≈ {ml_per_day:.1f} ml/day, "
-                    f"แบ่งวันละ {min_freq} – {max_freq} ครั้ง × {days} วัน (ครั้งละ ~{ml_per_day / max_freq:.1f} – {ml_per_day / min_freq:.1f} ml)"
-                )
 
-    # ✅ กรณี indication เป็น dict ธรรมดา
-    else:
-        dose_per_kg = indication_info["dose_mg_per_kg_per_day"]
-        freqs = indication_info["frequency"] if isinstance(indication_info["frequency"], list) else [indication_info["frequency"]]
-        days = indication_info["duration_days"]
-        max_mg_day = indication_info.get("max_mg_per_day")
-
-        if isinstance(dose_per_kg, list):
-            min_dose, max_dose = dose_per_kg
-            min_total_mg_day = weight * min_dose
-            max_total_mg_day = weight * max_dose
-
-            if max_mg_day:
-                min_total_mg_day = min(min_total_mg_day, max_mg_day)
-                max_total_mg_day = min(max_total_mg_day, max_mg_day)
-
-            ml_per_day_min = min_total_mg_day / conc
-            ml_per_day_max = max_total_mg_day / conc
-            total_ml = ml_per_day_max * days
-
-            min_freq = min(freqs)
-            max_freq = max(freqs)
-            reply_lines.append(
-                f"ขนาดยา: {min_dose} – {max_dose} mg/kg/day → {min_total_mg_day:.0f} – {max_total_mg_day:.0f} mg/day ≈ "
-                f"{ml_per_day_min:.1f} – {ml_per_day_max:.1f} ml/day, แบ่งวันละ {min_freq} – {max_freq} ครั้ง × {days} วัน (ครั้งละ ~{ml_per_day_max / max_freq:.1f} – {ml_per_day_min / min_freq:.1f} ml)"
-            )
-        else:
-            total_mg_day = weight * dose_per_kg
-            if max_mg_day:
-                total_mg_day = min(total_mg_day, max_mg_day)
-
-            ml_per_day = total_mg_day / conc
-            total_ml = ml_per_day * days
-
-            if len(freqs) == 1:
-                freq = freqs[0]
-                ml_per_dose = ml_per_day / freq
-                if "max_mg_per_dose" in indication_info:
-                    ml_per_dose = min(ml_per_dose, indication_info["max_mg_per_dose"] / conc)
-                reply_lines.append(
-                    f"ขนาดยา: {dose_per_kg} mg/kg/day → {total_mg_day:.0f} mg/day ≈ {ml_per_day:.1f} ml/day, "
-                    f"ครั้งละ ~{ml_per_dose:.1f} ml × {freq} ครั้ง/วัน × {days} วัน"
-                )
-            else:
-                min_freq = min(freqs)
-                max_freq = max(freqs)
-                reply_lines.append(
-                    f"ขนาดยา: {dose_per_kg} mg/kg/day → {total_mg_day:.0f} mg/day ≈ {ml_per_day:.1f} ml/day, "
-                    f"แบ่งวันละ {min_freq} – {max_freq} ครั้ง × {days} วัน (ครั้งละ ~{ml_per_day / max_freq:.1f} – {ml_per_day / min_freq:.1f} ml)"
-                )
+class WarfarinAdjustment:
+    """ผลการปรับขนาด Warfarin 1 ราย"""
 
-        note = indication_info.get("note")
-        if note:
-            reply_lines.append(f"\n📝 หมายเหตุ: {note}")
-
-    bottles = math.ceil(total_ml / bottle_size)
-    reply_lines.append(f"\nรวมทั้งหมด {total_ml:.1f} ml → จ่าย {bottles} ขวด ({bottle_size} ml)")
-    return "\n".join(reply_lines)
-
-def calculate_special_drug(user_id, drug, weight, age):
-    info = SPECIAL_DRUGS[drug]
-    indication = user_drug_selection.get(user_id, {}).get("indication")
-
-    if drug == "Hydroxyzine" and indication == "Pruritus (weight_based)":
-        data = info["indications"][indication]
-        if weight <= 40:
-            profile = data["\u226440kg"]  # ≤ = less than or equal to
-            dose_per_kg = profile["dose_mg_per_kg_per_day"]
-            freqs = profile["frequency"] if isinstance(profile["frequency"], list) else [profile["frequency"]]
-            max_dose = profile["max_mg_per_dose"]
-
-            total_mg_day = weight * dose_per_kg
-            reply_lines = [f"{drug} - {indication} (\u226440kg):"]
-            for freq in freqs:
-                dose_per_time = min(total_mg_day / freq, max_dose)
-                reply_lines.append(f"💊 {total_mg_day:.1f} mg/day → {freq} ครั้ง/วัน → ครั้งละ ~{dose_per_time:.1f} mg")
-            return "\n".join(reply_lines)
+    __slots__ = (
+        "inr", "twd", "icon", "label", "action", "pct_min", "pct_max", "twd_min", "twd_max", "hold_days",
+        "schedule", "schedule_skipped", "rendered",
+    )
 
+    def __init__(self, inr, twd, band):
+        _, label, icon, action, pct_min, pct_max, hold_days = band
+        self.inr = inr
+        self.twd = twd
+        self.icon = icon
+        self.label = label
+        self.action = action
+        self.pct_min = pct_min
+        self.pct_max = pct_max
+        self.hold_days = hold_days
+        if pct_min is None:
+            self.twd_min = self.twd_max = None
         else:
-            profile = data[">40kg"]
-            dose_range = profile["dose_mg_range"]
-            freqs = profile["frequency"] if isinstance(profile["frequency"], list) else [profile["frequency"]]
-            max_dose = profile["max_mg_per_dose"]
-
-            reply_lines = [f"{drug} - {indication} (>40kg):"]
-            for freq in freqs:
-                for dose in dose_range:
-                    dose_per_time = min(dose, max_dose)
-                    reply_lines.append(f"💊 {dose_per_time:.1f} mg × {freq} ครั้ง/วัน")
-            return "\n".join(reply_lines)
-    
-    if drug == "Cetirizine":
-        indication_info = info["indications"].get(indication)
-        if not indication_info:
-            return f"❌ ไม่พบข้อบ่งใช้ {indication}"
-
-        # ตรวจสอบ age_group ที่มีอยู่จริง
-        possible_groups = indication_info.keys()
-        
-        age_group = None
-        if age < 1:
-            age_group = "6_to_11_months"
-        elif 1 <= age < 2:
-            age_group = "12_to_23_months"
-        elif 2 <= age <= 5 and "2_to_5_years" in possible_groups:
-            age_group = "2_to_5_years"
-        elif 6 <= age <= 11 and "6_to_11_years" in possible_groups:
-            age_group = "6_to_11_years"
-        elif age >= 12 and "above_or_equal_12" in possible_groups:
-            age_group = "above_or_equal_12"
-        elif age > 5 and "above_5" in possible_groups:
-            age_group = "above_5"
-
-        group_data = indication_info.get(age_group)
-        if not group_data:
-            return f"❌ ไม่พบข้อมูลกลุ่มอายุที่เหมาะสม (อายุ {age} ปี)"
-
-        lines = [f"{drug} - {indication} (อายุ {age} ปี):"]
-        if "dose_mg" in group_data:
-            lines.append(f"💊 ขนาดยา: {group_data['dose_mg']} mg × {group_data['frequency']} ครั้ง/วัน")
-        elif "initial_dose_mg" in group_data:
-            options = group_data.get("options", [])
-            lines.append(f"💊 เริ่มต้น {group_data['initial_dose_mg']} mg × {group_data['frequency']} ครั้ง/วัน")
-            for opt in options:
-                lines.append(f"หรือ: {opt['dose_mg']} mg × {opt['frequency']} ครั้ง/วัน")
-        elif "dose_range_mg" in group_data:
-            for dose in group_data["dose_range_mg"]:
-                lines.append(f"💊 ขนาดยา: {dose} mg × {group_data['frequency']} ครั้ง/วัน")
-        elif "dose_mg_range" in group_data:
-            for dose in group_data["dose_mg_range"]:
-                lines.append(f"💊 ขนาดยา: {dose} mg × {group_data['frequency']} ครั้ง/วัน")
-        elif "dose_mg" in group_data and "frequency_options" in group_data:
-            for freq in group_data["frequency_options"]:
-                lines.append(f"💊 ขนาดยา: {group_data['dose_mg']} mg × {freq} ครั้ง/วัน")
-
-        return "\n".join(lines)
-    
-    if drug == "Ferrous drop":
-        indication_info = info["indications"][indication]["all_ages"]
-        dose_per_kg = indication_info["initial_dose_mg_per_kg_per_day"]
-        freqs = indication_info["frequency"]
-        max_range = indication_info["max_dose_range_mg_per_day"]
-        usual_max = indication_info.get("usual_max_mg_per_day")
-        absolute_max = indication_info.get("absolute_max_mg_per_day")
-
-        total_mg_day = weight * dose_per_kg
-        total_mg_day = min(max(total_mg_day, max_range[0]), max_range[1])
-        if absolute_max:
-            total_mg_day = min(total_mg_day, absolute_max)
-
-        reply_lines = [f"{drug} - {indication} (น้ำหนัก {weight} kg):"]
-        reply_lines.append(f"💊 {dose_per_kg} mg/kg/day → {total_mg_day:.1f} mg/day")
-
-        for freq in freqs:
-            reply_lines.append(f"→ {freq} ครั้ง/วัน → ครั้งละ ~{(total_mg_day / freq):.1f} mg")
-
-        if "note" in indication_info:
-            reply_lines.append(f"\n📌 หมายเหตุ: {indication_info['note']}")
-
-        return "\n".join(reply_lines)
-
-    # กรณีพิเศษอื่น ๆ เช่น Paracetamol (ใช้แบบเดิม)
-    indication_info = next(iter(info["indications"].values()))
-    for entry in indication_info:
-        if entry["min_age_years"] <= age < entry["max_age_years"]:
-            dose_per_kg = entry["dose_mg_per_kg_per_day"]
-            freq = entry["frequency"]
-            duration = entry["duration_days"]
-            max_dose = entry["max_mg_per_dose"]
-
-            total_mg_day = weight * dose_per_kg
-            dose_per_time = min(total_mg_day / freq, max_dose)
-
-            return (
-                f"{drug} (อายุ {age} ปี, น้ำหนัก {weight} kg):\n"
-                f"ขนาดยา: {dose_per_kg} mg/kg/day → {total_mg_day:.1f} mg/day\n"
-                f"แบ่ง {freq} ครั้ง/วัน → ครั้งละ ~{dose_per_time:.1f} mg เป็นเวลา {duration} วัน"
-            )
+            self.twd_min = twd * (100 + pct_min) / 100
+            self.twd_max = twd * (100 + pct_max) / 100
+        self.schedule = None
+        self.schedule_skipped = False  # WarfarinSchedule ตัวอย่างของขนาดยาใหม่ (เติมโดย calculate_warfarin)
+        self.rendered = {}
 
-    return f"❌ ไม่พบขนาดยาที่เหมาะสมสำหรับอายุ {age} ปีใน {drug}"
 
+def adjust_warfarin(inr, twd, bleeding=False):
+    if bleeding:
+        return WarfarinAdjustment(inr, twd, WARFARIN_BLEEDING)
+    idx = bisect.bisect_right(WARFARIN_BAND_STARTS, inr_tenths(inr)) - 1
+    return WarfarinAdjustment(inr, twd, WARFARIN_BANDS[idx])
 
-def send_special_indication_carousel(event, drug_name):
-    drug_info = SPECIAL_DRUGS.get(drug_name)
-    if not drug_info or "indications" not in drug_info:
-        messaging_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=f"ไม่พบข้อบ่งใช้ของ {drug_name}")]
-            )
-        )
-        return
 
+def calculate_warfarin(inr, twd, bleeding):
+    """
+    ปรับขนาดยาพร้อมตารางกินยาตัวอย่างของขนาดใหม่ (ถ้ามี) bleeding เป็น "yes" / "no" ตามที่ผู้ใช้ตอบ
+    ตารางที่จัดให้ตรงช่วงไม่ได้ใช้ได้ถ้าห่างจากเป้าหมายไม่เกิน WARFARIN_SCHEDULE_MAX_MISS (แสดงว่าเป็นค่าประมาณ)
+    ห่างกว่านั้นไม่แสดงตาราง (schedule_skipped)
+    """
+    adjustment = adjust_warfarin(inr, twd, bleeding == "yes")
+    if adjustment.twd_min is not None:
+        schedules = plan_warfarin_week(adjustment.twd_min, adjustment.twd_max)
+        target = (adjustment.twd_min + adjustment.twd_max) / 2
+        if schedules and schedules[0].miss <= target * WARFARIN_SCHEDULE_MAX_MISS:
+            adjustment.schedule = schedules[0]
+        else:
+            adjustment.schedule_skipped = True
+    if audit_log is not None:
+        audit_log.record(AUDIT_WARFARIN, (inr, twd, bleeding), adjustment)
+    return adjustment
+
+
+def adjust_warfarin_batch(inrs, twds, bleeding=None):
+    """
+    ปรับขนาด Warfarin หลายรายพร้อมกัน (เช่น worklist ของคลินิก) แบบ vectorized
+    คืนค่า structured array 1 แถวต่อราย, band = index ใน WARFARIN_BANDS (-1 = major bleeding)
+    ค่าที่ไม่มี (ไม่กำหนดขนาดใหม่ / หยุดจนกว่า INR ลดลง) เป็น NaN
+    INR / TWD ต้องอยู่ในช่วงเดียวกับที่รับจากผู้ใช้ (parse_warfarin_value) ไม่อย่างนั้น ValueError
+    """
+    inrs = np.asarray(inrs, dtype=np.float64).ravel()
+    twds = np.asarray(twds, dtype=np.float64).ravel()
+    if inrs.shape != twds.shape:
+        raise ValueError("จำนวนค่า INR และ TWD ต้องเท่ากัน")
+    # NaN เทียบแล้วเป็น False เสมอ จึงถูกนับเป็นค่าผิดด้วย
+    for name, values, upper in (("INR", inrs, WARFARIN_MAX_INR), ("TWD", twds, WARFARIN_MAX_TWD)):
+        invalid = np.flatnonzero(~((values > 0) & (values <= upper)))
+        if invalid.size:
+            raise ValueError(f"ค่า {name} ต้องมากกว่า 0 ไม่เกิน {upper:g} (แถวที่ผิด: {invalid[:10].tolist()})")
+
+    def column(pos):
+        return np.array([np.nan if band[pos] is None else band[pos] for band in WARFARIN_BANDS], dtype=np.float64)
+
+    band = np.searchsorted(WARFARIN_BAND_STARTS, np.floor(inrs * 10 + 0.5) / 10, side="right") - 1
+    pct_min = column(4)[band]
+    pct_max = column(5)[band]
+    hold_days = column(6)[band]
+    if bleeding is not None:
+        bleeding = np.asarray(bleeding, dtype=bool).ravel()
+        band = np.where(bleeding, -1, band)
+        pct_min[bleeding] = pct_max[bleeding] = hold_days[bleeding] = np.nan
+
+    result = np.empty(inrs.size, dtype=[
+        ("inr", np.float64), ("twd", np.float64), ("band", np.int8),
+        ("pct_min", np.float64), ("pct_max", np.float64),
+        ("twd_min", np.float64), ("twd_max", np.float64), ("hold_days", np.float64),
+    ])
+    result["inr"] = inrs
+    result["twd"] = twds
+    result["band"] = band
+    result["pct_min"] = pct_min
+    result["pct_max"] = pct_max
+    result["twd_min"] = twds * (100 + pct_min) / 100
+    result["twd_max"] = twds * (100 + pct_max) / 100
+    result["hold_days"] = hold_days
+    return result
+
+# เม็ดยา Warfarin ที่มีในคลัง (mg) แบ่งครึ่งเม็ดได้ และสีเม็ดยาสำหรับบอกผู้ป่วย
+WARFARIN_TABLETS_MG = tuple(float(mg) for mg in os.environ.get("WARFARIN_TABLETS_MG", "2,3,5").split(","))
+WARFARIN_TABLET_COLOURS = {2.0: "สีส้ม", 3.0: "สีฟ้า", 5.0: "สีชมพู"}
+WARFARIN_MAX_TABLETS_PER_DAY = 2  # ต่อความแรง
+WARFARIN_SCHEDULE_MAX_MISS = 0.1  # ตารางตัวอย่างที่จัดไม่ตรงช่วง ห่างจากเป้าหมายได้ไม่เกิน 10%
+WEEKDAYS = ("จ.", "อ.", "พ.", "พฤ.", "ศ.", "ส.", "อา.")
+
+
+class WarfarinSchedule:
+    """
+    ตารางกินยา 7 วัน: วันละ low_mg ยกเว้นวันใน high_days ที่กิน high_mg
+    miss = total_mg อยู่นอกช่วง TWD ที่ขอกี่ mg (0 = ตรงช่วง)
+    """
+
+    __slots__ = (
+        "total_mg", "low_mg", "low_tablets", "high_mg", "high_tablets", "high_days", "tablet_types", "half_tablets",
+        "miss", "rendered",
+    )
+
+    def __init__(self, low, high, n_high, miss=0):
+        self.low_mg, self.low_tablets = low
+        self.high_mg, self.high_tablets = high
+        # กระจายวันที่กินขนาดสูงให้ห่างกันทั้งสัปดาห์
+        self.high_days = tuple(round((i + 0.5) * 7 / n_high - 0.5) for i in range(n_high))
+        self.total_mg = self.low_mg * (7 - n_high) + self.high_mg * n_high
+        used = (self.low_tablets if n_high < 7 else ()) + (self.high_tablets if n_high else ())
+        self.tablet_types = len({mg for mg, _ in used})
+        self.half_tablets = (
+            sum(halves % 2 for _, halves in self.low_tablets) * (7 - n_high)
+            + sum(halves % 2 for _, halves in self.high_tablets) * n_high
+        )
+        self.miss = miss
+        self.rendered = {}
+
+
+@lru_cache(maxsize=None)
+def _daily_doses(strengths):
+    """ขนาดยาต่อวันทั้งหมดที่จัดได้จากเม็ดยาชุดนี้ (ทีละครึ่งเม็ด) เลือกแบบที่มีครึ่งเม็ดและจำนวนเม็ดน้อยสุด"""
+    best = {}
+    for halves in itertools.product(range(2 * WARFARIN_MAX_TABLETS_PER_DAY + 1), repeat=len(strengths)):
+        if not all(halves):
+            continue  # ให้ชุดย่อยที่ไม่ใช้ความแรงนี้เป็นคนหา
+        mg = sum(h * strength for h, strength in zip(halves, strengths)) / 2
+        cost = (sum(h % 2 for h in halves), sum(halves))
+        if mg not in best or cost < best[mg][0]:
+            best[mg] = (cost, tuple(zip(strengths, halves)))
+    return tuple(sorted((mg, tablets) for mg, (_, tablets) in best.items()))
+
+
+@lru_cache(maxsize=1024)
+def _plan_warfarin_week(twd_min, twd_max, strengths, top):
+    target = (twd_min + twd_max) / 2
+    # ขนาดยาต่อวันของทุกชุดเม็ดยา (ใช้ได้ไม่เกิน 2 ความแรงต่อวัน)
+    doses = sorted({
+        option
+        for r in (1, 2)
+        for subset in itertools.combinations(strengths, r)
+        for option in _daily_doses(subset)
+    })
+    mgs = [mg for mg, _ in doses]
+    types = [frozenset(mg for mg, _ in tablets) for _, tablets in doses]
+    halves = [sum(h % 2 for _, h in tablets) for _, tablets in doses]
+
+    def candidates(exact):
+        for i, low in enumerate(mgs):
+            for n_high in range(7):
+                n_low = 7 - n_high
+                if n_high == 0:
+                    first, last = i, i + 1
+                    if exact and not twd_min - 1e-9 <= low * 7 <= twd_max + 1e-9:
+                        continue
+                elif exact:
+                    # วันที่เหลือต้องได้ขนาด high ที่ทำให้ TWD อยู่ในช่วงพอดี → หาช่วงด้วย bisect
+                    first = max(bisect.bisect_left(mgs, (twd_min - low * n_low) / n_high - 1e-9), i)
+                    last = bisect.bisect_right(mgs, (twd_max - low * n_low) / n_high + 1e-9)
+                else:
+                    # ขนาด high ที่ใกล้เป้าหมายที่สุดทั้งสองฝั่ง
+                    k = bisect.bisect_left(mgs, (target - low * n_low) / n_high)
+                    first = max(bisect.bisect_left(mgs, mgs[max(k - 1, 0)]), i)
+                    last = bisect.bisect_right(mgs, mgs[min(k, len(mgs) - 1)])
+                for j in range(first, last):
+                    high = mgs[j]
+                    if high > 2 * low:
+                        break  # ไม่ให้ขนาดยาแต่ละวันต่างกันเกิน 2 เท่า
+                    if n_high and high == low:
+                        continue  # ซ้ำกับกรณี n_high = 0
+                    total = low * n_low + high * n_high
+                    miss = max(twd_min - total, total - twd_max, 0)
+                    used = (types[i] if n_low else frozenset()) | (types[j] if n_high else frozenset())
+                    key = (round(miss, 2), len(used), halves[i] * n_low + halves[j] * n_high,
+                           high - low, abs(total - target))
+                    yield key, i, j, n_high
+
+    ranked = sorted(candidates(exact=True))
+    if not ranked:
+        ranked = sorted(candidates(exact=False))  # จัดให้ตรงช่วงไม่ได้ เอาที่ใกล้ที่สุด
+    # n_high = 0 คือกินเท่ากันทุกวัน (ใช้ doses[i] ทั้ง 7 วัน)
+    return tuple(
+        WarfarinSchedule(doses[i], doses[i], 7, key[0]) if n_high == 0
+        else WarfarinSchedule(doses[i], doses[j], n_high, key[0])
+        for key, i, j, n_high in ranked[:top]
+    )
+
+
+def plan_warfarin_week(twd_min, twd_max=None, strengths=WARFARIN_TABLETS_MG, top=3):
+    """
+    หาตารางกินยา 7 วันที่ได้ TWD ในช่วง [twd_min, twd_max] (ถ้าไม่มีเลยคืนที่ใกล้ที่สุด โดย miss > 0)
+    เรียงตาม ห่างจากเป้าหมาย → จำนวนชนิดเม็ดยา → จำนวนครึ่งเม็ด → ความต่างของขนาดยาแต่ละวัน
+    """
+    if twd_max is None:
+        twd_max = twd_min
+    # ปัดเป้าหมายเป็น 0.1 mg ให้ memo ใช้ซ้ำได้
+    return list(_plan_warfarin_week(round(twd_min, 1), round(twd_max, 1), tuple(sorted(strengths)), top))
+
+
+# cache ผลคำนวณ: น้ำหนักปัดเป็น 0.1 kg, key มี TABLES_VERSION ด้วย
+# เพื่อไม่ให้ผลจากตารางยาชุดเก่าค้างใน cache หลัง reload_drug_tables()
+# ตัวคำนวณคืนเฉพาะตัวเลข (object ด้านล่าง) ข้อความสร้างแยกใน render_reply() และเก็บไว้ใน object เดิมต่อภาษา
+REPLY_CACHE_SIZE = int(os.environ.get("REPLY_CACHE_SIZE", 4096))
+TABLES_VERSION = 0
+
+
+class NoDoseResult:
+    """คำนวณไม่ได้ reason: drug / indication / special_indication / age_group"""
+
+    __slots__ = ("reason", "drug", "indication", "age", "rendered")
+
+    def __init__(self, reason, drug, indication, age=None):
+        self.reason = reason
+        self.drug = drug
+        self.indication = indication
+        self.age = age
+        self.rendered = {}
+
+
+class DoseLine:
+    """
+    ผลของ 1 entry (DoseRule) ที่น้ำหนักหนึ่ง
+    ml_dose_at_max_freq = ขนาดยาสูงสุดต่อวัน / จำนวนครั้งมากสุด, ml_dose_at_min_freq = ขนาดยาต่ำสุดต่อวัน / จำนวนครั้งน้อยสุด
+    band = (น้ำหนักต่ำสุด, สูงสุด, mg ต่อครั้ง) สำหรับยาขนาดคงที่ (None ถ้าน้ำหนักไม่อยู่ในช่วงใด)
+    """
+
+    __slots__ = (
+        "rule", "band", "mg_day_min", "mg_day_max", "ml_day_min", "ml_day_max",
+        "ml_dose_at_max_freq", "ml_dose_at_min_freq", "ml_total", "bottles",
+    )
+
+    def __init__(self, rule, band, mg_day_min, mg_day_max, ml_day_min, ml_day_max,
+                 ml_dose_at_max_freq, ml_dose_at_min_freq, ml_total, bottles):
+        self.rule = rule
+        self.band = band
+        self.mg_day_min = mg_day_min
+        self.mg_day_max = mg_day_max
+        self.ml_day_min = ml_day_min
+        self.ml_day_max = ml_day_max
+        self.ml_dose_at_max_freq = ml_dose_at_max_freq
+        self.ml_dose_at_min_freq = ml_dose_at_min_freq
+        self.ml_total = ml_total
+        self.bottles = bottles
+
+
+class DoseResult:
+    """
+    ผลของ calculate_dose: 1 DoseLine ต่อ entry
+    layout แบบ alternatives คิดจำนวนขวดแยกใน DoseLine (total_ml/bottles เป็น None)
+    """
+
+    __slots__ = ("drug", "indication", "weight", "layout", "lines", "total_ml", "bottles", "bottle_size", "rendered")
+
+    def __init__(self, drug, indication, weight, layout, lines, total_ml, bottles, bottle_size):
+        self.drug = drug
+        self.indication = indication
+        self.weight = weight
+        self.layout = layout
+        self.lines = lines
+        self.total_ml = total_ml
+        self.bottles = bottles
+        self.bottle_size = bottle_size
+        self.rendered = {}
+
+
+def count_dose_calculation(rules, drug, indication):
+    """
+    label ของ metric มาจากข้อความผู้ใช้: นับชื่อยา/ข้อบ่งใช้จริงเฉพาะคู่ที่มีในตาราง
+    คู่อื่นรวมไว้ที่ "unknown" จำนวน series จึงไม่เกินจำนวนคู่ในตารางยา
+    """
+    if (drug, indication) in rules:
+        DOSE_CALCULATIONS_TOTAL.inc(drug, indication)
+    else:
+        DOSE_CALCULATIONS_TOTAL.inc(UNKNOWN_LABEL, UNKNOWN_LABEL)
+
+
+def calculate_dose(drug, indication, weight, entry=None):
+    """entry = ลำดับ regimen ที่เลือก (เฉพาะข้อบ่งใช้แบบ alternatives) None = ทุก regimen"""
+    with stage_timer("calculate_dose"):
+        result = _calculate_dose(TABLES_VERSION, drug, indication, round(weight, 1), entry)
+    count_dose_calculation(INDICATION_RULES, drug, indication)
+    if audit_log is not None:
+        audit_log.record(AUDIT_DOSE, (drug, indication, weight, entry), result)
+    return result
+
+
+# typed: 15 กับ 15.0 เป็นคนละ key (ข้อความแสดงน้ำหนักตามที่ส่งมา "15 kg" / "15.0 kg")
+@lru_cache(maxsize=REPLY_CACHE_SIZE, typed=True)
+def _calculate_dose(tables_version, drug, indication, weight, entry=None):
+    compiled = INDICATION_RULES.get((drug, indication))
+    if compiled is None:
+        return NoDoseResult("drug" if drug not in DRUG_DATABASE else "indication", drug, indication)
+
+    layout, rules = compiled
+    if entry is not None and layout == LAYOUT_ALTERNATIVES:
+        rules = rules[entry:entry + 1]
+    alternatives = layout == LAYOUT_ALTERNATIVES
+    lines = []
+    total_ml = 0
+
+    for rule in rules:
+        if rule.fixed_doses:
+            line = _fixed_dose_line(rule, weight)
+        else:
+            mg_day_max = weight * rule.dose_max
+            if rule.max_mg_day and mg_day_max > rule.max_mg_day:
+                mg_day_max = rule.max_mg_day
+            mg_day_min = mg_day_max
+            if rule.is_range:
+                mg_day_min = weight * rule.dose_min
+                if rule.max_mg_day and mg_day_min > rule.max_mg_day:
+                    mg_day_min = rule.max_mg_day
+            ml_day_max = mg_day_max / rule.conc
+            ml_day_min = mg_day_min / rule.conc
+            # rule.max_mg_day รวมขนาดสูงสุดต่อครั้งแล้ว ครั้งละที่จำนวนครั้งมากสุดจึงไม่เกินเสมอ
+            ml_dose_at_min_freq = ml_day_min / rule.min_freq
+            if rule.max_ml_per_dose is not None:
+                ml_dose_at_min_freq = min(ml_dose_at_min_freq, rule.max_ml_per_dose)
+            ml_total = ml_day_max * rule.days
+            line = DoseLine(
+                rule, None, mg_day_min, mg_day_max, ml_day_min, ml_day_max,
+                ml_day_max / rule.max_freq, ml_dose_at_min_freq, ml_total, None,
+            )
+        if alternatives:
+            # แต่ละ regimen เป็นทางเลือก จึงคิดจำนวนขวดแยกกัน
+            if line.ml_total:
+                line.bottles = math.ceil(line.ml_total / rule.bottle_size)
+        else:
+            total_ml += line.ml_total
+        lines.append(line)
+
+    if alternatives:
+        return DoseResult(drug, indication, weight, layout, tuple(lines), None, None, None)
+    bottle_size = rules[0].bottle_size
+    return DoseResult(drug, indication, weight, layout, tuple(lines), total_ml, math.ceil(total_ml / bottle_size), bottle_size)
+
+
+def _fixed_dose_line(rule, weight):
+    """ขนาดยาคงที่ตามช่วงน้ำหนัก ถ้าน้ำหนักไม่อยู่ในช่วงใดเลย band เป็น None และปริมาณยาเป็น 0"""
+    for lo, hi, dose_mg in rule.fixed_doses:
+        if lo <= weight <= hi:
+            break
+    else:
+        return DoseLine(rule, None, 0, 0, 0, 0, 0, 0, 0, None)
+
+    ml_per_dose = dose_mg / rule.conc
+    ml_per_day = ml_per_dose * rule.max_freq
+    mg_day = dose_mg * rule.max_freq
+    return DoseLine(
+        rule, (lo, hi, dose_mg), mg_day, mg_day, ml_per_day, ml_per_day,
+        ml_per_dose, ml_per_dose, ml_per_day * rule.days, None,
+    )
+
+
+class SpecialDose:
+    """
+    ตัวเลขของ SpecialRule ที่น้ำหนักหนึ่ง (ไม่ขึ้นกับอายุจริง จึง cache ร่วมกันได้ทั้งกลุ่ม)
+    doses = ((mg ต่อครั้ง, จำนวนครั้ง/วัน), ...) เรียงตามที่แสดง
+    """
+
+    __slots__ = ("rule", "weight", "mg_day", "doses", "rendered")
+
+    def __init__(self, rule, weight, mg_day, doses):
+        self.rule = rule
+        self.weight = weight
+        self.mg_day = mg_day
+        self.doses = doses
+        self.rendered = {}
+
+
+class SpecialResult:
+    """ผลของ calculate_special_drug: อายุ/น้ำหนักจริงของผู้ป่วย + SpecialDose ของกลุ่มที่ตรง"""
+
+    __slots__ = ("rule", "age", "weight", "dose", "rendered")
+
+    def __init__(self, rule, age, weight, dose):
+        self.rule = rule
+        self.age = age
+        self.weight = weight
+        self.dose = dose
+        self.rendered = {}
+
+
+def calculate_special_drug(drug, indication, weight, age):
+    with stage_timer("calculate_special_drug"):
+        result = _calculate_special_drug(drug, indication, weight, age)
+    count_dose_calculation(SPECIAL_RULES, drug, indication)
+    if audit_log is not None:
+        audit_log.record(AUDIT_SPECIAL, (drug, indication, weight, age), result)
+    return result
+
+
+def _calculate_special_drug(drug, indication, weight, age):
+    rules = SPECIAL_RULES.get((drug, indication))
+    if rules is None:
+        return NoDoseResult("special_indication", drug, indication)
+
+    weight = round(weight, 1)
+    for rule in rules:
+        if rule.basis == BASIS_WEIGHT:
+            if rule.lo < weight <= rule.hi:
+                break
+        elif rule.lo <= age < rule.hi:
+            break
+    else:
+        return NoDoseResult("age_group", drug, indication, age)
+
+    # cache ตาม (กลุ่มอายุ/น้ำหนัก, น้ำหนัก) อายุจริงอยู่ใน SpecialResult
+    dose = _special_drug_body(TABLES_VERSION, rule, weight if rule.uses_weight else None)
+    return SpecialResult(rule, age, weight, dose)
+
+
+@lru_cache(maxsize=REPLY_CACHE_SIZE)
+def _special_drug_body(tables_version, rule, weight):
+    kind = rule.kind
+    if kind == SPECIAL_PER_KG_DAY_BY_AGE:
+        # เช่น Paracetamol
+        total_mg_day = weight * rule.dose_per_kg
+        return SpecialDose(rule, weight, total_mg_day, ((min(total_mg_day / rule.freqs[0], rule.max_mg_dose), rule.freqs[0]),))
+
+    if kind == SPECIAL_PER_KG_DAY_BY_WEIGHT:
+        total_mg_day = weight * rule.dose_per_kg
+        return SpecialDose(rule, weight, total_mg_day, tuple(
+            (min(total_mg_day / freq, rule.max_mg_dose), freq) for freq in rule.freqs
+        ))
+
+    if kind == SPECIAL_FIXED_BY_WEIGHT:
+        return SpecialDose(rule, weight, None, tuple(
+            (min(dose, rule.max_mg_dose), freq) for freq in rule.freqs for dose in rule.dose_range
+        ))
+
+    if kind == SPECIAL_IRON:
+        # เช่น Ferrous drop: ปรับให้อยู่ในช่วง max_dose_range แล้วไม่เกิน absolute max
+        total_mg_day = min(max(weight * rule.dose_per_kg, rule.clamp_mg_day[0]), rule.clamp_mg_day[1])
+        if rule.max_mg_day:
+            total_mg_day = min(total_mg_day, rule.max_mg_day)
+        return SpecialDose(rule, weight, total_mg_day, tuple((total_mg_day / freq, freq) for freq in rule.freqs))
+
+    if kind == SPECIAL_PER_KG_DOSE:
+        dose_per_time = weight * rule.dose_per_kg
+        if rule.max_mg_dose:
+            dose_per_time = min(dose_per_time, rule.max_mg_dose)
+        return SpecialDose(rule, weight, None, ((dose_per_time, rule.freq_text),))
+
+    # SPECIAL_FIXED_BY_AGE เช่น Cetirizine, Hydroxyzine ตามอายุ: ขนาดยามาจากตารางล้วน
+    if rule.initial_dose_mg is not None:
+        doses = ((rule.initial_dose_mg, rule.freq_text),) + rule.options
+    elif rule.frequency_options:
+        doses = tuple((rule.dose_range[0], freq) for freq in rule.frequency_options)
+    elif len(rule.dose_range) == 1:
+        doses = ((rule.dose_range[0], rule.freq_text),)
+    else:
+        doses = tuple((dose, rule.freq_text) for dose in rule.dose_range)
+    return SpecialDose(rule, weight, None, doses)
+
+
+def reply_cache_stats():
+    stats = {}
+    for name, func in (("dose", _calculate_dose), ("special_drug", _special_drug_body)):
+        info = func.cache_info()
+        lookups = info.hits + info.misses
+        stats[name] = {
+            "hits": info.hits,
+            "misses": info.misses,
+            "size": info.currsize,
+            "max_size": info.maxsize,
+            "hit_rate": round(info.hits / lookups, 3) if lookups else None,
+        }
+    return stats
+
+
+def clear_reply_cache():
+    _calculate_dose.cache_clear()
+    _special_drug_body.cache_clear()
+
+
+# ---------------------------------------------------------------------------
+# ตัวสร้างข้อความตอบกลับจากผลคำนวณ แยกจากตัวคำนวณ: ผู้เรียกที่ต้องการแค่ตัวเลข (JSON, export) ไม่ต้องจ่ายค่าสร้างข้อความ
+# template ของแต่ละภาษา (รูปแบบ str.format) parse ไว้ครั้งเดียว ข้อความที่สร้างแล้วเก็บใน result.rendered ต่อภาษา
+# (ผลจาก lru_cache ของตัวคำนวณเป็น object เดิม ข้อความจึงสร้างครั้งเดียวต่อ result ต่อภาษา)
+# ---------------------------------------------------------------------------
+
+REPLY_LOCALE = os.environ.get("REPLY_LOCALE", "th")  # th หรือ en
+
+REPLY_TEMPLATES = {
+    "th": {
+        "no_drug": "❌ ไม่พบข้อมูลยา {drug}",
+        "no_indication": "❌ ไม่พบ indication {indication} ใน {drug}",
+        "no_special_indication": "❌ ไม่พบข้อบ่งใช้ {indication}",
+        "no_age_group": "❌ ไม่พบข้อมูลกลุ่มอายุที่เหมาะสม (อายุ {age} ปี)",
+
+        "dose_header": "{drug} - {indication} (น้ำหนัก {weight} kg):",
+        "prefix_single": "ขนาดยา: ",
+        "prefix_phase": "📆 {day_range}: ",
+        "prefix_alternative": "📌 {title}: ",
+        "heading_phase": "\n🔹 {title}",
+        "note_single": "\n📝 หมายเหตุ: {note}",
+        "note": "📝 หมายเหตุ: {note}",
+        "dose_range": (
+            "{prefix}{dose_min} – {dose_max} mg/kg/day → {mg_day_min:.0f} – {mg_day_max:.0f} mg/day ≈ "
+            "{ml_day_min:.1f} – {ml_day_max:.1f} ml/day, แบ่งวันละ {min_freq} – {max_freq} ครั้ง × {days} วัน "
+            "(ครั้งละ ~{ml_dose_a:.1f} – {ml_dose_b:.1f} ml)"
+        ),
+        "dose_fixed_freq": (
+            "{prefix}{dose} mg/kg/day → {mg_day:.0f} mg/day ≈ {ml_day:.1f} ml/day, "
+            "ครั้งละ ~{ml_dose:.1f} ml × {freq} ครั้ง/วัน × {days} วัน"
+        ),
+        "dose_freq_range": (
+            "{prefix}{dose} mg/kg/day → {mg_day:.0f} mg/day ≈ {ml_day:.1f} ml/day, "
+            "แบ่งวันละ {min_freq} – {max_freq} ครั้ง × {days} วัน (ครั้งละ ~{ml_dose_a:.1f} – {ml_dose_b:.1f} ml)"
+        ),
+        "dose_by_weight_band": (
+            "{prefix}{dose_mg} mg/ครั้ง (น้ำหนัก {lo}–{hi} kg) → {mg_day:.0f} mg/day ≈ {ml_day:.1f} ml/day, "
+            "ครั้งละ ~{ml_dose:.1f} ml × {freq} ครั้ง/วัน × {days} วัน"
+        ),
+        "dose_no_weight_band": "{prefix}ไม่มีขนาดยาสำหรับน้ำหนัก {weight} kg (ใช้ได้ตั้งแต่ {min_weight} kg ขึ้นไป)",
+        "bottles": "รวม {ml_total:.1f} ml → จ่าย {bottles} ขวด ({bottle_size} ml)",
+        "course_total": "\nรวมทั้งหมด {ml_total:.1f} ml → จ่าย {bottles} ขวด ({bottle_size} ml)",
+
+        "special_header_age_weight": "{drug} (อายุ {age} ปี, น้ำหนัก {weight} kg):",
+        "special_header_group": "{drug} - {indication} ({group}):",
+        "special_header_age": "{drug} - {indication} (อายุ {age} ปี):",
+        "special_header_weight": "{drug} - {indication} (น้ำหนัก {weight} kg):",
+        "special_per_kg_day_by_age": (
+            "ขนาดยา: {dose_per_kg} mg/kg/day → {mg_day:.1f} mg/day\n"
+            "แบ่ง {freq} ครั้ง/วัน → ครั้งละ ~{dose:.1f} mg เป็นเวลา {days} วัน"
+        ),
+        "special_per_kg_day_by_weight": "💊 {mg_day:.1f} mg/day → {freq} ครั้ง/วัน → ครั้งละ ~{dose:.1f} mg",
+        "special_fixed_by_weight": "💊 {dose:.1f} mg × {freq} ครั้ง/วัน",
+        "special_iron": "💊 {dose_per_kg} mg/kg/day → {mg_day:.1f} mg/day",
+        "special_iron_freq": "→ {freq} ครั้ง/วัน → ครั้งละ ~{dose:.1f} mg",
+        "special_iron_note": "\n📌 หมายเหตุ: {note}",
+        "special_per_kg_dose": "💊 {dose_per_kg} mg/kg/ครั้ง → ครั้งละ ~{dose:.1f} mg",
+        "special_per_kg_dose_freq": " × {freq} ครั้ง/วัน",
+        "special_initial": "💊 เริ่มต้น {dose} mg × {freq} ครั้ง/วัน",
+        "special_option": "หรือ: {dose} mg × {freq} ครั้ง/วัน",
+        "special_fixed_by_age": "💊 ขนาดยา: {dose} mg × {freq} ครั้ง/วัน",
+
+        "warfarin_band": "{icon} INR {label} → {action}",
+        "warfarin_bleeding": "{icon} มี {label} → {action}",
+        "warfarin_new_dose": "\nขนาดยาใหม่: {twd_min:.1f} mg/สัปดาห์",
+        "warfarin_new_dose_range": "\nขนาดยาใหม่: {twd_min:.1f} – {twd_max:.1f} mg/สัปดาห์",
+        "warfarin_schedule": "💊 ตัวอย่างการจัดยา {total_mg:g} mg/สัปดาห์:",
+        "warfarin_schedule_approx": "💊 ตัวอย่างการจัดยาใกล้เคียง {total_mg:g} mg/สัปดาห์ (เม็ดยาที่มีจัดให้ตรงขนาดใหม่ไม่ได้ ต่าง {miss:g} mg):",
+        "warfarin_schedule_after_hold": "⏸️ หยุดยา {days} วันก่อน แล้วจึงเริ่มตารางนี้",
+        "warfarin_schedule_skipped": "ℹ️ ไม่มีตัวอย่างการจัดยา: เม็ดยาที่มีจัดให้ใกล้ขนาดใหม่ไม่ได้",
+        "warfarin_schedule_days": "• {days} วันละ {mg:g} mg = {tablets}",
+        "warfarin_tablet": "{mg:g} mg{colour} × {count} เม็ด",
+        "warfarin_tablet_colour": " ({colour})",
+    },
+    "en": {
+        "no_drug": "❌ No data for {drug}",
+        "no_indication": "❌ Indication {indication} not found for {drug}",
+        "no_special_indication": "❌ Indication {indication} not found",
+        "no_age_group": "❌ No dosing group for age {age} years",
+
+        "dose_header": "{drug} - {indication} (weight {weight} kg):",
+        "prefix_single": "Dose: ",
+        "prefix_phase": "📆 {day_range}: ",
+        "prefix_alternative": "📌 {title}: ",
+        "heading_phase": "\n🔹 {title}",
+        "note_single": "\n📝 Note: {note}",
+        "note": "📝 Note: {note}",
+        "dose_range": (
+            "{prefix}{dose_min} – {dose_max} mg/kg/day → {mg_day_min:.0f} – {mg_day_max:.0f} mg/day ≈ "
+            "{ml_day_min:.1f} – {ml_day_max:.1f} ml/day, divided {min_freq} – {max_freq} times daily × {days} days "
+            "(~{ml_dose_a:.1f} – {ml_dose_b:.1f} ml per dose)"
+        ),
+        "dose_fixed_freq": (
+            "{prefix}{dose} mg/kg/day → {mg_day:.0f} mg/day ≈ {ml_day:.1f} ml/day, "
+            "~{ml_dose:.1f} ml per dose × {freq} times daily × {days} days"
+        ),
+        "dose_freq_range": (
+            "{prefix}{dose} mg/kg/day → {mg_day:.0f} mg/day ≈ {ml_day:.1f} ml/day, "
+            "divided {min_freq} – {max_freq} times daily × {days} days (~{ml_dose_a:.1f} – {ml_dose_b:.1f} ml per dose)"
+        ),
+        "dose_by_weight_band": (
+            "{prefix}{dose_mg} mg/dose (weight {lo}–{hi} kg) → {mg_day:.0f} mg/day ≈ {ml_day:.1f} ml/day, "
+            "~{ml_dose:.1f} ml per dose × {freq} times daily × {days} days"
+        ),
+        "dose_no_weight_band": "{prefix}no dose for weight {weight} kg (from {min_weight} kg up)",
+        "bottles": "Total {ml_total:.1f} ml → dispense {bottles} bottle(s) ({bottle_size} ml)",
+        "course_total": "\nCourse total {ml_total:.1f} ml → dispense {bottles} bottle(s) ({bottle_size} ml)",
+
+        "special_header_age_weight": "{drug} (age {age} years, weight {weight} kg):",
+        "special_header_group": "{drug} - {indication} ({group}):",
+        "special_header_age": "{drug} - {indication} (age {age} years):",
+        "special_header_weight": "{drug} - {indication} (weight {weight} kg):",
+        "special_per_kg_day_by_age": (
+            "Dose: {dose_per_kg} mg/kg/day → {mg_day:.1f} mg/day\n"
+            "Divided {freq} times daily → ~{dose:.1f} mg per dose for {days} days"
+        ),
+        "special_per_kg_day_by_weight": "💊 {mg_day:.1f} mg/day → {freq} times daily → ~{dose:.1f} mg per dose",
+        "special_fixed_by_weight": "💊 {dose:.1f} mg × {freq} times daily",
+        "special_iron": "💊 {dose_per_kg} mg/kg/day → {mg_day:.1f} mg/day",
+        "special_iron_freq": "→ {freq} times daily → ~{dose:.1f} mg per dose",
+        "special_iron_note": "\n📌 Note: {note}",
+        "special_per_kg_dose": "💊 {dose_per_kg} mg/kg/dose → ~{dose:.1f} mg per dose",
+        "special_per_kg_dose_freq": " × {freq} times daily",
+        "special_initial": "💊 Start {dose} mg × {freq} times daily",
+        "special_option": "or: {dose} mg × {freq} times daily",
+        "special_fixed_by_age": "💊 Dose: {dose} mg × {freq} times daily",
+
+        "warfarin_band": "{icon} INR {label} → {action}",
+        "warfarin_bleeding": "{icon} {label} → {action}",
+        "warfarin_new_dose": "\nNew dose: {twd_min:.1f} mg/week",
+        "warfarin_new_dose_range": "\nNew dose: {twd_min:.1f} – {twd_max:.1f} mg/week",
+        "warfarin_schedule": "💊 Example schedule for {total_mg:g} mg/week:",
+        "warfarin_schedule_approx": "💊 Approximate schedule for {total_mg:g} mg/week (available tablets cannot match the new dose, off by {miss:g} mg):",
+        "warfarin_schedule_after_hold": "⏸️ Hold for {days} day(s) first, then start this schedule",
+        "warfarin_schedule_skipped": "ℹ️ No example schedule: the available tablets cannot get close to the new dose",
+        "warfarin_schedule_days": "• {days}: {mg:g} mg daily = {tablets}",
+        "warfarin_tablet": "{mg:g} mg{colour} × {count} tab",
+        "warfarin_tablet_colour": " ({colour})",
+    },
+}
+
+# ข้อความที่ไม่ใช่ template: คำแนะนำตามช่วง INR (key = ชื่อช่วง), ชื่อวัน, สีเม็ดยา, จำนวนเม็ดแบบครึ่งเม็ด
+# ภาษาที่ไม่มีคำแนะนำของช่วงใดใช้ข้อความใน WARFARIN_BANDS
+REPLY_WORDS = {
+    "th": {
+        "warfarin_actions": {},
+        "weekdays": WEEKDAYS,
+        "tablet_colours": WARFARIN_TABLET_COLOURS,
+        "half_tablets": {1: "½", 3: "1½"},
+    },
+    "en": {
+        "warfarin_actions": {
+            "< 1.5": "increase dose by 10–20%",
+            "1.5–1.9": "increase dose by 5–10%",
+            "2.0–3.0": "keep the current dose",
+            "3.1–3.9": "reduce dose by 5–10%",
+            "4.0–4.9": "hold 1 day, then reduce dose by 10%",
+            "≥ 5.0": "hold warfarin and consider vitamin K",
+            "major bleeding": "stop warfarin, give vitamin K1",
+        },
+        "weekdays": ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"),
+        "tablet_colours": {2.0: "orange", 3.0: "blue", 5.0: "pink"},
+        "half_tablets": {1: "½", 3: "1½"},
+    },
+}
+
+
+# format spec ของ str.format ที่เขียนเป็น printf ได้ตรงกัน ("" = str(), ".1f", "g", ...)
+_PRINTF_SPEC = re.compile(r"(?:\.\d+)?[fgde]?")
+
+
+def compile_template(template):
+    """
+    แปลง template แบบ str.format ครั้งเดียวเป็น printf-style mapping ("{mg:.1f}" → "%(mg).1f")
+    แล้วคืนฟังก์ชันที่รับค่าเป็น keyword (str.format ต้อง parse template ใหม่ทุกครั้ง, % ทำใน C ทั้งหมด)
+    keyword ที่ template ไม่ใช้ถูกทิ้งไป field แบบอื่น ({x[key]}, {x!r}, {x:>8}) ใช้ format_map ตามเดิม
+    """
+    printf = []
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        printf.append(literal.replace("%", "%%"))
+        if field is None:
+            continue
+        if conversion or not field.isidentifier() or not _PRINTF_SPEC.fullmatch(spec):
+            return lambda **values: template.format_map(values)
+        printf.append(f"%({field}){spec or 's'}")
+    printf = "".join(printf)
+    return lambda **values: printf % values
+
+
+class ReplyTemplates:
+    """template ของ 1 ภาษาที่ compile แล้ว: templates.dose_range(...) คืนข้อความนั้น"""
+
+    def __init__(self, locale, templates, words):
+        self.locale = locale
+        for name, template in templates.items():
+            setattr(self, name, compile_template(template))
+        for name, value in words.items():
+            setattr(self, name, value)
+
+
+COMPILED_TEMPLATES = {
+    locale: ReplyTemplates(locale, templates, REPLY_WORDS[locale]) for locale, templates in REPLY_TEMPLATES.items()
+}
+
+
+def render_reply(result, locale=REPLY_LOCALE):
+    """ข้อความตอบกลับของผลคำนวณ สร้างครั้งแรกที่ขอแล้วเก็บใน result.rendered"""
+    text = result.rendered.get(locale)
+    if text is None:
+        text = RENDERERS[type(result)](result, COMPILED_TEMPLATES[locale])
+        result.rendered[locale] = text
+    return text
+
+
+def reply_result(event, result, locale=REPLY_LOCALE):
+    with stage_timer("build_messages"):
+        message = json.dumps({"type": "text", "text": render_reply(result, locale)}, ensure_ascii=False)
+    outbound.add(event.reply_token, [message])
+
+
+def render_no_dose(result, t):
+    return getattr(t, f"no_{result.reason}")(drug=result.drug, indication=result.indication, age=result.age)
+
+
+def _dose_prefix(rule, layout, t):
+    if layout == LAYOUT_SINGLE:
+        return t.prefix_single()
+    if layout == LAYOUT_PHASES:
+        return t.prefix_phase(day_range=rule.day_range)
+    return t.prefix_alternative(title=rule.title or f"{rule.indication} #{rule.index + 1}")
+
+
+def render_dose(result, t):
+    lines = [t.dose_header(drug=result.drug, indication=result.indication, weight=result.weight)]
+    layout = result.layout
+    for line in result.lines:
+        rule = line.rule
+        prefix = _dose_prefix(rule, layout, t)
+        if layout == LAYOUT_PHASES and rule.title:
+            lines.append(t.heading_phase(title=rule.title))
+
+        if rule.fixed_doses:
+            if line.band is None:
+                lines.append(t.dose_no_weight_band(prefix=prefix, weight=result.weight, min_weight=rule.fixed_doses[0][0]))
+            else:
+                lo, hi, dose_mg = line.band
+                lines.append(t.dose_by_weight_band(
+                    prefix=prefix, dose_mg=dose_mg, lo=lo, hi=hi, mg_day=line.mg_day_max, ml_day=line.ml_day_max,
+                    ml_dose=line.ml_dose_at_max_freq, freq=rule.max_freq, days=rule.days_text,
+                ))
+        elif rule.is_range:
+            lines.append(t.dose_range(
+                prefix=prefix, dose_min=rule.dose_min, dose_max=rule.dose_max,
+                mg_day_min=line.mg_day_min, mg_day_max=line.mg_day_max, ml_day_min=line.ml_day_min, ml_day_max=line.ml_day_max,
+                min_freq=rule.min_freq, max_freq=rule.max_freq, days=rule.days_text,
+                ml_dose_a=line.ml_dose_at_max_freq, ml_dose_b=line.ml_dose_at_min_freq,
+            ))
+        elif rule.min_freq == rule.max_freq:
+            lines.append(t.dose_fixed_freq(
+                prefix=prefix, dose=rule.dose_max, mg_day=line.mg_day_max, ml_day=line.ml_day_max,
+                ml_dose=line.ml_dose_at_max_freq, freq=rule.max_freq, days=rule.days_text,
+            ))
+        else:
+            lines.append(t.dose_freq_range(
+                prefix=prefix, dose=rule.dose_max, mg_day=line.mg_day_max, ml_day=line.ml_day_max,
+                min_freq=rule.min_freq, max_freq=rule.max_freq, days=rule.days_text,
+                ml_dose_a=line.ml_dose_at_max_freq, ml_dose_b=line.ml_dose_at_min_freq,
+            ))
+
+        if line.bottles is not None:
+            lines.append(t.bottles(ml_total=line.ml_total, bottles=line.bottles, bottle_size=rule.bottle_size))
+        if rule.note:
+            lines.append(t.note_single(note=rule.note) if layout == LAYOUT_SINGLE else t.note(note=rule.note))
+
+    if result.bottles is not None:
+        lines.append(t.course_total(ml_total=result.total_ml, bottles=result.bottles, bottle_size=result.bottle_size))
+    return "\n".join(lines)
+
+
+def render_special(result, t):
+    rule = result.rule
+    kind = rule.kind
+    if kind == SPECIAL_PER_KG_DAY_BY_AGE:
+        header = t.special_header_age_weight(drug=rule.drug, age=result.age, weight=result.weight)
+    elif kind in (SPECIAL_PER_KG_DAY_BY_WEIGHT, SPECIAL_FIXED_BY_WEIGHT):
+        header = t.special_header_group(drug=rule.drug, indication=rule.indication, group=rule.group)
+    elif kind == SPECIAL_FIXED_BY_AGE:
+        header = t.special_header_age(drug=rule.drug, indication=rule.indication, age=result.age)
+    else:
+        header = t.special_header_weight(drug=rule.drug, indication=rule.indication, weight=result.weight)
+    # ส่วนตัวยาใช้ร่วมกันทุกอายุในกลุ่ม จึงเก็บข้อความไว้ใน SpecialDose
+    return header + "\n" + render_reply(result.dose, t.locale)
+
+
+def render_special_dose(dose, t):
+    rule = dose.rule
+    kind = rule.kind
+    if kind == SPECIAL_PER_KG_DAY_BY_AGE:
+        dose_mg, freq = dose.doses[0]
+        return t.special_per_kg_day_by_age(dose_per_kg=rule.dose_per_kg, mg_day=dose.mg_day, freq=freq, dose=dose_mg, days=rule.days)
+
+    if kind == SPECIAL_PER_KG_DAY_BY_WEIGHT:
+        return "\n".join(t.special_per_kg_day_by_weight(mg_day=dose.mg_day, freq=freq, dose=dose_mg) for dose_mg, freq in dose.doses)
+
+    if kind == SPECIAL_FIXED_BY_WEIGHT:
+        return "\n".join(t.special_fixed_by_weight(dose=dose_mg, freq=freq) for dose_mg, freq in dose.doses)
+
+    if kind == SPECIAL_IRON:
+        lines = [t.special_iron(dose_per_kg=rule.dose_per_kg, mg_day=dose.mg_day)]
+        lines.extend(t.special_iron_freq(freq=freq, dose=dose_mg) for dose_mg, freq in dose.doses)
+        if rule.note:
+            lines.append(t.special_iron_note(note=rule.note))
+        return "\n".join(lines)
+
+    if kind == SPECIAL_PER_KG_DOSE:
+        dose_mg, freq = dose.doses[0]
+        line = t.special_per_kg_dose(dose_per_kg=rule.dose_per_kg, dose=dose_mg)
+        if freq:
+            line += t.special_per_kg_dose_freq(freq=freq)
+        return line
+
+    # SPECIAL_FIXED_BY_AGE
+    if rule.initial_dose_mg is not None:
+        (dose_mg, freq), options = dose.doses[0], dose.doses[1:]
+        lines = [t.special_initial(dose=dose_mg, freq=freq)]
+        lines.extend(t.special_option(dose=dose_mg, freq=freq) for dose_mg, freq in options)
+        return "\n".join(lines)
+    return "\n".join(t.special_fixed_by_age(dose=dose_mg, freq=freq) for dose_mg, freq in dose.doses)
+
+
+def render_warfarin(adjustment, t):
+    action = t.warfarin_actions.get(adjustment.label, adjustment.action)
+    if adjustment.label == WARFARIN_BLEEDING[1]:
+        text = t.warfarin_bleeding(icon=adjustment.icon, label=adjustment.label, action=action)
+    else:
+        text = t.warfarin_band(icon=adjustment.icon, label=adjustment.label, action=action)
+    if adjustment.pct_min:
+        if adjustment.twd_min == adjustment.twd_max:
+            text += t.warfarin_new_dose(twd_min=adjustment.twd_min)
+        else:
+            text += t.warfarin_new_dose_range(twd_min=adjustment.twd_min, twd_max=adjustment.twd_max)
+    if adjustment.schedule is not None:
+        text += "\n\n"
+        if adjustment.hold_days:
+            text += t.warfarin_schedule_after_hold(days=adjustment.hold_days) + "\n"
+        text += render_reply(adjustment.schedule, t.locale)
+    elif adjustment.schedule_skipped:
+        text += "\n\n" + t.warfarin_schedule_skipped()
+    return text
+
+
+def render_warfarin_schedule(schedule, t):
+    if schedule.miss:
+        lines = [t.warfarin_schedule_approx(total_mg=schedule.total_mg, miss=schedule.miss)]
+    else:
+        lines = [t.warfarin_schedule(total_mg=schedule.total_mg)]
+    weekdays = t.weekdays
+    groups = [(schedule.low_mg, schedule.low_tablets, [d for i, d in enumerate(weekdays) if i not in schedule.high_days])]
+    if schedule.high_days:
+        groups.append((schedule.high_mg, schedule.high_tablets, [weekdays[i] for i in schedule.high_days]))
+    for mg, tablets, days in groups:
+        if days:
+            lines.append(t.warfarin_schedule_days(days=" ".join(days), mg=mg, tablets=format_tablets(tablets, t)))
+    return "\n".join(lines)
+
+
+def format_tablets(tablets, t):
+    parts = []
+    for mg, halves in tablets:
+        count = t.half_tablets.get(halves, f"{halves // 2}")
+        colour = t.tablet_colours.get(mg)
+        parts.append(t.warfarin_tablet(mg=mg, colour=t.warfarin_tablet_colour(colour=colour) if colour else "", count=count))
+    return " + ".join(parts)
+
+
+RENDERERS = {
+    NoDoseResult: render_no_dose,
+    DoseResult: render_dose,
+    SpecialResult: render_special,
+    SpecialDose: render_special_dose,
+    WarfarinAdjustment: render_warfarin,
+    WarfarinSchedule: render_warfarin_schedule,
+}
+
+
+def send_special_indication_carousel(event, drug_name):
+    drug_info = SPECIAL_DRUGS.get(drug_name)
+    if not drug_info or "indications" not in drug_info:
+        reply_text(event, f"ไม่พบข้อบ่งใช้ของ {drug_name}")
+        return
+
+    outbound.add(event.reply_token, get_picker_payload(
+        ("special_indications", drug_name),
+        lambda: build_special_indication_messages(drug_name, drug_info)
+    ))
+
+
+def build_special_indication_messages(drug_name, drug_info):
+    from linebot.v3.messaging import CarouselColumn, CarouselTemplate, TemplateMessage
     indications = drug_info["indications"]
     common = drug_info.get("common_indications", [])
 
@@ -1033,24 +2203,16 @@ def send_special_indication_carousel(event, drug_name):
         columns.append(CarouselColumn(
             title=title,
             text=f"{dose} mg",
-            actions=[MessageAction(label="เลือก", text=f"Indication: {name}")]
+            actions=[picker_action("เลือก", f"Indication: {name}", drug_name, name)]
         ))
 
 
     carousel_template = CarouselTemplate(columns=columns)
-    messages = [TemplateMessage(
+    return [TemplateMessage(
         alt_text=f"ข้อบ่งใช้ {drug_name}",
         template=carousel_template
     )]
 
-    messaging_api.reply_message(
-        ReplyMessageRequest(
-            reply_token=event.reply_token,
-            messages=messages
-        )
-    )
-    return
-
 def get_indication_title(indication_dict):
     """
     คืนค่าชื่อย่อยของ indication จาก key ที่เหมาะสม เช่น label, sub_indication, title, name
@@ -1060,33 +2222,23 @@ def get_indication_title(indication_dict):
             return indication_dict[key]
     return None
 
-def create_quick_reply_items(drug, drug_info):
+def create_quick_reply_items(drug, drug_info, indication=None):
+    """
+    ปุ่ม quick reply เลือก regimen (ลำดับ entry) ของแต่ละข้อบ่งใช้ แบบ postback ที่มี token ของขั้นถัดไป
+    indication ไม่เป็น None = เฉพาะ regimen ของข้อบ่งใช้นั้น
+    """
     items = []
+    names = [indication] if indication is not None else list(drug_info["indications"])
 
-    for indication_name, entry in drug_info["indications"].items():
+    for indication_name in names:
+        entry = drug_info["indications"][indication_name]
         if isinstance(entry, list):
             for idx, sub in enumerate(entry):
                 title = get_indication_title(sub) or f"{indication_name} #{idx+1}"
-                label = title[:20]  # LINE จำกัด label ไม่เกิน 20 ตัวอักษร
-                items.append(
-                    QuickReplyButton(
-                        action=PostbackAction(
-                            label=label,
-                            data=f"{drug}|{indication_name}|{idx}"
-                        )
-                    )
-                )
+                items.append(flow_quick_reply(title, f"สูตร: {title}", drug, indication_name, idx))
         else:
-            label = indication_name[:20]
-            items.append(
-                QuickReplyButton(
-                    action=PostbackAction(
-                        label=label,
-                        data=f"{drug}|{indication_name}|0"
-                    )
-                )
-            )
-    return items
+            items.append(flow_quick_reply(indication_name, f"Indication: {indication_name}", drug, indication_name))
+    return items[:FLOW_QUICK_REPLY_MAX_ITEMS]
 
 
 def get_indication_entry(drug, indication_name, entry_index=0):
@@ -1095,252 +2247,1500 @@ def get_indication_entry(drug, indication_name, entry_index=0):
         return entries[int(entry_index)]
     return entries
 
-@handler.add(MessageEvent)
-def handle_message(event: MessageEvent):
-    if not isinstance(event.message, TextMessageContent):
-        return
-    user_id = event.source.user_id
-    text = event.message.text.strip()
-    text_lower = text.lower()
-
-    if text_lower in ['คำนวณยา warfarin']:
-        user_sessions.pop(user_id, None)
-        user_drug_selection.pop(user_id, None)
-        user_sessions[user_id] = {"flow": "warfarin", "step": "ask_inr"}
-        messaging_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text="🧪 กรุณาใส่ค่า INR (เช่น 2.5)")]
-            )
+# ---------------------------------------------------------------------------
+# flow แบบ postback (PEDIATRIC_FLOW=postback): สถานะของแต่ละขั้น (ยา, ข้อบ่งใช้, ลำดับ entry, อายุ)
+# อยู่ใน token ที่เซ็นด้วย HMAC ใน postback data / fillInText แทน session store
+# worker ไหน node ไหนก็ตอบขั้นถัดไปได้เอง ขอแค่ตั้ง FLOW_TOKEN_SECRET (หรือ channel secret) ตรงกัน
+#
+#   เลือกยา        postback token(drug)               → carousel ข้อบ่งใช้
+#   เลือกข้อบ่งใช้  postback token(drug, indication)   → เปิดคีย์บอร์ดพร้อมข้อความ "... #token\nน้ำหนัก "
+#   พิมพ์น้ำหนัก    ข้อความที่มี #token                 → คำนวณ (ถ้าพิมพ์แค่อายุ ตอบปุ่มที่มี token พร้อมอายุ)
+# ---------------------------------------------------------------------------
+
+PEDIATRIC_FLOW = os.environ.get("PEDIATRIC_FLOW", "session")  # session หรือ postback
+FLOW_TOKEN_SECRET = os.environ.get("FLOW_TOKEN_SECRET") or LINE_CHANNEL_SECRET
+FLOW_TOKEN_KEY = hashlib.sha256(b"pediatric-flow\0" + FLOW_TOKEN_SECRET.encode("utf-8")).digest()
+FLOW_TOKEN_VERSION = "s1"
+FLOW_TOKEN_SIGNATURE_BYTES = 12
+FLOW_TOKEN_PATTERN = r"s1\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+"
+LINE_ACTION_MAX_CHARS = 300      # LINE จำกัด postback data และ fillInText ไม่เกิน 300 ตัวอักษร
+FLOW_QUICK_REPLY_MAX_ITEMS = 13  # LINE รับ quick reply ได้ไม่เกิน 13 ปุ่ม
+FLOW_EXPIRED_TEXT = "⌛ ปุ่มนี้ใช้ไม่ได้แล้ว (ตารางยาอาจเปลี่ยน) พิมพ์ 'คำนวณยาเด็ก' เพื่อเริ่มใหม่"
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def encode_flow_token(drug, indication=None, entry=None, age=None):
+    """token สั้นๆ "s1.<payload>.<signature>" payload เป็น JSON list ตัดค่า None ท้ายออก"""
+    state = [drug, indication, entry, age]
+    while state[-1] is None:
+        state.pop()
+    payload = _b64encode(json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    signature = hmac.new(FLOW_TOKEN_KEY, f"{FLOW_TOKEN_VERSION}.{payload}".encode("ascii"), hashlib.sha256)
+    token = f"{FLOW_TOKEN_VERSION}.{payload}.{_b64encode(signature.digest()[:FLOW_TOKEN_SIGNATURE_BYTES])}"
+    if len(token) > LINE_ACTION_MAX_CHARS:
+        raise ValueError(f"token ของ {drug} / {indication} ยาวเกิน {LINE_ACTION_MAX_CHARS} ตัวอักษร")
+    return token
+
+
+def decode_flow_token(token):
+    """
+    คืนค่า (drug, indication, entry, age) หรือ None ถ้า signature ไม่ถูก หรือค่าไม่ตรงกับตารางยาปัจจุบัน
+    (token อาจสร้างก่อน reload ตารางยา จึงตรวจซ้ำทุกครั้ง)
+    """
+    try:
+        version, payload, signature = token.split(".")
+        expected = hmac.new(FLOW_TOKEN_KEY, f"{version}.{payload}".encode("ascii"), hashlib.sha256)
+        if version != FLOW_TOKEN_VERSION or not hmac.compare_digest(
+                _b64decode(signature), expected.digest()[:FLOW_TOKEN_SIGNATURE_BYTES]):
+            return None
+        state = json.loads(_b64decode(payload))
+        drug, indication, entry, age = state + [None] * (4 - len(state))
+    except (ValueError, TypeError, UnicodeError):
+        return None
+
+    if drug in DRUG_DATABASE:
+        compiled = INDICATION_RULES.get((drug, indication))
+        if indication is not None and compiled is None:
+            return None
+        if entry is not None and (compiled[0] != LAYOUT_ALTERNATIVES or not 0 <= entry < len(compiled[1])):
+            return None
+    elif drug in SPECIAL_DRUGS:
+        if indication is not None and (drug, indication) not in SPECIAL_RULES:
+            return None
+        if age is not None and not 0 <= age <= 18:
+            return None
+    else:
+        return None
+    return drug, indication, entry, age
+
+
+def flow_fill_in_text(drug, indication, token, age=None):
+    """ข้อความที่เติมไว้ในช่องพิมพ์ ผู้ใช้พิมพ์ค่าต่อท้ายแล้วส่ง (ส่วนก่อน token ตัดได้ถ้ายาวเกิน)"""
+    prompt = "อายุ " if drug in SPECIAL_DRUGS and age is None else "น้ำหนัก "
+    label = f"{drug} · {indication}"[:max(0, LINE_ACTION_MAX_CHARS - len(token) - len(prompt) - 3)]
+    return f"{label} #{token}\n{prompt}"
+
+
+def flow_action(label, display_text, drug, indication=None, entry=None, age=None):
+    """postback action (JSON ของ LINE) ถ้ามีข้อบ่งใช้แล้ว กดแล้วเปิดคีย์บอร์ดพร้อมข้อความที่มี token"""
+    token = encode_flow_token(drug, indication, entry, age)
+    action = {"type": "postback", "label": label[:20], "data": token, "displayText": display_text[:LINE_ACTION_MAX_CHARS]}
+    if indication is not None:
+        action["inputOption"] = "openKeyboard"
+        action["fillInText"] = flow_fill_in_text(drug, indication, token, age)
+    return action
+
+
+def flow_quick_reply(label, display_text, drug, indication=None, entry=None, age=None):
+    return {"type": "action", "action": flow_action(label, display_text, drug, indication, entry, age)}
+
+
+def picker_action(label, text, drug, indication=None):
+    """ปุ่มใน carousel: โหมด session ส่งข้อความ text, โหมด postback ส่ง token (text แสดงในแชทแทน)"""
+    if PEDIATRIC_FLOW == "postback":
+        from linebot.v3.messaging import PostbackAction
+        return PostbackAction.from_dict(flow_action(label, text, drug, indication))
+    from linebot.v3.messaging import MessageAction
+    return MessageAction(label=label, text=text)
+
+
+def reply_flow_prompt(event, text, quick_reply_items):
+    with stage_timer("build_messages"):
+        message = json.dumps(
+            {"type": "text", "text": text, "quickReply": {"items": quick_reply_items}},
+            ensure_ascii=False, separators=(",", ":"),
         )
-        return
+    outbound.add(event.reply_token, [message])
+
 
-    elif text_lower in ['คำนวณขนาดยาเด็ก', 'คำนวณยาเด็ก']:
-        user_sessions.pop(user_id, None)
-        user_drug_selection.pop(user_id, None)
-        user_ages.pop(user_id, None)
-        send_drug_selection(event)
+def prompt_flow_input(event, drug, indication, entry=None, age=None):
+    """ตอบขั้นที่ต้องพิมพ์ค่า พร้อมปุ่มเปิดคีย์บอร์ด (token เดิม) เผื่อผู้ใช้ปิดคีย์บอร์ดไปแล้ว"""
+    if drug in SPECIAL_DRUGS and age is None:
+        example_age = round(random.uniform(1, 18), 1)
+        text = f"📆 พิมพ์อายุและน้ำหนักต่อท้ายข้อความที่เตรียมไว้ เช่น {example_age} ปี 18 กก แล้วกดส่ง"
+        items = [flow_quick_reply("⌨️ พิมพ์อายุ", f"Indication: {indication}", drug, indication)]
+        reply_flow_prompt(event, text, items)
         return
-    
-    # ดำเนิน Warfarin flow
-    if user_id in user_sessions:
-        session = user_sessions[user_id]
-        if session.get("flow") == "warfarin":
-            step = session.get("step")
-            if step == "ask_inr":
+
+    example_weight = round(random.uniform(5.0, 20.0), 1)
+    if age is not None:
+        chosen = f"อายุ {age:.2f} ปีแล้ว"
+    elif entry is not None:
+        chosen = f"เลือกสูตร {get_indication_title(get_indication_entry(drug, indication, entry)) or entry + 1} แล้ว"
+    else:
+        chosen = f"เลือกข้อบ่งใช้ {indication} แล้ว"
+    text = f"{chosen} พิมพ์น้ำหนัก (kg) ต่อท้ายข้อความที่เตรียมไว้ เช่น {example_weight} แล้วกดส่ง"
+    items = [flow_quick_reply("⌨️ พิมพ์น้ำหนัก", f"Indication: {indication}", drug, indication, entry, age)]
+    compiled = INDICATION_RULES.get((drug, indication))
+    if entry is None and compiled is not None and compiled[0] == LAYOUT_ALTERNATIVES and len(compiled[1]) > 1:
+        text += "\nหรือเลือกสูตรยาด้านล่าง (ไม่เลือก = แสดงทุกสูตร)"
+        items += create_quick_reply_items(drug, DRUG_DATABASE[drug], indication)[:FLOW_QUICK_REPLY_MAX_ITEMS - 1]
+    reply_flow_prompt(event, text, items)
+
+
+# ---------------------------------------------------------------------------
+# ตารางกฎขนาดยาที่ compile ไว้ตอนเริ่มระบบ
+# แปลง DRUG_DATABASE / SPECIAL_DRUGS ที่มีหลายรูปแบบ (dict, list ของช่วงวัน, sub-indication)
+# ให้เป็น rule แบนๆ ครั้งเดียว เพื่อไม่ต้องตรวจรูปแบบข้อมูลซ้ำทุก request
+# ---------------------------------------------------------------------------
+
+LAYOUT_SINGLE = "single"              # indication เป็น dict ธรรมดา
+LAYOUT_PHASES = "phases"              # list ของช่วงวัน (day_range) ต้องให้ต่อเนื่องกันทุกช่วง
+LAYOUT_ALTERNATIVES = "alternatives"  # list ของ regimen ให้เลือกอย่างใดอย่างหนึ่ง
+
+
+class DoseRule:
+    """1 entry ของ DRUG_DATABASE (ที่ผ่าน normalize_dose_entry แล้ว)"""
+
+    __slots__ = (
+        "drug", "indication", "index", "title", "day_range",
+        "dose_min", "dose_max", "is_range", "fixed_doses", "freqs", "min_freq", "max_freq",
+        "days", "days_text", "max_mg_day", "max_mg_dose", "max_ml_per_dose", "conc", "bottle_size",
+        "note",
+    )
+
+    def __init__(self, drug, indication, index, entry, conc, bottle_size):
+        dose = entry["dose_mg_per_kg_per_day"]
+        self.drug = drug
+        self.indication = indication
+        self.index = index
+        self.title = entry["title"]
+        self.day_range = entry["day_range"]
+        self.is_range = isinstance(dose, list)
+        self.dose_min, self.dose_max = dose if self.is_range else (dose, dose)
+        # ขนาดยาคงที่ตามช่วงน้ำหนัก: ((min_weight, max_weight, dose_mg ต่อครั้ง), ...)
+        self.fixed_doses = tuple(
+            (band["min_weight"], band["max_weight"], band["dose_mg"]) for band in entry["fixed_dose_by_weight"] or ()
+        )
+        self.freqs = tuple(entry["frequency"])
+        self.min_freq = min(self.freqs)
+        self.max_freq = max(self.freqs)
+        self.days = entry["duration_days"]
+        days_range = entry["duration_days_range"]
+        self.days_text = f"{days_range[0]}–{days_range[1]}" if days_range else f"{self.days}"
+        self.max_mg_day = entry["max_mg_per_day"]
+        self.max_mg_dose = entry["max_mg_per_dose"]
+        if self.max_mg_dose:
+            # ขนาดสูงสุดต่อครั้งจำกัดขนาดต่อวันด้วย: mg/day, ml/day, ปริมาณรวม และจำนวนขวดต้องตรงกับที่ให้จริง
+            dose_cap = self.max_mg_dose * self.max_freq
+            self.max_mg_day = min(self.max_mg_day, dose_cap) if self.max_mg_day else dose_cap
+        self.conc = conc
+        self.bottle_size = bottle_size
+        self.max_ml_per_dose = self.max_mg_dose / conc if self.max_mg_dose else None
+        self.note = entry["note"]
+
+
+BASIS_AGE = "age"
+BASIS_WEIGHT = "weight"
+
+SPECIAL_PER_KG_DAY_BY_AGE = "per_kg_day_by_age"        # Paracetamol
+SPECIAL_PER_KG_DAY_BY_WEIGHT = "per_kg_day_by_weight"  # Hydroxyzine ≤40kg
+SPECIAL_FIXED_BY_WEIGHT = "fixed_by_weight"            # Hydroxyzine >40kg
+SPECIAL_FIXED_BY_AGE = "fixed_by_age"                  # Cetirizine, Hydroxyzine ตามอายุ
+SPECIAL_IRON = "iron"                                  # Ferrous drop
+SPECIAL_PER_KG_DOSE = "per_kg_dose"                    # mg/kg/ครั้ง เช่น Sedation
+
+# ช่วงอายุ (ปี) ของกลุ่มใน SPECIAL_DRUGS: lo <= อายุ < hi
+AGE_GROUP_YEARS = {
+    "6_to_11_months": (0.5, 1),
+    "12_to_23_months": (1, 2),
+    "6_to_23_months": (0.5, 2),
+    "2_to_5_years": (2, 6),
+    "under_6": (0, 6),
+    "6_to_11_years": (6, 12),
+    "above_5": (6, math.inf),
+    "above_or_equal_6": (6, math.inf),
+    "above_or_equal_12": (12, math.inf),
+    "all_ages": (0, math.inf),
+}
+
+# ช่วงน้ำหนัก (kg) ของกลุ่มใน SPECIAL_DRUGS: lo < น้ำหนัก <= hi
+WEIGHT_GROUP_KG = {
+    "≤40kg": (0, 40),
+    ">40kg": (40, math.inf),
+}
+
+
+class SpecialRule:
+    __slots__ = (
+        "drug", "indication", "group", "basis", "lo", "hi", "kind",
+        "dose_per_kg", "dose_range", "initial_dose_mg", "options", "frequency_options",
+        "freqs", "freq_text", "days", "max_mg_dose", "max_mg_day", "clamp_mg_day",
+        "note", "conc", "bottle_size", "uses_weight",
+    )
+
+    def __init__(self, drug, indication, group, entry, conc, bottle_size):
+        self.drug = drug
+        self.indication = indication
+        self.group = group
+        self.conc = conc
+        self.bottle_size = bottle_size
+
+        if group is None:
+            self.basis = BASIS_AGE
+            self.lo, self.hi = entry["min_age_years"], entry["max_age_years"]
+        elif group in WEIGHT_GROUP_KG:
+            self.basis = BASIS_WEIGHT
+            self.lo, self.hi = WEIGHT_GROUP_KG[group]
+        elif group in AGE_GROUP_YEARS:
+            self.basis = BASIS_AGE
+            self.lo, self.hi = AGE_GROUP_YEARS[group]
+        else:
+            raise FormularyError(f"{drug} / {indication}: ไม่รู้จักกลุ่ม {group}")
+
+        frequency = entry.get("frequency")
+        if frequency is None:
+            self.freqs = ()
+        else:
+            self.freqs = tuple(frequency) if isinstance(frequency, list) else (frequency,)
+        if len(self.freqs) > 1:
+            self.freq_text = f"{min(self.freqs)} – {max(self.freqs)}"
+        else:
+            self.freq_text = str(self.freqs[0]) if self.freqs else None
+        self.frequency_options = tuple(entry.get("frequency_options", ()))
+        self.days = entry.get("duration_days")
+        self.max_mg_dose = entry.get("max_mg_per_dose")
+        self.max_mg_day = entry.get("max_mg_per_day")
+        self.note = entry.get("note")
+        self.initial_dose_mg = entry.get("initial_dose_mg")
+        self.options = tuple((opt["dose_mg"], opt["frequency"]) for opt in entry.get("options", ()))
+        self.dose_per_kg = None
+        self.dose_range = ()
+        self.clamp_mg_day = None
+
+        if "initial_dose_mg_per_kg_per_day" in entry:
+            self.kind = SPECIAL_IRON
+            self.dose_per_kg = entry["initial_dose_mg_per_kg_per_day"]
+            self.clamp_mg_day = tuple(entry["max_dose_range_mg_per_day"])
+            self.max_mg_day = entry.get("absolute_max_mg_per_day")
+        elif "dose_mg_per_kg_per_day" in entry:
+            self.kind = SPECIAL_PER_KG_DAY_BY_WEIGHT if group is not None else SPECIAL_PER_KG_DAY_BY_AGE
+            self.dose_per_kg = entry["dose_mg_per_kg_per_day"]
+        elif "dose_mg_per_kg_per_dose" in entry or "dose_mg_per_kg" in entry:
+            self.kind = SPECIAL_PER_KG_DOSE
+            self.dose_per_kg = entry.get("dose_mg_per_kg_per_dose", entry.get("dose_mg_per_kg"))
+        else:
+            if "dose_mg" in entry:
+                self.dose_range = (entry["dose_mg"],)
+            elif "dose_mg_range" in entry:
+                self.dose_range = tuple(entry["dose_mg_range"])
+            elif "dose_range_mg" in entry:
+                self.dose_range = tuple(entry["dose_range_mg"])
+            elif self.initial_dose_mg is None:
+                raise KeyError("dose_mg")
+            self.kind = SPECIAL_FIXED_BY_WEIGHT if self.basis == BASIS_WEIGHT else SPECIAL_FIXED_BY_AGE
+
+        self.uses_weight = self.kind not in (SPECIAL_FIXED_BY_WEIGHT, SPECIAL_FIXED_BY_AGE)
+
+
+DOSE_RULES = {}        # (drug, indication, entry index) -> DoseRule
+INDICATION_RULES = {}  # (drug, indication) -> (layout, (DoseRule, ...))
+SPECIAL_RULES = {}     # (drug, indication) -> (SpecialRule, ...)
+
+
+def build_rule_index(drug_database, special_drugs):
+    dose_rules = {}
+    indication_rules = {}
+    special_rules = {}
+
+    for drug, drug_info in drug_database.items():
+        conc = drug_info["concentration_mg_per_ml"]
+        bottle_size = drug_info["bottle_size_ml"]
+        for indication, indication_info in drug_info["indications"].items():
+            # indication ผ่าน normalize_indication แล้ว: dict 1 entry หรือ list ของ entry
+            if indication_info == INDICATION_OTHERS:
+                continue  # ไม่ใช่ข้อมูลขนาดยา
+            if isinstance(indication_info, dict):
+                entries = [indication_info]
+                layout = LAYOUT_SINGLE
+            else:
+                entries = indication_info
+                layout = LAYOUT_PHASES if entries[0]["day_range"] is not None else LAYOUT_ALTERNATIVES
+
+            rules = []
+            for idx, entry in enumerate(entries):
+                rule = DoseRule(drug, indication, idx, entry, conc, bottle_size)
+                dose_rules[(drug, indication, idx)] = rule
+                rules.append(rule)
+            indication_rules[(drug, indication)] = (layout, tuple(rules))
+
+    for drug, drug_info in special_drugs.items():
+        conc = drug_info["concentration_mg_per_ml"]
+        bottle_size = drug_info["bottle_size_ml"]
+        for indication, indication_info in drug_info["indications"].items():
+            if isinstance(indication_info, list):
+                groups = [(None, entry) for entry in indication_info]
+            else:
+                groups = list(indication_info.items())
+            rules = []
+            for group, entry in groups:
                 try:
-                    session["inr"] = float(text)
-                    session["step"] = "ask_twd"
-                    reply = "📈 ใส่ Total Weekly Dose (TWD) เช่น 28"
-                except:
-                    reply = "❌ กรุณาใส่ค่า INR เป็นตัวเลข เช่น 2.5"
-                messaging_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply)]
-                    )
-                )
-                return
-            elif step == "ask_twd":
+                    rules.append(SpecialRule(drug, indication, group, entry, conc, bottle_size))
+                except KeyError as e:
+                    raise FormularyError(f"{drug} / {indication} / {group}: ไม่มี {e}") from None
+            special_rules[(drug, indication)] = tuple(rules)
+
+    return dose_rules, indication_rules, special_rules
+
+
+DRUG_DATABASE, SPECIAL_DRUGS = load_formulary(FORMULARY_PATH, FORMULARY_SNAPSHOT_PATH)
+DOSE_RULES, INDICATION_RULES, SPECIAL_RULES = build_rule_index(DRUG_DATABASE, SPECIAL_DRUGS)
+load_picker_snapshot()
+
+# ฟังก์ชันที่ต้องเรียกหลังเปลี่ยนตารางยา เช่น ล้าง cache
+TABLE_RELOAD_HOOKS = [clear_reply_cache, PICKER_CACHE.clear]
+
+
+def reload_drug_tables(drug_database, special_drugs):
+    """compile ตารางยาชุดใหม่ก่อน แล้วค่อยสลับทีเดียว (ถ้า compile ไม่ผ่านจะใช้ชุดเดิมต่อ)"""
+    global DRUG_DATABASE, SPECIAL_DRUGS, DOSE_RULES, INDICATION_RULES, SPECIAL_RULES, TABLES_VERSION
+    dose_rules, indication_rules, special_rules = build_rule_index(drug_database, special_drugs)
+    DRUG_DATABASE, SPECIAL_DRUGS = drug_database, special_drugs
+    DOSE_RULES, INDICATION_RULES, SPECIAL_RULES = dose_rules, indication_rules, special_rules
+    TABLES_VERSION += 1
+    for hook in TABLE_RELOAD_HOOKS:
+        hook()
+    logging.info(f"🔄 โหลดตารางยาใหม่แล้ว (version {TABLES_VERSION})")
+
+
+
+def calculate_dose_batch(weights, pairs=None):
+    """
+    คำนวณขนาดยาแบบ vectorized สำหรับหลายน้ำหนัก × หลาย (drug, indication) เช่นทำตารางขนาดยา
+    คืนค่า structured array 1 แถวต่อ (entry, น้ำหนัก) เรียงตาม pairs → entry → weights
+    bottles คิดจากทั้ง course (ช่วงวันต่อเนื่องรวมกัน, regimen ทางเลือกคิดแยก)
+    """
+    weights = np.asarray(weights, dtype=np.float64).ravel()
+    if pairs is None:
+        pairs = list(INDICATION_RULES)
+
+    rules = []
+    course_ids = []
+    n_courses = 0
+    for drug, indication in pairs:
+        compiled = INDICATION_RULES.get((drug, indication))
+        if compiled is None:
+            raise ValueError(f"ไม่พบ indication {indication} ใน {drug}")
+        layout, indication_rules = compiled
+        for rule in indication_rules:
+            if layout == LAYOUT_ALTERNATIVES or rule is indication_rules[0]:
+                n_courses += 1
+            course_ids.append(n_courses - 1)
+            rules.append(rule)
+
+    def column(attr, missing=np.inf):
+        return np.array([getattr(r, attr) or missing for r in rules], dtype=np.float64)[:, None]
+
+    dose_min = column("dose_min")
+    dose_max = column("dose_max")
+    max_mg_day = column("max_mg_day")
+    max_ml_dose = column("max_ml_per_dose")
+    conc = column("conc")
+    days = column("days")
+    min_freq = column("min_freq")
+    max_freq = column("max_freq")
+    bottle_size = column("bottle_size")
+
+    w = weights[None, :]
+    mg_day_min = np.minimum(w * dose_min, max_mg_day)
+    mg_day_max = np.minimum(w * dose_max, max_mg_day)
+    # ขนาดยาคงที่ตามช่วงน้ำหนัก: น้ำหนักที่ไม่อยู่ในช่วงใดได้ NaN (และ 0 ขวด)
+    for i, rule in enumerate(rules):
+        if rule.fixed_doses:
+            mg_dose = np.full(weights.size, np.nan)
+            for lo, hi, dose_mg in rule.fixed_doses:
+                mg_dose[(weights >= lo) & (weights <= hi)] = dose_mg
+            mg_day_min[i] = mg_day_max[i] = mg_dose * rule.max_freq
+    ml_day_min = mg_day_min / conc
+    ml_day_max = mg_day_max / conc
+    # ครั้งละเหมือน DoseLine: max_mg_day รวมขนาดสูงสุดต่อครั้งแล้ว, ยาขนาดคงที่ครั้งละเท่ากันทุกความถี่
+    ml_dose_at_max_freq = ml_day_max / max_freq
+    ml_dose_at_min_freq = np.minimum(ml_day_min / min_freq, max_ml_dose)
+    fixed = np.array([bool(r.fixed_doses) for r in rules])
+    ml_dose_at_min_freq[fixed] = ml_dose_at_max_freq[fixed]
+    total_ml = ml_day_max * days
+
+    course_ids = np.asarray(course_ids)
+    course_ml = np.zeros((n_courses, weights.size))
+    np.add.at(course_ml, course_ids, np.nan_to_num(total_ml))
+    course_ml = course_ml[course_ids]
+    bottles = np.where(np.isnan(total_ml), 0, np.ceil(course_ml / bottle_size))
+
+    name_len = max([len(r.drug) for r in rules] + [len(r.indication) for r in rules] + [1])
+    result = np.empty(len(rules) * weights.size, dtype=[
+        ("drug", f"U{name_len}"), ("indication", f"U{name_len}"), ("entry", np.int16),
+        ("weight", np.float64),
+        ("mg_day_min", np.float64), ("mg_day_max", np.float64),
+        ("ml_day_min", np.float64), ("ml_day_max", np.float64),
+        ("ml_dose_at_max_freq", np.float64), ("ml_dose_at_min_freq", np.float64),
+        ("total_ml", np.float64), ("course_ml", np.float64), ("bottles", np.int32),
+    ])
+    result["drug"] = np.repeat([r.drug for r in rules], weights.size)
+    result["indication"] = np.repeat([r.indication for r in rules], weights.size)
+    result["entry"] = np.repeat([r.index for r in rules], weights.size)
+    result["weight"] = np.tile(weights, len(rules))
+    result["mg_day_min"] = mg_day_min.ravel()
+    result["mg_day_max"] = mg_day_max.ravel()
+    result["ml_day_min"] = ml_day_min.ravel()
+    result["ml_day_max"] = ml_day_max.ravel()
+    result["ml_dose_at_max_freq"] = ml_dose_at_max_freq.ravel()
+    result["ml_dose_at_min_freq"] = ml_dose_at_min_freq.ravel()
+    result["total_ml"] = total_ml.ravel()
+    result["course_ml"] = course_ml.ravel()
+    result["bottles"] = bottles.ravel()
+    return result
+
+# ---------------------------------------------------------------------------
+# /api/dose: คำนวณขนาดยาเป็นชุดให้ระบบอื่น (เช่น EHR, worklist ตอน ward round) ด้วยตัวคำนวณเดียวกับ LINE
+#
+#   POST /api/dose?locale=th   Authorization: Bearer <DOSE_API_TOKENS ตัวใดตัวหนึ่ง>
+#   body: JSON array (Content-Type: application/json) หรือ NDJSON 1 แถวต่อบรรทัด
+#         {"id": "bed-12", "drug": "Amoxicillin", "indication": "...", "weight": 14.5, "age": 3, "entry": 0}
+#   ตอบ: NDJSON 1 บรรทัดต่อแถว เรียงตามลำดับที่ส่งมา {"id": ..., "ok": true, "result": {...}}
+#         locale = ใส่ข้อความแบบที่ตอบใน LINE ("text") มาด้วย ไม่ใส่ = ตัวเลขล้วน (ไม่เสียเวลาสร้างข้อความ)
+#
+# body อ่านทีละท่อนและตอบทีละชุด จึงไม่เก็บทั้ง batch ไว้ใน memory
+# ชุดละ DOSE_API_CHUNK_ROWS แถว: batch เล็ก (ชุดเดียว) คำนวณใน request, batch ใหญ่ส่งแต่ละชุดเข้า process pool
+# client ที่ส่ง body ใหญ่มากควรอ่านคำตอบไปพร้อมกับส่ง (server เริ่มตอบก่อนอ่าน body ครบ)
+# ---------------------------------------------------------------------------
+
+DOSE_API_TOKENS = tuple(token for token in os.environ.get("DOSE_API_TOKENS", "").split(",") if token)  # คั่นด้วย , (หมุน token ได้)
+# 0 = คำนวณใน request ทั้งหมด (ค่าเริ่มต้นบนเครื่อง 1 core: pool มีแต่ค่า pickle/IPC เพิ่ม)
+DOSE_API_WORKERS = int(os.environ.get("DOSE_API_WORKERS", multiprocessing.cpu_count() if multiprocessing.cpu_count() > 1 else 0))
+DOSE_API_CHUNK_ROWS = int(os.environ.get("DOSE_API_CHUNK_ROWS", 256))
+DOSE_API_MAX_ROWS = int(os.environ.get("DOSE_API_MAX_ROWS", 100000))
+DOSE_API_MAX_ROW_BYTES = 64 * 1024
+DOSE_API_READ_BYTES = 64 * 1024
+DOSE_API_MAX_WEIGHT_KG = 200
+
+_JSON_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r"\s*")
+_ARRAY_DELIMITERS = frozenset(" \t\r\n,]")
+
+
+class DoseApiBodyError(ValueError):
+    """body อ่านต่อไม่ได้ (JSON array ผิดรูปแบบ, แถวยาวเกิน, จำนวนแถวเกิน)"""
+
+
+class NdjsonRowReader:
+    """ตัดแถวจาก NDJSON ทีละท่อน แถวที่ parse ไม่ได้คืนเป็น ValueError (ตอบ error เฉพาะแถวนั้น)"""
+
+    def __init__(self):
+        self.buffer = b""
+
+    def _parse(self, line):
+        try:
+            return json.loads(line)
+        except ValueError as e:
+            return ValueError(f"JSON ไม่ถูกต้อง: {e}")
+
+    def feed(self, chunk):
+        *lines, self.buffer = (self.buffer + chunk).split(b"\n")
+        if len(self.buffer) > DOSE_API_MAX_ROW_BYTES:
+            raise DoseApiBodyError(f"แถวยาวเกิน {DOSE_API_MAX_ROW_BYTES} bytes")
+        return [self._parse(line) for line in lines if line.strip()]
+
+    def close(self):
+        rows = [self._parse(self.buffer)] if self.buffer.strip() else []
+        self.buffer = b""
+        return rows
+
+
+class JsonArrayRowReader:
+    """อ่าน JSON array ทีละ element โดยไม่ต้องรอ body ครบ (raw_decode จากตำแหน่งล่าสุดใน buffer)"""
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.state = "start"  # start → first → next → end
+
+    def feed(self, chunk, final=False):
+        self.buffer += self.decoder.decode(chunk, final)
+        buffer = self.buffer
+        pos = 0
+        rows = []
+        while True:
+            pos = _WHITESPACE.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            if self.state == "start":
+                if buffer[pos] != "[":
+                    raise DoseApiBodyError("body ต้องเป็น JSON array")
+                self.state = "first"
+                pos += 1
+                continue
+            if self.state == "end":
+                raise DoseApiBodyError("มีข้อมูลต่อท้าย JSON array")
+            if buffer[pos] == "]":
+                self.state = "end"
+                pos += 1
+                continue
+            start = pos
+            if self.state == "next":
+                if buffer[pos] != ",":
+                    raise DoseApiBodyError(f"JSON array ไม่ถูกต้องที่ตำแหน่ง {pos}")
+                pos = _WHITESPACE.match(buffer, pos + 1).end()
+            try:
+                row, end = _JSON_DECODER.raw_decode(buffer, pos)
+            except ValueError as e:
+                if final:
+                    raise DoseApiBodyError(f"JSON ไม่ถูกต้อง: {e}") from None
+                pos = start  # element ยังมาไม่ครบ รอท่อนถัดไป
+                break
+            if not final and (end == len(buffer) or buffer[end] not in _ARRAY_DELIMITERS):
+                pos = start  # ตัวเลขอาจยังมาไม่ครบ ("1" ของ "1.5") รอจนเห็นตัวคั่น
+                break
+            rows.append(row)
+            self.state = "next"
+            pos = end
+        self.buffer = buffer[pos:]
+        if len(self.buffer) > DOSE_API_MAX_ROW_BYTES:
+            raise DoseApiBodyError(f"แถวยาวเกิน {DOSE_API_MAX_ROW_BYTES} bytes")
+        return rows
+
+    def close(self):
+        rows = self.feed(b"", final=True)
+        if self.state != "end":
+            raise DoseApiBodyError("JSON array ไม่สมบูรณ์ (ไม่มี ])")
+        return rows
+
+
+def dose_api_authorized(authorization):
+    return any(hmac.compare_digest(authorization or "", f"Bearer {token}") for token in DOSE_API_TOKENS)
+
+
+def _round(value):
+    return None if value is None else round(value, 2)
+
+
+def dose_result_json(result):
+    return {
+        "type": "dose",
+        "drug": result.drug,
+        "indication": result.indication,
+        "weight": result.weight,
+        "layout": result.layout,
+        "entries": [
+            {
+                "entry": line.rule.index,
+                "title": line.rule.title,
+                "day_range": line.rule.day_range,
+                "dose_mg_per_kg_per_day": None if line.rule.fixed_doses else [line.rule.dose_min, line.rule.dose_max],
+                "weight_band": None if line.band is None else {"min_weight": line.band[0], "max_weight": line.band[1], "dose_mg": line.band[2]},
+                "frequency": [line.rule.min_freq, line.rule.max_freq],
+                "days": line.rule.days,
+                "mg_per_day": [_round(line.mg_day_min), _round(line.mg_day_max)],
+                "ml_per_day": [_round(line.ml_day_min), _round(line.ml_day_max)],
+                "ml_per_dose_at_max_frequency": _round(line.ml_dose_at_max_freq),
+                "ml_per_dose_at_min_frequency": _round(line.ml_dose_at_min_freq),
+                "ml_total": _round(line.ml_total),
+                "bottles": line.bottles,
+                "bottle_size": line.rule.bottle_size,
+                "note": line.rule.note,
+            }
+            for line in result.lines
+        ],
+        "total_ml": _round(result.total_ml),
+        "bottles": result.bottles,
+        "bottle_size": result.bottle_size,
+    }
+
+
+def special_result_json(result):
+    rule = result.rule
+    return {
+        "type": "special",
+        "drug": rule.drug,
+        "indication": rule.indication,
+        "group": rule.group,
+        "basis": rule.basis,
+        "age": result.age,
+        "weight": result.weight,
+        "mg_per_day": _round(result.dose.mg_day),
+        "doses": [{"mg": _round(mg), "frequency": freq} for mg, freq in result.dose.doses],
+        "days": rule.days,
+        "note": rule.note,
+    }
+
+
+def no_dose_result_json(result):
+    return {"type": "no_dose", "reason": result.reason, "drug": result.drug, "indication": result.indication, "age": result.age}
+
+
+def warfarin_result_json(result):
+    schedule = result.schedule
+    return {
+        "type": "warfarin",
+        "inr": result.inr,
+        "twd": result.twd,
+        "band": result.label,
+        "action": result.action,
+        "percent_change": None if result.pct_min is None else [result.pct_min, result.pct_max],
+        "twd_range": None if result.twd_min is None else [_round(result.twd_min), _round(result.twd_max)],
+        "hold_days": result.hold_days,
+        "schedule": None if schedule is None else {
+            "total_mg": schedule.total_mg,
+            "low_mg": schedule.low_mg,
+            "low_tablets": [{"mg": mg, "tablets": halves / 2} for mg, halves in schedule.low_tablets],
+            "high_mg": schedule.high_mg,
+            "high_tablets": [{"mg": mg, "tablets": halves / 2} for mg, halves in schedule.high_tablets],
+            "high_days": schedule.high_days,
+            "approximate": bool(schedule.miss),
+        },
+        "schedule_skipped": result.schedule_skipped,
+    }
+
+
+RESULT_SERIALIZERS = {
+    DoseResult: dose_result_json,
+    SpecialResult: special_result_json,
+    NoDoseResult: no_dose_result_json,
+    WarfarinAdjustment: warfarin_result_json,
+}
+
+
+def _row_problem(row):
+    """ข้อความบอกว่าแถวผิดตรงไหน หรือ None ถ้าใช้ได้"""
+    drug, indication, weight, age, entry = (row.get(key) for key in ("drug", "indication", "weight", "age", "entry"))
+    if not isinstance(drug, str) or not isinstance(indication, str):
+        return "ต้องมี drug และ indication เป็นข้อความ"
+    if not _is_positive(weight) or weight > DOSE_API_MAX_WEIGHT_KG:
+        return f"weight ต้องเป็นตัวเลข 0–{DOSE_API_MAX_WEIGHT_KG} kg"
+    if age is not None and not (isinstance(age, (int, float)) and not isinstance(age, bool) and 0 <= age <= 18):
+        return "age ต้องเป็นตัวเลข 0–18 ปี"
+    if drug in SPECIAL_DRUGS and age is None:
+        return f"{drug} ต้องระบุ age (ปี)"
+    if entry is not None:
+        compiled = INDICATION_RULES.get((drug, indication))
+        if (not isinstance(entry, int) or isinstance(entry, bool) or compiled is None
+                or compiled[0] != LAYOUT_ALTERNATIVES or not 0 <= entry < len(compiled[1])):
+            return "entry ใช้ได้เฉพาะข้อบ่งใช้ที่มีหลาย regimen และต้องอยู่ในช่วง"
+    return None
+
+
+def evaluate_dose_row(row, locale=None):
+    """1 แถวของ /api/dose → dict ผลลัพธ์ ผ่าน calculate_dose / calculate_special_drug เดียวกับ handle_message"""
+    if isinstance(row, ValueError):
+        return {"id": None, "ok": False, "error": "invalid_json", "message": str(row)}
+    if not isinstance(row, dict):
+        return {"id": None, "ok": False, "error": "invalid_row", "message": "แต่ละแถวต้องเป็น JSON object"}
+    row_id = row.get("id")
+    problem = _row_problem(row)
+    if problem is not None:
+        return {"id": row_id, "ok": False, "error": "invalid_row", "message": problem}
+
+    drug, indication = row["drug"], row["indication"]
+    if drug in SPECIAL_DRUGS:
+        result = calculate_special_drug(drug, indication, row["weight"], row["age"])
+    else:
+        result = calculate_dose(drug, indication, row["weight"], row.get("entry"))
+
+    if isinstance(result, NoDoseResult):
+        output = {"id": row_id, "ok": False, "error": result.reason, "message": render_reply(result, locale or REPLY_LOCALE)}
+    else:
+        output = {"id": row_id, "ok": True, "result": RESULT_SERIALIZERS[type(result)](result)}
+        if locale is not None:
+            output["text"] = render_reply(result, locale)
+    return output
+
+
+def evaluate_dose_rows(rows, locale=None):
+    """คำนวณ 1 ชุด (ใน request หรือใน process ของ pool) คืน (บรรทัด NDJSON ที่ต่อกันแล้ว, จำนวนแถวที่ ok)"""
+    lines = []
+    ok = 0
+    for row in rows:
+        output = evaluate_dose_row(row, locale)
+        ok += output["ok"]
+        lines.append(json.dumps(output, ensure_ascii=False, separators=(",", ":")))
+    lines.append("")
+    return "\n".join(lines), ok
+
+
+class AuditCapture:
+    """แทน audit_log ใน process ลูกของ DoseApiPool: เก็บรายการไว้ส่งกลับไปให้แม่เขียน (และนับ metric)"""
+
+    __slots__ = ("records",)
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, kind, inputs, result):
+        self.records.append((time.time(), kind, _dose_pool_tables_version, inputs, RESULT_SERIALIZERS[type(result)](result)))
+
+    def drain(self):
+        records, self.records = self.records, []
+        return records
+
+
+_dose_pool_tables_version = None  # ใน process ลูก: TABLES_VERSION ของแม่ที่ตารางยาในลูกตรงกัน
+
+
+def _dose_pool_worker_init(tables_version):
+    global _dose_pool_tables_version, audit_log
+    _dose_pool_tables_version = tables_version
+    drain_metrics()  # ค่าที่ติดมาตอน fork เป็นของแม่ (แม่นับไว้แล้ว)
+    if audit_log is not None:
+        audit_log = AuditCapture()
+
+
+def evaluate_dose_rows_in_pool(rows, locale, tables):
+    """
+    งานของ process ลูก: tables = (version, pickle ของตารางยา) ถ้าแม่ reload หลัง fork
+    คืน evaluate_dose_rows + metric และรายการ audit ของชุดนี้ (แม่รวมด้วย merge_dose_pool_result)
+    """
+    global _dose_pool_tables_version
+    if tables is not None and tables[0] != _dose_pool_tables_version:
+        reload_drug_tables(*pickle.loads(tables[1]))
+        _dose_pool_tables_version = tables[0]
+    text, ok = evaluate_dose_rows(rows, locale)
+    return text, ok, drain_metrics(), audit_log.drain() if audit_log is not None else ()
+
+
+def merge_dose_pool_result(result):
+    """ผลจาก process ลูก → (บรรทัด NDJSON, จำนวนแถวที่ ok) หลังรวม metric และ audit ของลูกเข้ากับ process นี้"""
+    text, ok, metrics, audit_records = result
+    merge_metrics(metrics)
+    if audit_records and audit_log is not None:
+        audit_log.extend(audit_records)
+    return text, ok
+
+
+class DoseApiPool:
+    """
+    process pool ของ /api/dose และ dosebatch.py: fork worker ทั้งหมดตอนสร้าง (ก่อนรับ request และก่อนมี thread อื่น)
+    reload ตารางยาแล้วไม่ fork ใหม่: งานถัดไปแนบตารางชุดใหม่ (pickle ครั้งเดียวต่อ version) ให้ลูกโหลดเอง
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.forked_version = TABLES_VERSION
+        self._tables = None
+        self.executor = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("fork"),
+            initializer=_dose_pool_worker_init, initargs=(TABLES_VERSION,),
+        )
+        # ProcessPoolExecutor แบบ fork เริ่ม worker ทุกตัวตอน submit แรก: ให้เกิดตอนนี้ ไม่ใช่ใน request
+        self.executor.submit(int).result()
+
+    def tables(self):
+        """None ถ้าตารางยายังเป็นชุดเดียวกับตอน fork ไม่เช่นนั้น (TABLES_VERSION, pickle ของตาราง)"""
+        version = TABLES_VERSION
+        if version == self.forked_version:
+            return None
+        cached = self._tables
+        if cached is None or cached[0] != version:
+            cached = self._tables = (version, pickle.dumps((DRUG_DATABASE, SPECIAL_DRUGS), protocol=pickle.HIGHEST_PROTOCOL))
+        return cached
+
+    def submit(self, rows, locale=None):
+        return self.executor.submit(evaluate_dose_rows_in_pool, rows, locale, self.tables())
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+dose_api_pool = None
+
+
+def start_dose_api_pool():
+    global dose_api_pool
+    if DOSE_API_WORKERS > 0 and dose_api_pool is None:
+        dose_api_pool = DoseApiPool(DOSE_API_WORKERS)
+        atexit.register(dose_api_pool.shutdown)
+        logging.info(f"🧮 เริ่ม process pool ของ /api/dose {DOSE_API_WORKERS} ตัว")
+
+
+class DoseRowBatcher:
+    """
+    body ทีละท่อน → ชุดแถว ชุดละ DOSE_API_CHUNK_ROWS (ใช้ทั้ง route ของ Flask และ asgi.py)
+    raise DoseApiBodyError ถ้า body อ่านต่อไม่ได้หรือเกิน DOSE_API_MAX_ROWS
+    """
+
+    def __init__(self, mimetype):
+        self.reader = JsonArrayRowReader() if mimetype == "application/json" else NdjsonRowReader()
+        self.rows = []
+        self.count = 0
+
+    def _chunks(self, rows):
+        self.count += len(rows)
+        if self.count > DOSE_API_MAX_ROWS:
+            raise DoseApiBodyError(f"เกิน {DOSE_API_MAX_ROWS} แถวต่อ request")
+        self.rows.extend(rows)
+        chunks = []
+        while len(self.rows) >= DOSE_API_CHUNK_ROWS:
+            chunks.append(self.rows[:DOSE_API_CHUNK_ROWS])
+            del self.rows[:DOSE_API_CHUNK_ROWS]
+        return chunks
+
+    def feed(self, data):
+        return self._chunks(self.reader.feed(data))
+
+    def close(self):
+        chunks = self._chunks(self.reader.close())
+        if self.rows:
+            chunks.append(self.rows)
+            self.rows = []
+        return chunks
+
+
+def use_dose_api_pool(chunk, in_flight):
+    """ส่งเข้า pool เมื่อ batch มีมากกว่าชุดเดียว (ชุดเต็ม หรือมีชุดก่อนหน้าอยู่ใน pool แล้ว เพื่อคงลำดับ)"""
+    return dose_api_pool is not None and (bool(in_flight) or len(chunk) == DOSE_API_CHUNK_ROWS)
+
+
+def evaluate_dose_chunk(chunk, locale=None):
+    """คำนวณ 1 ชุดใน request นี้เลย (batch เล็ก หรือไม่มี pool)"""
+    with stage_timer("dose_api_chunk"):
+        return count_dose_api_rows(*evaluate_dose_rows(chunk, locale))
+
+
+def count_dose_api_rows(text, ok):
+    DOSE_API_ROWS_TOTAL.inc("ok", amount=ok)
+    DOSE_API_ROWS_TOTAL.inc("error", amount=text.count("\n") - ok)
+    return text
+
+
+def dose_api_error_line(error, message):
+    return json.dumps({"id": None, "ok": False, "error": error, "message": message}, ensure_ascii=False) + "\n"
+
+
+def stream_dose_results(batcher, body_chunks, locale=None):
+    """body เข้า → บรรทัด NDJSON ออกตามลำดับเดิม (pool ทำงานล่วงหน้าได้ไม่เกิน 2 ชุดต่อ worker)"""
+    in_flight = deque()
+
+    def chunks():
+        for data in body_chunks:
+            yield from batcher.feed(data)
+        yield from batcher.close()
+
+    def pooled():
+        return count_dose_api_rows(*merge_dose_pool_result(in_flight.popleft().result()))
+
+    try:
+        for chunk in chunks():
+            if use_dose_api_pool(chunk, in_flight):
+                in_flight.append(dose_api_pool.submit(chunk, locale))
+                while len(in_flight) > dose_api_pool.workers * 2:
+                    yield pooled()
+            else:
+                yield evaluate_dose_chunk(chunk, locale)
+        while in_flight:
+            yield pooled()
+    except DoseApiBodyError as e:
+        # ส่งผลของชุดที่คำนวณแล้วให้ครบก่อน แล้วจบด้วยบรรทัด error (ส่ง status 200 ไปแล้ว เปลี่ยนไม่ได้)
+        while in_flight:
+            yield pooled()
+        yield dose_api_error_line("invalid_body", str(e))
+
+
+def dose_api_locale_error(locale):
+    """ข้อความ error ถ้า ?locale= ไม่รองรับ (None = ใช้ได้)"""
+    if locale is not None and locale not in COMPILED_TEMPLATES:
+        return f"ไม่รองรับ locale {locale} (ใช้ได้: {', '.join(COMPILED_TEMPLATES)})"
+    return None
+
+
+@app.route("/api/dose", methods=["POST"])
+def api_dose():
+    if not dose_api_authorized(request.headers.get("Authorization")):
+        abort(403)
+    locale = request.args.get("locale")
+    error = dose_api_locale_error(locale)
+    if error is not None:
+        return {"ok": False, "error": error}, 400
+    body_chunks = iter(lambda: request.stream.read(DOSE_API_READ_BYTES), b"")
+    results = stream_dose_results(DoseRowBatcher(request.mimetype), body_chunks, locale)
+    return Response(stream_with_context(results), mimetype="application/x-ndjson")
+
+
+# ---------------------------------------------------------------------------
+# audit log: บันทึกทุกขนาดยาที่ bot แนะนำ (input + ผลคำนวณแบบมีโครงสร้าง) แบบ append-only
+#
+# ฝั่ง request แค่ append tuple ลง deque (append/popleft ของ deque เป็น atomic ไม่ต้องใช้ lock)
+# thread "audit-writer" ดึงออกเป็นชุดทุก AUDIT_FLUSH_SECONDS (หรือเร็วกว่านั้นเมื่อค้างครบ AUDIT_BATCH_MAX)
+# แปลงเป็น JSON แล้วเขียนพร้อม fsync ครั้งเดียวต่อชุด เขียนไม่ได้ (ดิสก์เต็ม, DB lock) ชุดนั้นกลับเข้าหัวคิวรอรอบหน้า
+#   jsonl   ไฟล์ใหม่ต่อ process ใน AUDIT_LOG_DIR ขึ้นไฟล์ใหม่เมื่อเกิน AUDIT_ROTATE_BYTES หรือข้ามวัน (ไม่แก้ไฟล์เก่า)
+#   sqlite  ตาราง audit_log ใน AUDIT_DB_PATH (WAL, synchronous=FULL: fsync ตอน commit ของแต่ละชุด)
+# ตอนปิด process (atexit และตอนจบ process ลูกของ multiprocessing) เขียนที่ค้างอยู่ให้หมดก่อน
+# รายการที่มาหลังปิดแล้วเขียนทันทีใน thread ที่บันทึก, คิวเกิน AUDIT_QUEUE_MAX (เขียนไม่ได้นานๆ) ทิ้งรายการใหม่และนับไว้
+# ---------------------------------------------------------------------------
+
+AUDIT_LOG_BACKEND = os.environ.get("AUDIT_LOG_BACKEND", "off")  # off, jsonl หรือ sqlite
+AUDIT_LOG_DIR = os.environ.get("AUDIT_LOG_DIR", "audit")
+AUDIT_DB_PATH = os.environ.get("AUDIT_DB_PATH", "audit.sqlite3")
+AUDIT_FLUSH_SECONDS = float(os.environ.get("AUDIT_FLUSH_SECONDS", 1))
+AUDIT_BATCH_MAX = int(os.environ.get("AUDIT_BATCH_MAX", 1000))
+AUDIT_QUEUE_MAX = int(os.environ.get("AUDIT_QUEUE_MAX", 100000))
+AUDIT_ROTATE_BYTES = int(os.environ.get("AUDIT_ROTATE_BYTES", 64 * 1024 * 1024))
+
+AUDIT_DOSE = "dose"
+AUDIT_SPECIAL = "special"
+AUDIT_WARFARIN = "warfarin"
+AUDIT_INPUT_FIELDS = {
+    AUDIT_DOSE: ("drug", "indication", "weight", "entry"),
+    AUDIT_SPECIAL: ("drug", "indication", "weight", "age"),
+    AUDIT_WARFARIN: ("inr", "twd", "bleeding"),
+}
+
+
+def audit_entry(record):
+    """(เวลา, ชนิด, TABLES_VERSION, input, ผล) จากคิว → dict ที่บันทึก (ผลจาก process ลูกเป็น dict มาแล้ว)"""
+    logged_at, kind, tables_version, inputs, result = record
+    return {
+        "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(logged_at)) + f".{int(logged_at % 1 * 1000):03d}Z",
+        "kind": kind,
+        "pid": os.getpid(),
+        "tables_version": tables_version,
+        "inputs": dict(zip(AUDIT_INPUT_FIELDS[kind], inputs)),
+        "result": result if isinstance(result, dict) else RESULT_SERIALIZERS[type(result)](result),
+    }
+
+
+class JsonlAuditSink:
+    """ไฟล์ audit-<เวลาเปิด>-<pid>.jsonl 1 บรรทัดต่อรายการ (แต่ละ process มีไฟล์ของตัวเอง ไม่ต้องแย่งกันเขียน)"""
+
+    def __init__(self, directory, rotate_bytes):
+        self.directory = directory
+        self.rotate_bytes = rotate_bytes
+        self.file = None
+        self.day = None
+        self.size = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self):
+        if self.file is not None:
+            self.file.close()
+        now = time.gmtime()
+        stem = os.path.join(self.directory, f"audit-{time.strftime('%Y%m%dT%H%M%S', now)}-{os.getpid()}")
+        path = f"{stem}.jsonl"
+        for n in itertools.count(1):
+            if not os.path.exists(path):
+                break
+            path = f"{stem}.{n}.jsonl"
+        self.file = open(path, "ab")
+        self.day = now.tm_yday
+        self.size = 0
+
+    def write(self, entries):
+        data = "".join(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n" for entry in entries).encode("utf-8")
+        if self.file is None or self.size + len(data) > self.rotate_bytes or time.gmtime().tm_yday != self.day:
+            self._open()
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.size += len(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class SQLiteAuditSink:
+    """ตาราง audit_log ใน SQLite (ทุก worker เขียนไฟล์เดียวกันได้ด้วย WAL) 1 transaction ต่อชุด"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS audit_log ("
+            "id INTEGER PRIMARY KEY, ts TEXT NOT NULL, kind TEXT NOT NULL, pid INTEGER NOT NULL, "
+            "tables_version INTEGER NOT NULL, inputs TEXT NOT NULL, result TEXT NOT NULL)"
+        )
+
+    def write(self, entries):
+        rows = [
+            (entry["ts"], entry["kind"], entry["pid"], entry["tables_version"],
+             json.dumps(entry["inputs"], ensure_ascii=False, separators=(",", ":")),
+             json.dumps(entry["result"], ensure_ascii=False, separators=(",", ":")))
+            for entry in entries
+        ]
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT INTO audit_log (ts, kind, pid, tables_version, inputs, result) VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+def create_audit_sink(backend):
+    if backend == "jsonl":
+        return JsonlAuditSink(AUDIT_LOG_DIR, AUDIT_ROTATE_BYTES)
+    if backend == "sqlite":
+        return SQLiteAuditSink(AUDIT_DB_PATH)
+    raise ValueError(f"AUDIT_LOG_BACKEND ไม่รองรับ: {backend}")
+
+
+class AuditLog:
+    """คิวของรายการ audit + thread เขียนเป็นชุด (เริ่ม thread และเปิดไฟล์เมื่อมีรายการแรกของแต่ละ process)"""
+
+    def __init__(self, backend, flush_seconds, batch_max, queue_max):
+        self.backend = backend
+        self.flush_seconds = flush_seconds
+        self.batch_max = batch_max
+        self.queue_max = queue_max
+        create_audit_sink(backend).close()  # ตรวจ path/สิทธิ์ตั้งแต่ตอนโหลด ไม่ใช่ตอน reply แรก
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+        # process ลูกของ multiprocessing ไม่เรียก atexit: ลงทะเบียน finalizer ใหม่ในลูกทุกตัว
+        multiprocessing.util.register_after_fork(self, AuditLog._finalize_in_child)
+
+    def _reset(self):
+        # หลัง fork: รายการที่ค้างอยู่เป็นของ process แม่ (แม่เขียนเอง) ส่วน thread และไฟล์ไม่ติดมาด้วย
+        self.pending = deque()
+        self.wake = threading.Event()
+        self.start_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.sink = None
+        self.closed = False
+        self.written = 0
+        self.failed_batches = 0
+        self.dropped = 0
+        self.dropped_logged = 0
+        self.drop_lock = threading.Lock()
+
+    def _finalize_in_child(self):
+        multiprocessing.util.Finalize(self, self.close, exitpriority=0)
+
+    def record(self, kind, inputs, result):
+        """เรียกจากฝั่ง request: ไม่รอ I/O และไม่จับ lock (ยกเว้นครั้งแรกของ process ที่ต้องเริ่ม thread)"""
+        if len(self.pending) >= self.queue_max:
+            self._drop(1)
+            return
+        self.pending.append((time.time(), kind, TABLES_VERSION, inputs, result))
+        self._queued()
+
+    def extend(self, records):
+        """รายการที่ process ลูกของ DoseApiPool บันทึกไว้ (เวลาและ TABLES_VERSION ตามตอนคำนวณ)"""
+        room = self.queue_max - len(self.pending)
+        if room < len(records):
+            self._drop(len(records) - max(room, 0))
+            records = records[:max(room, 0)]
+        self.pending.extend(records)
+        self._queued()
+
+    def _queued(self):
+        if self.closed:
+            self.flush()  # ปิดไปแล้ว (เช่นงานที่ยังค้างตอน atexit) ไม่มี thread มาเขียนให้
+        elif self.thread is None:
+            self.start()
+        elif len(self.pending) >= self.batch_max:
+            self.wake.set()
+
+    def _drop(self, count):
+        with self.drop_lock:
+            self.dropped += count
+        AUDIT_RECORDS_TOTAL.inc("dropped", amount=count)
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is None and not self.closed:
+                self.thread = threading.Thread(target=self._run, daemon=True, name="audit-writer")
+                self.thread.start()
+
+    def _run(self):
+        while not self.closed:
+            self.wake.wait(self.flush_seconds)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        """เขียนทุกรายการที่ค้างอยู่ ทีละชุดไม่เกิน batch_max คืน False ถ้าเขียนไม่สำเร็จ (รายการยังอยู่ในคิว)"""
+        with self.flush_lock:
+            while self.pending:
+                batch = []
+                while self.pending and len(batch) < self.batch_max:
+                    batch.append(self.pending.popleft())
                 try:
-                    session["twd"] = float(text)
-                    session["step"] = "ask_bleeding"
-                    reply = "🩸 มี major bleeding หรือไม่? (yes/no)"
-                except:
-                    reply = "❌ กรุณาใส่ค่า TWD เป็นตัวเลข เช่น 28"
-                messaging_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply)]
-                    )
-                )
-                return
-            elif step == "ask_bleeding":
-                if text.lower() not in ["yes", "no"]:
-                    reply = "❌ ตอบว่า yes หรือ no เท่านั้น"
-                else:
-                    result = calculate_warfarin(session["inr"], session["twd"], text.lower())
-                    user_sessions.pop(user_id, None)  # จบ session
-                    reply = result
-                messaging_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply)]
-                    )
-                )
-                return
+                    if self.sink is None:
+                        self.sink = create_audit_sink(self.backend)
+                    self.sink.write([audit_entry(record) for record in batch])
+                except (OSError, sqlite3.Error) as e:
+                    self.pending.extendleft(reversed(batch))
+                    self.failed_batches += 1
+                    AUDIT_RECORDS_TOTAL.inc("requeued", amount=len(batch))
+                    logging.warning(f"⚠️ เขียน audit log ไม่สำเร็จ ({len(self.pending)} รายการรออยู่): {e}")
+                    return False
+                self.written += len(batch)
+                AUDIT_RECORDS_TOTAL.inc("written", amount=len(batch))
+            if self.dropped != self.dropped_logged:
+                logging.error(f"❌ คิว audit log เต็ม ({self.queue_max}) ทิ้งไป {self.dropped - self.dropped_logged} รายการ")
+                self.dropped_logged = self.dropped
+            return True
+
+    def close(self):
+        """หยุด thread แล้วเขียนที่เหลือทั้งหมด (เรียกตอนปิด process)"""
+        self.closed = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+        if not self.flush():
+            logging.error(f"❌ ปิด process โดยเขียน audit log ไม่ได้ {len(self.pending)} รายการ")
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+
+    def stats(self):
+        return {
+            "backend": self.backend,
+            "pending": len(self.pending),
+            "written": self.written,
+            "failed_batches": self.failed_batches,
+            "dropped": self.dropped,
+        }
+
+
+audit_log = (
+    AuditLog(AUDIT_LOG_BACKEND, AUDIT_FLUSH_SECONDS, AUDIT_BATCH_MAX, AUDIT_QUEUE_MAX) if AUDIT_LOG_BACKEND != "off" else None
+)
+if audit_log is not None:
+    atexit.register(audit_log.close)
+
+
+class IntentRouter:
+    """
+    จัดประเภทข้อความเป็น intent ด้วย regex ตัวเดียว (1 named group ต่อ intent) แทนการเช็ค if ทีละเงื่อนไข
+    - intent แบบ always ทำงานเสมอ แม้อยู่ระหว่าง flow (เช่นคำสั่งเริ่มต้นใหม่)
+    - flow ที่ค้างอยู่ใน session (เช่น warfarin) รับข้อความที่เหลือทั้งหมด
+    - ข้อความที่ไม่ตรง intent ใด หรือ handler คืนค่า False (ไม่รับข้อความนี้) ไปที่ fallback
+    """
+
+    def __init__(self):
+        self.patterns = []
+        self.handlers = {}
+        self.always = set()
+        self.flows = {}
+        self.fallback = None
+        self.regex = None
+
+    def intent(self, name, pattern, ignore_case=False, always=False):
+        def decorator(func):
+            self.patterns.append(f"(?P<{name}>{f'(?i:{pattern})' if ignore_case else pattern})")
+            self.handlers[name] = func
+            if always:
+                self.always.add(name)
+            self.regex = None
+            return func
+        return decorator
+
+    def flow(self, name):
+        def decorator(func):
+            self.flows[name] = func
+            return func
+        return decorator
+
+    def default(self, func):
+        self.fallback = func
+        return func
+
+    def compile(self):
+        self.regex = re.compile("|".join(self.patterns), re.DOTALL)
+
+    def classify(self, text):
+        """คืนค่า (intent, args) หรือ (None, {}) ถ้าไม่ตรง intent ใด"""
+        if self.regex is None:
+            self.compile()
+        match = self.regex.fullmatch(text)
+        if match is None:
+            return None, {}
+        # group ของ intent ปิดหลัง group ของ argument เสมอ lastgroup จึงเป็นชื่อ intent
+        args = {key: value for key, value in match.groupdict().items() if value is not None and key not in self.handlers}
+        return match.lastgroup, args
+
+    def dispatch(self, event, user_id, text):
+        with stage_timer("route"):
+            intent, args = self.classify(text)
+        if intent in self.always:
+            return self.handlers[intent](event, user_id, None, **args)
+        session = sessions.get(user_id)
+        if session is not None and session.get("flow") in self.flows:
+            return self.flows[session["flow"]](event, user_id, session, text)
+        if intent is not None and self.handlers[intent](event, user_id, session, **args) is not False:
+            return
+        self.fallback(event, user_id, session, text)
+
+
+router = IntentRouter()
 
-    if text == "เลือกยาใหม่":
-        user_drug_selection.pop(user_id, None)
-        user_ages.pop(user_id, None)
-        send_drug_selection(event)
-        return
 
-    if text.startswith("MoreIndication:"):
-        drug_name = text.replace("MoreIndication:", "").strip()
-        send_indication_carousel(event, drug_name, show_all=True)
+@handler.add(MessageEvent)
+def handle_message(event: MessageEvent):
+    if not isinstance(event.message, TextMessageContent):
         return
+    with outbound.collect(event.reply_token):
+        router.dispatch(event, event.source.user_id, event.message.text.strip())
 
-    if text.startswith("เลือกยา:"):
-        drug_name = text.replace("เลือกยา:", "").strip()
-        user_drug_selection[user_id] = {"drug": drug_name}
 
-        if drug_name in DRUG_DATABASE:
-            send_indication_carousel(event, drug_name)
+@handler.add(PostbackEvent)
+def handle_postback(event: PostbackEvent):
+    with outbound.collect(event.reply_token):
+        state = decode_flow_token(event.postback.data)
+        if state is None:
+            reply_text(event, FLOW_EXPIRED_TEXT)
+            return
+        drug, indication, entry, age = state
+        if indication is not None:
+            prompt_flow_input(event, drug, indication, entry, age)
+        elif drug in DRUG_DATABASE:
+            send_indication_carousel(event, drug)
         else:
-            send_special_indication_carousel(event, drug_name)
+            send_special_indication_carousel(event, drug)
+
+
+@router.intent("start_warfarin", r"คำนวณยา warfarin", ignore_case=True, always=True)
+def start_warfarin(event, user_id, session):
+    sessions.set(user_id, {"flow": "warfarin", "step": "ask_inr"})
+    reply_text(event, "🧪 กรุณาใส่ค่า INR (เช่น 2.5)")
+
+
+@router.intent("start_pediatric", r"คำนวณขนาดยาเด็ก|คำนวณยาเด็ก", always=True)
+def start_pediatric(event, user_id, session):
+    sessions.delete(user_id)
+    send_drug_selection(event)
+
+
+@router.intent("flow_step", rf"[^#]*#(?P<flow_token>{FLOW_TOKEN_PATTERN})(?P<flow_input>.*)", always=True)
+def flow_step(event, user_id, session, flow_token, flow_input):
+    """ข้อความจากคีย์บอร์ดที่เปิดด้วยปุ่ม postback: สถานะทั้งหมดอยู่ใน token ไม่อ่าน/เขียน session"""
+    state = decode_flow_token(flow_token)
+    if state is None or state[1] is None:
+        reply_text(event, FLOW_EXPIRED_TEXT)
         return
+    drug, indication, entry, age = state
 
-    if text.startswith("Indication:") and user_id in user_drug_selection:
-        indication = text.replace("Indication:", "").strip()
-        user_drug_selection[user_id]["indication"] = indication
-        drug = user_drug_selection[user_id].get("drug")
+    age_years, weight = parse_age_weight(flow_input)
+    if age_years is not None:
+        if not 0 <= age_years <= 18:
+            reply_text(event, "❌ กรุณาใส่อายุระหว่าง 0–18 ปี (หรือเป็นเดือนก็ได้)")
+            return
+        age = age_years
+    if weight is None or (drug in SPECIAL_DRUGS and age is None):
+        prompt_flow_input(event, drug, indication, entry, age)
+        return
 
-        if user_id in user_ages:
-            user_ages.pop(user_id)
+    if drug in SPECIAL_DRUGS:
+        reply_result(event, calculate_special_drug(drug, indication, weight, age))
+    else:
+        reply_result(event, calculate_dose(drug, indication, weight, entry))
 
-        if drug in SPECIAL_DRUGS:
-            example_age = round(random.uniform(1, 18), 1)
-            messaging_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="📆 กรุณาพิมพ์อายุของเด็ก เช่น {example_age} ปี")]
-                )
-            )
+
+# ค่าที่รับจากผู้ใช้ได้ (มากกว่า 0 และไม่เกินค่านี้) ค่าที่เกินมักพิมพ์ผิด เช่น ใส่ TWD เป็น mg/วัน × 10
+WARFARIN_MAX_INR = 20.0
+WARFARIN_MAX_TWD = 140.0  # mg/สัปดาห์ = 20 mg/วัน
+
+
+def parse_warfarin_value(text, upper):
+    """ตัวเลข 0 < x ≤ upper จากข้อความ หรือ None (รวม nan, inf, ค่าติดลบ ที่ float() รับได้)"""
+    try:
+        value = float(text)
+    except ValueError:
+        return None
+    if not (math.isfinite(value) and 0 < value <= upper):
+        return None
+    return value
+
+
+@router.flow("warfarin")
+def warfarin_step(event, user_id, session, text):
+    step = session.get("step")
+    if step == "ask_inr":
+        inr = parse_warfarin_value(text, WARFARIN_MAX_INR)
+        if inr is None:
+            reply = f"❌ กรุณาใส่ค่า INR เป็นตัวเลขมากกว่า 0 ไม่เกิน {WARFARIN_MAX_INR:g} เช่น 2.5"
         else:
-            example_weight = round(random.uniform(5.0, 20.0), 1)
-            messaging_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=f"เลือกข้อบ่งใช้ {indication} แล้ว กรุณาพิมพ์น้ำหนักเป็นกิโลกรัม เช่น {example_weight}")]
-                )
-            )
-        return
-    
-    if user_id in user_drug_selection:
+            session["inr"] = inr
+            session["step"] = "ask_twd"
+            sessions.set(user_id, session)
+            reply = "📈 ใส่ Total Weekly Dose (TWD) เช่น 28"
+    elif step == "ask_twd":
+        twd = parse_warfarin_value(text, WARFARIN_MAX_TWD)
+        if twd is None:
+            reply = f"❌ กรุณาใส่ค่า TWD เป็นตัวเลขมากกว่า 0 ไม่เกิน {WARFARIN_MAX_TWD:g} mg/สัปดาห์ เช่น 28"
+        else:
+            session["twd"] = twd
+            session["step"] = "ask_bleeding"
+            sessions.set(user_id, session)
+            reply = "🩸 มี major bleeding หรือไม่? (yes/no)"
+    else:
+        if text.lower() not in ["yes", "no"]:
+            reply = "❌ ตอบว่า yes หรือ no เท่านั้น"
+        else:
+            with stage_timer("calculate_warfarin"):
+                adjustment = calculate_warfarin(session["inr"], session["twd"], text.lower())
+            WARFARIN_ADJUSTMENTS_TOTAL.inc(adjustment.label)
+            sessions.delete(user_id)  # จบ session
+            reply_result(event, adjustment)
+            return
+    reply_text(event, reply)
 
-        # 🛠 แก้การจับอายุ: ใช้ .group(0) และใส่ try-except
-        text_lower = text.lower()
 
-        if any(kw in text_lower for kw in ["อายุ", "ปี", "y", "ขวบ", "เดือน", "mo"]):
-            try:
-                # ตรวจจับปีและเดือน
-                years = 0
-                months = 0
-
-                year_match = re.search(r"(\d+(?:\.\d+)?)\s*(ปี|y|ขวบ)", text_lower)
-                if year_match:
-                    years = float(year_match.group(1))
-
-                month_match = re.search(r"(\d+(?:\.\d+)?)\s*(เดือน|mo)", text_lower)
-                if month_match:
-                    months = float(month_match.group(1))
-
-                if not year_match and not month_match:
-                    raise ValueError("ไม่พบปีหรือเดือน")
-
-                age_years = round(years + months / 12, 2)
-
-                if 0 <= age_years <= 18:
-                    user_ages[user_id] = age_years
-                    example_weight = round(random.uniform(5.0, 20.0), 1)
-                    messaging_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=f"🎯 อายุ {age_years:.2f} ปีแล้ว กรุณาใส่น้ำหนัก เช่น {example_weight} กก")]
-                        )
-                    )
-                else:
-                    messaging_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="❌ กรุณาใส่อายุระหว่าง 0–18 ปี (หรือเป็นเดือนก็ได้)")]
-                        )
-                    )
-                return
+@router.intent("reset_drug", r"เลือกยาใหม่")
+def reset_drug(event, user_id, session):
+    sessions.delete(user_id)
+    send_drug_selection(event)
 
-            except:
-                messaging_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="❌ กรุณาพิมพ์อายุให้ถูกต้อง เช่น 6 เดือน หรือ 1 ปี 6 เดือน หรือ 2 ขวบ")]
-                    )
-                )
-                return
 
-        if any(kw in text_lower for kw in ["น้ำหนัก", "กก", "kg"]) or text.replace(".", "", 1).isdigit():
-            weight_match = re.search(r"(\d+(\.\d+)?)", text)
-            if weight_match:
-                try:
-                    weight = float(weight_match.group(1))
-                except ValueError:
-                    messaging_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="❌ กรุณาพิมพ์น้ำหนักให้ถูกต้อง เช่น 20 กก")]
-                        )
-                    )
-
-                entry = user_drug_selection[user_id]
-                drug = entry.get("drug")
-
-                if drug in SPECIAL_DRUGS:
-                    age = user_ages.get(user_id)
-                    if age is None:
-                        # แจ้งให้ใส่อายุก่อน แล้วค่อยพิมพ์น้ำหนักอีกครั้ง
-                        messaging_api.reply_message(
-                            ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text="📆 กรุณาพิมพ์อายุของเด็กก่อน เช่น 5 ปี\nจากนั้นพิมพ์น้ำหนักอีกครั้ง")]
-                            )
-                        )
-                        return  # หยุดการทำงานที่นี่เลย
-                    else:
-                        try:
-                            reply = calculate_special_drug(user_id, drug, weight, age)
-                        except Exception as e:
-                            logging.info(f"❌ คำนวณผิดพลาดใน SPECIAL_DRUG: {e}")
-                            reply = "เกิดข้อผิดพลาดในการคำนวณยา"
-                else:
-                    if "indication" not in entry:
-                        reply = "❗️ กรุณาเลือกข้อบ่งใช้ก่อน เช่น 'Indication: Fever'"
-                    else:
-                        indication = entry["indication"]
-                        try:
-                            reply = calculate_dose(drug, indication, weight)
-                        except Exception as e:
-                            logging.info(f"❌ คำนวณผิดพลาดใน DRUG_DATABASE: {e}")
-                            reply = "เกิดข้อผิดพลาดในการคำนวณยา"
-
-                messaging_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply)]
-                    )
-                )
-                return
+@router.intent("more_indication", r"MoreIndication:\s*(?P<more_drug>.*)")
+def more_indication(event, user_id, session, more_drug):
+    send_indication_carousel(event, more_drug.strip(), show_all=True)
+
 
+@router.intent("select_drug", r"เลือกยา:\s*(?P<drug>.*)")
+def select_drug(event, user_id, session, drug):
+    drug_name = drug.strip()
+    sessions.set(user_id, {"drug": drug_name})
+
+    if drug_name in DRUG_DATABASE:
+        send_indication_carousel(event, drug_name)
+    else:
+        send_special_indication_carousel(event, drug_name)
+
+
+@router.intent("select_indication", r"Indication:\s*(?P<indication>.*)")
+def select_indication(event, user_id, session, indication):
+    if session is None or "drug" not in session:
+        return False
+    indication = indication.strip()
+    session["indication"] = indication
+    session.pop("age", None)
+    sessions.set(user_id, session)
+    drug = session.get("drug")
+
+    if drug in SPECIAL_DRUGS:
+        example_age = round(random.uniform(1, 18), 1)
+        reply_text(event, f"📆 กรุณาพิมพ์อายุของเด็ก เช่น {example_age} ปี")
+    else:
+        example_weight = round(random.uniform(5.0, 20.0), 1)
+        reply_text(event, f"เลือกข้อบ่งใช้ {indication} แล้ว กรุณาพิมพ์น้ำหนักเป็นกิโลกรัม เช่น {example_weight}")
+
+
+# จับตัวเลขพร้อมหน่วยทุกตัวในข้อความในการสแกนครั้งเดียว เช่น "1 ปี 6 เดือน 12 กก", "อายุ 3 น้ำหนัก 14.5"
+# หน่วยยาวเรียงก่อนหน่วยสั้น (months ก่อน mo, กิโลกรัม ก่อน กิโล)
+AGE_YEAR_UNITS = ("years", "year", "yrs", "yr", "y", "ปี", "ขวบ")
+AGE_MONTH_UNITS = ("months", "month", "mos", "mo", "เดือน")
+WEIGHT_UNITS = ("kgs", "kg", "กิโลกรัม", "กิโล", "กก.", "กก")
+QUANTITY_RE = re.compile(
+    r"(?:(?P<keyword>อายุ|น้ำหนัก|นน\.?)\s*)?"
+    r"(?P<number>\d+(?:\.\d+)?)\s*"
+    r"(?:(?P<unit>" + "|".join(re.escape(unit) for unit in AGE_YEAR_UNITS + AGE_MONTH_UNITS + WEIGHT_UNITS) + r")(?![a-z]))?",
+    re.IGNORECASE,
+)
+UNIT_KINDS = {
+    **{unit: "years" for unit in AGE_YEAR_UNITS},
+    **{unit: "months" for unit in AGE_MONTH_UNITS},
+    **{unit: "weight" for unit in WEIGHT_UNITS},
+}
+
+
+def parse_age_weight(text):
+    """
+    คืนค่า (อายุเป็นปี, น้ำหนัก kg) จากข้อความ ค่าที่ไม่มีเป็น None
+    ตัวเลขที่ไม่มีหน่วยถือเป็นน้ำหนัก ยกเว้นตามหลังคำว่า "อายุ" ถือเป็นปี
+    """
+    years = months = weight = None
+    for match in QUANTITY_RE.finditer(text):
+        value = float(match.group("number"))
+        unit = match.group("unit")
+        if unit:
+            kind = UNIT_KINDS[unit.lower()]
         else:
-            # ถ้าไม่มีคำว่า "อายุ" หรือ "น้ำหนัก" ให้แจ้งเตือน
-            messaging_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="❗️ กรุณาพิมพ์อายุ เช่น '5 ปี' หรือ น้ำหนัก เช่น '18 กก'")]
-                )
-            )
+            kind = "years" if match.group("keyword") == "อายุ" else "weight"
+        if kind == "years":
+            years = value
+        elif kind == "months":
+            months = value
+        elif weight is None:
+            weight = value
+    if years is None and months is None:
+        return None, weight
+    return round((years or 0) + (months or 0) / 12, 2), weight
+
+
+@router.default
+def free_text(event, user_id, session, text):
+    if session is None:
+        reply_text(event, "❓ พิมพ์ 'คำนวณยา warfarin' หรือ 'คำนวณยาเด็ก' เพื่อเริ่มต้นใช้งาน")
+        return
+    if "drug" not in session:
+        return
+
+    age_years, weight = parse_age_weight(text)
+    if age_years is None and weight is None:
+        reply_text(event, "❗️ กรุณาพิมพ์อายุ เช่น '5 ปี' หรือ น้ำหนัก เช่น '18 กก' (พิมพ์พร้อมกันได้ เช่น '1 ปี 6 เดือน 12 กก')")
+        return
+
+    if age_years is not None:
+        if not 0 <= age_years <= 18:
+            reply_text(event, "❌ กรุณาใส่อายุระหว่าง 0–18 ปี (หรือเป็นเดือนก็ได้)")
+            return
+        session["age"] = age_years
+        sessions.set(user_id, session)
+        if weight is None:
+            example_weight = round(random.uniform(5.0, 20.0), 1)
+            reply_text(event, f"🎯 อายุ {age_years:.2f} ปีแล้ว กรุณาใส่น้ำหนัก เช่น {example_weight} กก")
             return
 
-    if user_id not in user_sessions and user_id not in user_drug_selection:
-        messaging_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[
-                    TextMessage(text="❓ พิมพ์ 'คำนวณยา warfarin' หรือ 'คำนวณยาเด็ก' เพื่อเริ่มต้นใช้งาน")
-                ]
-            )
-        )
+    drug = session.get("drug")
+    if drug in SPECIAL_DRUGS:
+        age = session.get("age")
+        if age is None:
+            # แจ้งให้ใส่อายุก่อน แล้วค่อยพิมพ์น้ำหนักอีกครั้ง
+            reply_text(event, "📆 กรุณาพิมพ์อายุของเด็กก่อน เช่น 5 ปี\nจากนั้นพิมพ์น้ำหนักอีกครั้ง (หรือพิมพ์พร้อมกัน เช่น 5 ปี 18 กก)")
+            return
+        reply_result(event, calculate_special_drug(drug, session.get("indication"), weight, age))
+    elif "indication" not in session:
+        reply_text(event, "❗️ กรุณาเลือกข้อบ่งใช้ก่อน เช่น 'Indication: Fever'")
+    else:
+        reply_result(event, calculate_dose(drug, session["indication"], weight))
+
+
+router.compile()
+
+
+_background_workers_pid = None
+
+
+def start_background_workers(event_workers=True):
+    """
+    เริ่ม worker เบื้องหลังของ process นี้ ต้องเรียกก่อนรับ request และก่อนมี thread อื่น:
+    โหมด process fork ตอนนี้ ไม่ใช่ใน thread ของ request ที่อาจถือ lock (logging, queue) ค้างไว้ตอน fork
+    ตอนปิด process ส่งสัญญาณให้ event worker ทำคิวที่ค้างให้หมดแล้วรอจนจบ (ก่อน audit_log.close ตาม atexit)
+    event_workers=False: ไม่เริ่ม event_pool (asgi.py จัดการ event บน event loop ของตัวเอง)
+    เรียกซ้ำใน process เดียวกันได้ (ครั้งหลังไม่ทำอะไร)
+    """
+    global _background_workers_pid
+    if _background_workers_pid == os.getpid():
         return
-        
+    _background_workers_pid = os.getpid()
+    pool = event_pool if event_workers else None
+    # process ลูกก่อน (event worker โหมด process แล้วค่อย pool ของ /api/dose) จากนั้นจึงเริ่ม thread
+    if pool is not None and pool.mode == "process":
+        pool.start()
+    start_dose_api_pool()
+    if pool is not None:
+        pool.start()
+        atexit.register(pool.shutdown)
+    if FORMULARY_WATCH_SECONDS > 0:
+        watch_formulary(FORMULARY_WATCH_SECONDS)
+
+
+# serve.py (SERVER_PREFORK=1) เรียก start_background_workers ในแต่ละ worker หลัง fork แทน
+# asgi.py ก็ตั้ง SERVER_PREFORK=1 แล้วเรียกเองใน lifespan.startup (ไม่เริ่ม event_pool)
+# process แม่จึงไม่มี thread/process ลูกติดไปตอน fork, โหมด offline ใช้แค่ตัวคำนวณ
+if not LINE_BOT_OFFLINE and os.environ.get("SERVER_PREFORK") != "1":
+    start_background_workers()
+
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
@@ -0,0 +1,27 @@
+"""
+โหลด app-2.py เป็น module ให้ entry point อื่น (ASGI, launcher, CLI, benchmark) ใช้ร่วมกัน
+ชื่อไฟล์มีขีด จึง import ตรงๆ ไม่ได้
+"""
+import importlib.util
+import os
+import sys
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app-2.py")
+MODULE_NAME = "app2"
+
+
+def load_app(offline=False):
+    """offline=True: โหลดเพื่อใช้ตัวคำนวณอย่างเดียว (CLI) ไม่ต้องมี LINE_CHANNEL_ACCESS_TOKEN/SECRET"""
+    module = sys.modules.get(MODULE_NAME)
+    if module is None:
+        if offline:
+            os.environ["LINE_BOT_OFFLINE"] = "1"
+        spec = importlib.util.spec_from_file_location(MODULE_NAME, APP_PATH)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[MODULE_NAME] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules[MODULE_NAME]
+            raise
+    return module
@@ -0,0 +1,244 @@
+"""
+ASGI entry point: รับ webhook บน asyncio event loop แล้วส่ง reply ผ่าน async LINE client (aiohttp)
+event แต่ละตัวเป็น task บน loop เดียว ไม่ต้องใช้ thread ต่อ request จึงรับ webhook พร้อมกันได้หลักพัน
+
+รันด้วย ASGI server เช่น
+    pip install uvicorn
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+route + คำนวณของแต่ละ event ทำใน thread pool ขนาด ASGI_DISPATCH_THREADS แยกตาม user_id
+(event ของ user เดียวกันเข้า thread เดียวกันตามลำดับ เหมือน EventWorkerPool) ไม่ block event loop
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import aiohttp
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.messaging import AsyncApiClient, AsyncMessagingApi, Configuration
+
+from app_loader import load_app
+
+# ไม่เริ่ม worker เบื้องหลังตอน import: event_pool ไม่ได้ใช้ใน ASGI และ pool ของ /api/dose
+# ต้อง fork ใน process ที่รับ request จริง (lifespan.startup) ไม่ใช่ในทุก process ที่ import
+os.environ["SERVER_PREFORK"] = "1"
+bot = load_app()
+
+# aiohttp ไม่ผูก thread ต่อ connection จึงเปิด pool ได้ใหญ่กว่าโหมด thread
+ASYNC_POOL_MAXSIZE = int(os.environ.get("ASYNC_POOL_MAXSIZE", 100))
+ASGI_DISPATCH_THREADS = int(os.environ.get("ASGI_DISPATCH_THREADS", 4))
+
+
+class AsyncReplySender:
+    """ส่ง reply ที่ OutboundDispatcher รวมไว้ ด้วย aiohttp session ของ AsyncApiClient (retry/สถิติใช้ของ dispatcher)"""
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.timeout = aiohttp.ClientTimeout(connect=bot.LINE_CONNECT_TIMEOUT, sock_read=bot.LINE_READ_TIMEOUT)
+        self.api_client = None
+        self.messaging_api = None
+
+    async def start(self):
+        if self.api_client is None:
+            configuration = Configuration(access_token=bot.LINE_CHANNEL_ACCESS_TOKEN)
+            configuration.connection_pool_maxsize = ASYNC_POOL_MAXSIZE
+            self.api_client = AsyncApiClient(configuration)
+            self.messaging_api = AsyncMessagingApi(self.api_client)
+
+    async def close(self):
+        if self.api_client is not None:
+            await self.api_client.close()
+            self.api_client = None
+
+    async def reply(self, reply_token, messages_json):
+        body = self.dispatcher.reply_body(reply_token, messages_json)
+        if body is None:
+            return
+        await self.start()
+        session = self.api_client.rest_client.pool_manager
+        for attempt in range(self.dispatcher.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                async with session.post(self.dispatcher.url, data=body, headers=self.dispatcher.headers, timeout=self.timeout) as r:
+                    status, reason, retry_after = r.status, r.reason, r.headers.get("Retry-After")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, reason, retry_after = None, str(e), None
+            delay = self.dispatcher.record(attempt, time.perf_counter() - started, status, reason, retry_after)
+            if delay is None:
+                return
+            await asyncio.sleep(delay)
+
+
+sender = AsyncReplySender(bot.outbound)
+pending = set()
+# executor ละ 1 thread: shard ตาม user_id ให้ event ของ user เดียวกันทำตามลำดับที่รับ
+dispatch_executors = [
+    ThreadPoolExecutor(1, thread_name_prefix=f"asgi-dispatch-{i}") for i in range(max(1, ASGI_DISPATCH_THREADS))
+]
+
+
+def dispatch_collected(event, reply_token):
+    """route + คำนวณใน thread ของ executor: outbox เป็นของ thread นี้ จึงเก็บข้อความของ event นี้ได้ครบ"""
+    with bot.outbound.collect(reply_token, send=False) as outbox:
+        bot.dispatch_event(event)
+    return outbox.messages
+
+
+async def handle_event(event):
+    reply_token = getattr(event, "reply_token", None)
+    user_id = getattr(getattr(event, "source", None), "user_id", None) or ""
+    executor = dispatch_executors[zlib.crc32(user_id.encode()) % len(dispatch_executors)]
+    try:
+        messages = await asyncio.get_running_loop().run_in_executor(executor, dispatch_collected, event, reply_token)
+        await sender.reply(reply_token, messages)
+    except Exception as e:
+        logging.info(f"❌ Exception occurred in async handler: {e}")
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def respond(send, status, body, content_type=b"text/plain; charset=utf-8"):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", content_type)]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def callback(scope, receive, send):
+    body = (await read_body(receive)).decode("utf-8")
+    signature = dict(scope["headers"]).get(b"x-line-signature", b"").decode()
+    try:
+        events = bot.parse_webhook(body, signature)
+    except InvalidSignatureError:
+        await respond(send, 400, "Bad Request")
+        return
+    except Exception as e:
+        logging.info(f"❌ Exception occurred: {e}")
+        await respond(send, 400, "Bad Request")
+        return
+
+    # ตอบ 200 ทันที ให้ task คำนวณและ reply ทีหลัง
+    for event in events:
+        task = asyncio.create_task(handle_event(event))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    await respond(send, 200, "OK")
+
+
+async def dose_api_chunks(batcher, receive):
+    """อ่าน body ทีละ message ของ ASGI แล้วคืนชุดแถวทันทีที่ครบชุด (ไม่รอ body ครบ)"""
+    while True:
+        message = await receive()
+        for chunk in batcher.feed(message.get("body", b"")):
+            yield chunk
+        if not message.get("more_body"):
+            break
+    for chunk in batcher.close():
+        yield chunk
+
+
+async def dose_api_results(batcher, receive, locale):
+    """เหมือน bot.stream_dose_results แต่รอผลจาก pool ด้วย await ไม่ block event loop"""
+    in_flight = deque()
+
+    async def finish(future):
+        return bot.count_dose_api_rows(*bot.merge_dose_pool_result(await future))
+
+    try:
+        async for chunk in dose_api_chunks(batcher, receive):
+            if bot.use_dose_api_pool(chunk, in_flight):
+                in_flight.append(asyncio.wrap_future(bot.dose_api_pool.submit(chunk, locale)))
+                while len(in_flight) > bot.dose_api_pool.workers * 2:
+                    yield await finish(in_flight.popleft())
+            else:
+                yield bot.evaluate_dose_chunk(chunk, locale)
+        while in_flight:
+            yield await finish(in_flight.popleft())
+    except bot.DoseApiBodyError as e:
+        while in_flight:
+            yield await finish(in_flight.popleft())
+        yield bot.dose_api_error_line("invalid_body", str(e))
+
+
+async def dose_api(scope, receive, send):
+    headers = dict(scope["headers"])
+    if not bot.dose_api_authorized(headers.get(b"authorization", b"").decode()):
+        await respond(send, 403, "Forbidden")
+        return
+    locale = parse_qs(scope["query_string"].decode()).get("locale", [None])[0]
+    error = bot.dose_api_locale_error(locale)
+    if error is not None:
+        await respond(send, 400, json.dumps({"ok": False, "error": error}, ensure_ascii=False), b"application/json")
+        return
+
+    mimetype = headers.get(b"content-type", b"").decode().split(";")[0].strip().lower()
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/x-ndjson")]})
+    async for text in dose_api_results(bot.DoseRowBatcher(mimetype), receive, locale):
+        await send({"type": "http.response.body", "body": text.encode("utf-8"), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def admin_reload_formulary(scope, send):
+    if not bot.admin_authorized(dict(scope["headers"]).get(b"authorization", b"").decode()):
+        await respond(send, 403, "Forbidden")
+        return
+    # อ่านไฟล์และ compile ตารางยาใน thread ไม่ block event loop
+    result, status = await asyncio.to_thread(bot.reload_formulary_result)
+    await respond(send, status, json.dumps(result, ensure_ascii=False), b"application/json")
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # pool ของ /api/dose fork ก่อนเปิด aiohttp session (serve.py เริ่มไว้แล้วใน post_fork ก็ไม่เริ่มซ้ำ)
+            bot.start_background_workers(event_workers=False)
+            await sender.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            for executor in dispatch_executors:
+                executor.shutdown()
+            await sender.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    path, method = scope["path"], scope["method"]
+    if path == "/callback" and method == "POST":
+        await callback(scope, receive, send)
+    elif path == "/api/dose" and method == "POST":
+        await dose_api(scope, receive, send)
+    elif path == "/admin/reload-formulary" and method == "POST":
+        await admin_reload_formulary(scope, send)
+    elif path == "/" and method in ("GET", "HEAD"):
+        await respond(send, 200, bot.home())
+    elif path == "/stats" and method == "GET":
+        client = scope.get("client") or (None, None)
+        if bot.admin_or_local(client[0], dict(scope["headers"]).get(b"authorization", b"").decode()):
+            await respond(send, 200, json.dumps(bot.stats_snapshot(), ensure_ascii=False), b"application/json")
+        else:
+            await respond(send, 403, "Forbidden")
+    else:
+        await respond(send, 404, "Not Found")
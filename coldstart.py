@@ -0,0 +1,155 @@
+"""
+เตรียมและวัด cold start สำหรับ deploy แบบ serverless (Cloud Run, Render) ที่ process ใหม่ต้องตอบ webhook แรกให้ทัน
+
+    python coldstart.py build           # สร้าง snapshot ตารางยา + picker snapshot ไว้ล่วงหน้า (รันตอน build image)
+    python coldstart.py profile         # import-time profile + เวลาจนถึง /callback แรกตอบ ใน process ใหม่
+    python coldstart.py profile --top 30 --json coldstart.json
+
+profile รัน python ตัวใหม่ด้วย -X importtime แล้ววัด
+  import app-2.py             เวลาโหลด module ทั้งหมด (SDK, ตารางยา, router)
+  ข้อความแรก (text)           ตั้งแต่ POST /callback จน reply ถึง LINE API จำลอง
+  ข้อความที่สอง (carousel)    carousel เลือกยา: เร็วถ้ามี picker snapshot, ถ้าไม่มีต้อง import linebot.v3.messaging
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+STAGES = ("interpreter", "import_app", "first_text_reply", "first_carousel_reply")
+FIRST_MESSAGES = ("คำนวณยา warfarin", "คำนวณยาเด็ก")
+APP_LOADED_MARKER = "coldstart: app loaded"  # บรรทัดใน stderr ที่คั่นระหว่าง import ของ app กับของตัวทดสอบ
+
+
+def first_callback():
+    """ทำงานใน process ลูก: โหลด app แล้วส่ง webhook 2 ข้อความ พิมพ์เวลาแต่ละขั้นเป็น JSON"""
+    timings = {"interpreter": time.time() - float(os.environ["COLDSTART_SPAWNED_AT"])}
+    # จอง port ให้ LINE API จำลองก่อน แต่ import ตัวทดสอบ (numpy, urllib3) หลังโหลด app ไม่ให้เวลา import app ดูน้อยเกินจริง
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    os.environ["LINE_REPLY_URL"] = f"http://127.0.0.1:{port}/v2/bot/message/reply"
+
+    started = time.perf_counter()
+    from app_loader import load_app
+    bot = load_app()
+    timings["import_app"] = time.perf_counter() - started
+    print(APP_LOADED_MARKER, file=sys.stderr, flush=True)
+
+    from loadtest import StubLineApi, WebhookClient
+    stub = StubLineApi(port)
+    stub.start()
+    client = bot.app.test_client()
+    webhook = WebhookClient("http://unused", os.environ["LINE_CHANNEL_SECRET"], 1)
+    for stage, text in zip(("first_text_reply", "first_carousel_reply"), FIRST_MESSAGES):
+        token = f"coldstart-{stage}"
+        waiter = stub.expect(token)
+        body = json.dumps(webhook.event("Ucoldstart", text, token), ensure_ascii=False).encode("utf-8")
+        started = time.perf_counter()
+        response = client.post("/callback", data=body, headers={
+            "Content-Type": "application/json", "X-Line-Signature": webhook.sign(body),
+        })
+        if response.status_code != 200 or not waiter[0].wait(30):
+            sys.exit(f"{stage}: ไม่ได้คำตอบ (HTTP {response.status_code})")
+        timings[stage] = waiter[1] - started
+    timings["picker_snapshot"] = os.path.exists(bot.PICKER_SNAPSHOT_PATH) and bool(bot.PICKER_CACHE)
+    timings["messaging_sdk_imported"] = "linebot.v3.messaging" in sys.modules
+    stub.stop()
+    print(json.dumps(timings))
+
+
+def parse_importtime(stderr):
+    """แปลงผลของ -X importtime เป็น [(module, self_us, cumulative_us, depth)] เฉพาะที่ import ก่อน app โหลดเสร็จ"""
+    rows = []
+    for line in stderr.splitlines():
+        if line == APP_LOADED_MARKER:
+            break
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def profile(top):
+    env = dict(os.environ)
+    env.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "coldstart-token")
+    env.setdefault("LINE_CHANNEL_SECRET", "test-secret")
+    env["COLDSTART_SPAWNED_AT"] = repr(time.time())
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.abspath(__file__), "_first-callback"],
+        capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        sys.exit(f"process ลูกล้มเหลว:\n{result.stderr[-2000:]}\n{result.stdout}")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    rows = parse_importtime(result.stderr)
+
+    # package ระดับบนสุด (depth 1) ที่ app import เอง รวมเวลาตาม package หลัก
+    packages = {}
+    for name, _, cumulative_us, depth in rows:
+        if depth == 1:
+            root = name.split(".")[0]
+            packages[root] = packages.get(root, 0) + cumulative_us
+    slowest = sorted(rows, key=lambda row: row[2], reverse=True)[:top]
+
+    print("เวลา cold start (process ใหม่, รวม overhead ของ -X importtime)")
+    for stage in STAGES:
+        print(f"  {stage:<22}{timings[stage] * 1000:>10.1f} ms")
+    total = sum(timings[stage] for stage in STAGES[:3])
+    print(f"  {'จนตอบข้อความแรก':<22}{total * 1000:>10.1f} ms")
+    print(f"\npicker snapshot: {'ใช้' if timings['picker_snapshot'] else 'ไม่มี (python coldstart.py build)'}, "
+          f"linebot.v3.messaging ถูก import: {'ใช่' if timings['messaging_sdk_imported'] else 'ไม่'}")
+
+    print("\nเวลา import ตาม package (cumulative)")
+    for root, cumulative_us in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f"  {root:<40}{cumulative_us / 1000:>10.1f} ms")
+    print(f"\nmodule ที่ใช้เวลา import มากที่สุด {top} อันดับ (cumulative / self)")
+    for name, self_us, cumulative_us, _ in slowest:
+        print(f"  {name:<60}{cumulative_us / 1000:>10.1f}{self_us / 1000:>10.1f} ms")
+
+    return {
+        "timings_ms": {stage: round(timings[stage] * 1000, 1) for stage in STAGES},
+        "picker_snapshot": timings["picker_snapshot"],
+        "messaging_sdk_imported": timings["messaging_sdk_imported"],
+        "packages_ms": {root: round(us / 1000, 1) for root, us in packages.items()},
+        "modules": [{"module": name, "self_ms": round(s / 1000, 2), "cumulative_ms": round(c / 1000, 2)} for name, s, c, _ in slowest],
+    }
+
+
+def build():
+    os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "coldstart-token")
+    os.environ.setdefault("LINE_CHANNEL_SECRET", "coldstart-secret")
+    from app_loader import load_app
+    bot = load_app()  # เขียน snapshot ตารางยา (formulary.bin) ให้ถ้ายังไม่มีหรือเก่ากว่าต้นฉบับ
+    count = bot.save_picker_snapshot()
+    print(f"✅ snapshot ตารางยา: {bot.FORMULARY_SNAPSHOT_PATH}")
+    print(f"✅ picker snapshot ({count} ชุด): {bot.PICKER_SNAPSHOT_PATH}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="เตรียมและวัด cold start")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("build", help="สร้าง snapshot ตารางยาและ picker ไว้ล่วงหน้า")
+    profile_parser = commands.add_parser("profile", help="วัดเวลา import และเวลาจนถึง /callback แรกตอบ")
+    profile_parser.add_argument("--top", type=int, default=15)
+    profile_parser.add_argument("--json", help="บันทึกผลเป็น JSON")
+    commands.add_parser("_first-callback")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        build()
+    elif args.command == "_first-callback":
+        first_callback()
+    else:
+        report = profile(args.top)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
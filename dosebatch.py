@@ -0,0 +1,174 @@
+"""
+คำนวณขนาดยาเป็นชุดจากไฟล์ CSV หรือ Parquet แบบ offline (เช่น audit ใบสั่งยาย้อนหลังหลักหมื่นใบ)
+ใช้ calculate_dose / calculate_special_drug ตัวเดียวกับ bot ไม่ต้องมี LINE_CHANNEL_ACCESS_TOKEN
+
+    python dosebatch.py prescriptions.csv -o doses.ndjson
+    python dosebatch.py prescriptions.parquet -o doses.ndjson --workers 8 --chunk-rows 1000
+    python dosebatch.py prescriptions.csv --locale th > doses.ndjson   # ใส่ข้อความแบบที่ตอบใน LINE มาด้วย
+
+column ที่อ่าน: drug, indication, weight, age (ต้องมีสำหรับยาใน SPECIAL_DRUGS), entry (ไม่บังคับ),
+id (ไม่บังคับ ถ้าไม่มีใช้ลำดับแถวเริ่มที่ 1)
+ผลเป็น NDJSON 1 บรรทัดต่อแถว เรียงตามไฟล์ต้นทาง รูปแบบเดียวกับ /api/dose
+
+อ่านไฟล์ทีละชุด (--chunk-rows) ส่งแต่ละชุดเข้า process pool ค้างได้ไม่เกิน 2 ชุดต่อ worker
+แล้วเขียนผลทีละชุดตามลำดับ หน่วยความจำจึงคงที่ไม่ว่าไฟล์จะใหญ่แค่ไหน
+Parquet ต้องติดตั้ง pyarrow
+"""
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+
+from app_loader import load_app
+
+PROGRESS_SECONDS = 1.0
+NUMBER_COLUMNS = {"weight": float, "age": float, "entry": int}
+
+
+def coerce_row(row):
+    """ค่าจาก CSV เป็นข้อความทั้งหมด: แปลง weight/age/entry เป็นตัวเลข (ช่องว่าง = ไม่มีค่า, แปลงไม่ได้ = ปล่อยให้แถวนั้น error)"""
+    for column, convert in NUMBER_COLUMNS.items():
+        value = row.get(column)
+        if isinstance(value, str):
+            value = value.strip()
+            try:
+                row[column] = convert(value) if value else None
+            except ValueError:
+                row[column] = value
+    return row
+
+
+def read_csv_chunks(path, chunk_rows):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        rows = csv.DictReader(f)
+        while True:
+            chunk = [coerce_row(row) for row in itertools.islice(rows, chunk_rows)]
+            if not chunk:
+                return
+            yield chunk
+
+
+def read_parquet_chunks(path, chunk_rows):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        sys.exit("อ่าน Parquet ต้องติดตั้ง pyarrow ก่อน: pip install pyarrow")
+    parquet = pq.ParquetFile(path)
+    columns = [name for name in ("id", "drug", "indication", "weight", "age", "entry") if name in parquet.schema_arrow.names]
+    for batch in parquet.iter_batches(batch_size=chunk_rows, columns=columns):
+        yield [coerce_row(row) for row in batch.to_pylist()]
+
+
+def read_chunks(path, chunk_rows, input_format=None):
+    """แต่ละชุดเป็น list ของ dict ต่อแถว ใส่ id เป็นลำดับแถวให้แถวที่ไม่มี id"""
+    if (input_format or os.path.splitext(path)[1].lstrip(".").lower()) == "parquet":
+        chunks = read_parquet_chunks(path, chunk_rows)
+    else:
+        chunks = read_csv_chunks(path, chunk_rows)
+    line = 0
+    for chunk in chunks:
+        for row in chunk:
+            line += 1
+            if row.get("id") in (None, ""):
+                row["id"] = line
+        yield chunk
+
+
+class Progress:
+    """พิมพ์จำนวนแถวและ rows/s ลง stderr ทุก PROGRESS_SECONDS (stdout อาจเป็นผลลัพธ์)"""
+
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self.started = self.reported = time.perf_counter()
+        self.rows = 0
+        self.errors = 0
+
+    def add(self, rows, ok):
+        self.rows += rows
+        self.errors += rows - ok
+        now = time.perf_counter()
+        if not self.quiet and now - self.reported >= PROGRESS_SECONDS:
+            self.reported = now
+            self.report()
+
+    def report(self, final=False):
+        elapsed = time.perf_counter() - self.started
+        rate = self.rows / elapsed if elapsed else 0
+        icon = "✅" if final else "⏳"
+        print(f"\r{icon} {self.rows:,} แถว (error {self.errors:,}) {rate:,.0f} rows/s {elapsed:.1f} s",
+              end="\n" if final else "", file=sys.stderr, flush=True)
+
+
+def evaluate_chunks(bot, chunks, workers, locale):
+    """คืน (บรรทัด NDJSON ของชุด, จำนวนแถวที่ ok, จำนวนแถว) ตามลำดับชุดในไฟล์"""
+    if workers == 0:
+        for chunk in chunks:
+            yield (*bot.evaluate_dose_rows(chunk, locale), len(chunk))
+        return
+    # fork: process ลูกได้ตารางยาที่โหลดแล้วไปเลย ไม่ต้องโหลด app-2.py ใหม่
+    # รายการ audit ของลูกส่งกลับมาให้ process นี้เขียน (merge_dose_pool_result)
+    pool = bot.DoseApiPool(workers)
+    try:
+        in_flight = deque()
+        for chunk in chunks:
+            in_flight.append((pool.submit(chunk, locale), len(chunk)))
+            while len(in_flight) > workers * 2:
+                future, rows = in_flight.popleft()
+                yield (*bot.merge_dose_pool_result(future.result()), rows)
+        while in_flight:
+            future, rows = in_flight.popleft()
+            yield (*bot.merge_dose_pool_result(future.result()), rows)
+    finally:
+        pool.shutdown()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="คำนวณขนาดยาเป็นชุดจาก CSV/Parquet (offline)")
+    parser.add_argument("input", help="ไฟล์ .csv หรือ .parquet")
+    parser.add_argument("-o", "--output", default="-", help="ไฟล์ NDJSON ที่จะเขียน (- = stdout)")
+    parser.add_argument("--format", choices=("csv", "parquet"), help="ชนิดไฟล์ (ค่าเริ่มต้นดูจากนามสกุล)")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="จำนวน process (0 = คำนวณใน process นี้)")
+    parser.add_argument("--chunk-rows", type=int, default=1000, help="จำนวนแถวต่อชุดที่ส่งให้แต่ละ process")
+    parser.add_argument("--locale", help="ใส่ข้อความตอบกลับแบบ LINE ในภาษานี้ (th/en) มาด้วย")
+    parser.add_argument("--quiet", action="store_true", help="ไม่แสดงความคืบหน้า")
+    args = parser.parse_args(argv)
+    if args.workers < 0 or args.chunk_rows < 1:
+        parser.error("--workers ต้อง ≥ 0 และ --chunk-rows ต้อง ≥ 1")
+    if not os.path.isfile(args.input):
+        parser.error(f"ไม่พบไฟล์ {args.input}")
+    if not os.access(args.input, os.R_OK):
+        parser.error(f"อ่านไฟล์ {args.input} ไม่ได้ (ไม่มีสิทธิ์)")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    bot = load_app(offline=True)
+    if args.locale is not None and args.locale not in bot.COMPILED_TEMPLATES:
+        sys.exit(f"ไม่รองรับ locale {args.locale} (ใช้ได้: {', '.join(bot.COMPILED_TEMPLATES)})")
+
+    progress = Progress(quiet=args.quiet)
+    chunks = read_chunks(args.input, args.chunk_rows, args.format)
+    try:
+        output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    except OSError as e:
+        sys.exit(f"เปิดไฟล์ผลลัพธ์ {args.output} ไม่ได้: {e.strerror}")
+    try:
+        for text, ok, rows in evaluate_chunks(bot, chunks, args.workers, args.locale):
+            output.write(text)
+            progress.add(rows, ok)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    progress.report(final=True)
+    if args.output != "-":
+        print(f"💾 บันทึกผลที่ {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
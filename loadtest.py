@@ -0,0 +1,365 @@
+"""
+ทดสอบโหลด webhook แบบครบวงจร: ยิง event ที่เซ็นด้วย secret ทดสอบเข้า /callback
+แล้ววัดเวลาจนถึงตอนที่ bot ตอบกลับมาถึง LINE Messaging API จำลองในเครื่อง
+
+    python loadtest.py --rate 20 --duration 30                       # เปิด bot (Flask) ใน process นี้เอง
+    python loadtest.py --rate 50 --mix warfarin=1,antibiotic=3,special=2 --json result.json
+    LINE_REPLY_URL=http://127.0.0.1:8089/v2/bot/message/reply python serve.py --bind 127.0.0.1:5000 &
+    python loadtest.py --target http://127.0.0.1:5000 --api-port 8089  # ยิงเข้า server ที่เปิดแยกไว้
+
+--rate คือจำนวนบทสนทนาที่เริ่มใหม่ต่อวินาที (มาถึงแบบ Poisson) แต่ละบทสนทนาเป็นผู้ใช้หนึ่งคน
+ที่ส่งข้อความถัดไปหลังได้คำตอบของข้อความก่อนหน้า เหมือนผู้ใช้จริง
+ทั้งสองฝั่งต้องใช้ LINE_CHANNEL_SECRET เดียวกัน (ค่าเริ่มต้น test-secret)
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import urllib3
+
+FLOWS = ("warfarin", "antibiotic", "special")
+PERCENTILES = (50, 95, 99)
+
+
+class StubLineApi:
+    """LINE Messaging API จำลอง: รับ reply แล้วบันทึกเวลาที่มาถึงตาม replyToken"""
+
+    def __init__(self, port=0, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.waiters = {}
+        self.lock = threading.Lock()
+        self.received = 0
+        self.failed = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive ให้ connection pool ของ bot ใช้ต่อได้
+            wbufsize = -1  # เขียน header กับ body ออกไปทีเดียว ไม่ให้ Nagle/delayed ACK หน่วงเพิ่ม ~40ms
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if stub.error_rate and random.random() < stub.error_rate:
+                    with stub.lock:
+                        stub.failed += 1
+                    self.respond(500, b'{"message":"stub error"}')
+                    return
+                token = json.loads(body).get("replyToken")
+                with stub.lock:
+                    stub.received += 1
+                    waiter = stub.waiters.get(token)
+                if waiter is not None:
+                    waiter[1] = time.perf_counter()
+                    waiter[0].set()
+                self.respond(200, b"{}")
+
+            def respond(self, status, payload):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v2/bot/message/reply"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def expect(self, token):
+        waiter = [threading.Event(), None]
+        with self.lock:
+            self.waiters[token] = waiter
+        return waiter
+
+    def forget(self, token):
+        with self.lock:
+            self.waiters.pop(token, None)
+
+
+class WebhookClient:
+    """สร้าง event ข้อความแบบเดียวกับที่ LINE ส่งมา เซ็น X-Line-Signature แล้ว POST เข้า /callback"""
+
+    def __init__(self, target, secret, pool_size):
+        self.url = target.rstrip("/") + "/callback"
+        self.secret = secret.encode("utf-8")
+        self.http = urllib3.PoolManager(maxsize=pool_size, block=True, retries=False)
+        self.ids = itertools.count(1)
+        self.run_id = os.urandom(4).hex()  # webhookEventId ต้องไม่ซ้ำกับรอบก่อน ไม่เช่นนั้น bot ทิ้งเป็น event ซ้ำ
+
+    def sign(self, body):
+        return base64.b64encode(hmac.new(self.secret, body, hashlib.sha256).digest()).decode("ascii")
+
+    def event(self, user_id, text, reply_token):
+        n = next(self.ids)
+        return {
+            "destination": "Uloadtest",
+            "events": [{
+                "type": "message",
+                "mode": "active",
+                "timestamp": int(time.time() * 1000),
+                "webhookEventId": f"loadtest-{self.run_id}-{n}",
+                "deliveryContext": {"isRedelivery": False},
+                "replyToken": reply_token,
+                "source": {"type": "user", "userId": user_id},
+                "message": {"type": "text", "id": str(n), "quoteToken": f"q{n}", "text": text},
+            }],
+        }
+
+    def post(self, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        response = self.http.request(
+            "POST", self.url, body=body,
+            headers={"Content-Type": "application/json", "X-Line-Signature": self.sign(body)},
+        )
+        return response.status
+
+
+def load_formulary_names(path):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    drugs = {name: list(info["indications"]) for name, info in data["drugs"].items()}
+    special = {name: list(info["indications"]) for name, info in data["special_drugs"].items()}
+    return drugs, special
+
+
+def make_conversation(flow, drugs, special, rng):
+    """ข้อความที่ผู้ใช้หนึ่งคนพิมพ์ตามลำดับในแต่ละ flow"""
+    weight = f"{rng.uniform(3, 40):.1f} กก"
+    if flow == "warfarin":
+        return [
+            "คำนวณยา warfarin",
+            f"{rng.choice((1.3, 1.8, 2.5, 3.4, 4.2, 5.6)):.1f}",
+            str(rng.choice((14, 21, 28, 35, 42))),
+            rng.choice(("no", "no", "no", "yes")),
+        ]
+    if flow == "antibiotic":
+        drug = rng.choice(list(drugs))
+        return ["คำนวณยาเด็ก", f"เลือกยา: {drug}", f"Indication: {rng.choice(drugs[drug])}", weight]
+    drug = rng.choice(list(special))
+    return [
+        "คำนวณยาเด็ก", f"เลือกยา: {drug}", f"Indication: {rng.choice(special[drug])}",
+        f"{rng.randint(0, 17)} ปี {rng.randint(0, 11)} เดือน", weight,
+    ]
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ack = {flow: [] for flow in FLOWS}
+        self.reply = {flow: [] for flow in FLOWS}
+        self.errors = {flow: 0 for flow in FLOWS}
+        self.timeouts = {flow: 0 for flow in FLOWS}
+        self.conversations = {flow: 0 for flow in FLOWS}
+
+    def add(self, flow, ack, reply):
+        with self.lock:
+            self.ack[flow].append(ack)
+            if reply is None:
+                self.timeouts[flow] += 1
+            else:
+                self.reply[flow].append(reply)
+
+    def error(self, flow):
+        with self.lock:
+            self.errors[flow] += 1
+
+    def done(self, flow):
+        with self.lock:
+            self.conversations[flow] += 1
+
+
+def run_conversation(flow, messages, user_id, client, stub, results, reply_timeout, think):
+    for i, text in enumerate(messages):
+        token = f"{user_id}-{i}"
+        waiter = stub.expect(token)
+        start = time.perf_counter()
+        try:
+            status = client.post(client.event(user_id, text, token))
+        except Exception:
+            status = None
+        ack = time.perf_counter() - start
+        if status != 200:
+            stub.forget(token)
+            results.error(flow)
+            return
+        waiter[0].wait(reply_timeout)
+        stub.forget(token)
+        results.add(flow, ack, waiter[1] - start if waiter[1] is not None else None)
+        if waiter[1] is None:
+            return  # ไม่ได้คำตอบ ผู้ใช้จริงก็คงไม่พิมพ์ต่อ
+        if think:
+            time.sleep(think)
+    results.done(flow)
+
+
+def parse_mix(text):
+    weights = dict.fromkeys(FLOWS, 0.0)
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in weights:
+            raise argparse.ArgumentTypeError(f"ไม่รู้จัก flow '{name}' (มี {', '.join(FLOWS)})")
+        weights[name] = float(weight or 1)
+    if not any(weights.values()):
+        raise argparse.ArgumentTypeError("ต้องมีอย่างน้อยหนึ่ง flow ที่น้ำหนักมากกว่า 0")
+    return weights
+
+
+def percentiles_ms(samples):
+    if not samples:
+        return {f"p{p}": None for p in PERCENTILES}
+    values = np.percentile(np.asarray(samples) * 1000, PERCENTILES)
+    return {f"p{p}": round(float(v), 2) for p, v in zip(PERCENTILES, values)}
+
+
+def summarize(results, elapsed, stub):
+    rows = {}
+    for flow in FLOWS + ("all",):
+        flows = FLOWS if flow == "all" else (flow,)
+        ack = [s for f in flows for s in results.ack[f]]
+        reply = [s for f in flows for s in results.reply[f]]
+        rows[flow] = {
+            "conversations": sum(results.conversations[f] for f in flows),
+            "messages": len(ack),
+            "errors": sum(results.errors[f] for f in flows),
+            "timeouts": sum(results.timeouts[f] for f in flows),
+            "messages_per_second": round(len(reply) / elapsed, 2) if elapsed else 0.0,
+            "ack_ms": percentiles_ms(ack),
+            "reply_ms": percentiles_ms(reply),
+        }
+    return {"elapsed_seconds": round(elapsed, 2), "stub_replies": stub.received, "stub_errors": stub.failed, "flows": rows}
+
+
+def print_summary(summary):
+    def fmt(value):
+        return "-" if value is None else f"{value:.1f}"
+
+    print(f"\nระยะเวลา {summary['elapsed_seconds']} วินาที, LINE API จำลองรับ reply {summary['stub_replies']} ครั้ง"
+          f" (ตอบ error {summary['stub_errors']})")
+    header = f"{'flow':<11}{'convs':>7}{'msgs':>7}{'err':>5}{'t/o':>5}{'msg/s':>9}" \
+             f"{'ack p50':>9}{'p95':>8}{'p99':>8}{'reply p50':>11}{'p95':>8}{'p99':>8}"
+    print(header)
+    print("-" * len(header))
+    for flow, row in summary["flows"].items():
+        ack, reply = row["ack_ms"], row["reply_ms"]
+        print(f"{flow:<11}{row['conversations']:>7}{row['messages']:>7}{row['errors']:>5}{row['timeouts']:>5}"
+              f"{row['messages_per_second']:>9.1f}"
+              f"{fmt(ack['p50']):>9}{fmt(ack['p95']):>8}{fmt(ack['p99']):>8}"
+              f"{fmt(reply['p50']):>11}{fmt(reply['p95']):>8}{fmt(reply['p99']):>8}")
+    print("(เวลาเป็นมิลลิวินาที: ack = จน /callback ตอบ 200, reply = จน reply ถึง LINE API จำลอง)")
+
+
+def start_local_bot(stub_url):
+    """เปิด bot ใน process นี้ (Flask + werkzeug แบบ threaded) โดยชี้ reply ไปที่ LINE API จำลอง"""
+    os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "loadtest-token")
+    os.environ.setdefault("LINE_CHANNEL_SECRET", "test-secret")
+    os.environ["LINE_REPLY_URL"] = stub_url
+    from werkzeug.serving import make_server
+    from app_loader import load_app
+
+    bot = load_app()
+    bot.warm_picker_cache()  # วัดสภาวะปกติ: ไม่ให้ carousel แรกที่ต้อง import SDK ไปปนใน p99 (cold start วัดด้วย coldstart.py)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, bot.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ทดสอบโหลด webhook กับ LINE API จำลอง")
+    parser.add_argument("--target", help="URL ของ bot ที่เปิดอยู่แล้ว (ไม่ใส่ = เปิด bot ใน process นี้)")
+    parser.add_argument("--rate", type=float, default=10.0, help="บทสนทนาที่เริ่มใหม่ต่อวินาที")
+    parser.add_argument("--duration", type=float, default=20.0, help="ระยะเวลาที่เริ่มบทสนทนาใหม่ (วินาที)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("warfarin=1,antibiotic=2,special=1"),
+                        help="สัดส่วนของแต่ละ flow เช่น warfarin=1,antibiotic=2,special=1")
+    parser.add_argument("--concurrency", type=int, default=200, help="จำนวนผู้ใช้พร้อมกันสูงสุด")
+    parser.add_argument("--think", type=float, default=0.0, help="เวลาที่ผู้ใช้คิดก่อนพิมพ์ข้อความถัดไป (วินาที)")
+    parser.add_argument("--reply-timeout", type=float, default=10.0)
+    parser.add_argument("--api-port", type=int, default=0, help="port ของ LINE API จำลอง (ต้องระบุเมื่อใช้ --target)")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="หน่วงการตอบของ LINE API จำลอง (มิลลิวินาที)")
+    parser.add_argument("--api-error-rate", type=float, default=0.0, help="สัดส่วน reply ที่ LINE API จำลองตอบ 500")
+    parser.add_argument("--secret", default=os.environ.get("LINE_CHANNEL_SECRET", "test-secret"))
+    parser.add_argument("--formulary", default=os.environ.get(
+        "FORMULARY_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "formulary.json")))
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", help="บันทึกผลเป็น JSON ไว้เทียบกับรอบอื่น")
+    args = parser.parse_args(argv)
+    if args.target and not args.api_port:
+        parser.error("ใช้ --target ต้องระบุ --api-port ให้ตรงกับ LINE_REPLY_URL ของ server นั้น")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    rng = random.Random(args.seed)
+
+    stub = StubLineApi(args.api_port, args.api_latency / 1000, args.api_error_rate)
+    stub.start()
+    server = None
+    if args.target:
+        target = args.target
+    else:
+        server, target = start_local_bot(stub.url)
+    print(f"🎯 bot {target}, LINE API จำลอง {stub.url}")
+
+    drugs, special = load_formulary_names(args.formulary)
+    flows = [flow for flow in FLOWS if args.mix[flow] > 0]
+    weights = [args.mix[flow] for flow in flows]
+    client = WebhookClient(target, args.secret, args.concurrency)
+    results = Results()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        next_start = start
+        for n in itertools.count():
+            next_start += rng.expovariate(args.rate)
+            if next_start - start > args.duration:
+                break
+            delay = next_start - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            flow = rng.choices(flows, weights)[0]
+            executor.submit(
+                run_conversation, flow, make_conversation(flow, drugs, special, rng), f"Uloadtest{n:08d}",
+                client, stub, results, args.reply_timeout, args.think,
+            )
+    elapsed = time.perf_counter() - start
+
+    summary = summarize(results, elapsed, stub)
+    print_summary(summary)
+    if args.json:
+        summary["args"] = {key: value for key, value in vars(args).items() if key != "secret"}
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    if server is not None:
+        server.shutdown()
+    stub.stop()
+    return 1 if summary["flows"]["all"]["errors"] or summary["flows"]["all"]["timeouts"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
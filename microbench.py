@@ -0,0 +1,288 @@
+"""
+microbenchmark ของตัวคำนวณขนาดยา: calculate_dose ทุก (ยา, ข้อบ่งใช้) ใน DRUG_DATABASE
+และ calculate_special_drug ทุกข้อบ่งใช้ × ทุกกลุ่มอายุใน SPECIAL_DRUGS ไล่ตามช่วงน้ำหนัก
+
+    python microbench.py                                   # รันทั้งหมด แสดงตาราง
+    python microbench.py --filter Amoxicillin --weights 5:30:5
+    python microbench.py --save baseline.json              # เก็บเป็น baseline
+    python microbench.py --compare baseline.json           # เทียบกับ baseline, exit 1 ถ้าช้าลงเกิน --threshold
+
+แต่ละกรณีวัด 3 ค่า
+  cold ns/call  คำนวณจริงและสร้างข้อความใหม่ (ข้าม lru_cache ของผลคำนวณและข้อความที่เก็บไว้ใน result)
+  warm ns/call  เรียกผ่านฟังก์ชันที่ bot ใช้จริง (calculate_* + render_reply) ซึ่งตอบจาก cache (รวม metrics)
+  alloc B/call  หน่วยความจำชั่วคราวสูงสุดต่อการคำนวณหนึ่งครั้ง (tracemalloc, cold)
+และท้ายตารางมี peak memory ของการคำนวณทั้งชุด
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+from contextlib import contextmanager
+
+from app_loader import load_app
+
+DEFAULT_WEIGHTS = "3:40:2.5"
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.10
+FIELDS = ("cold_ns", "warm_ns", "alloc_bytes")
+MIN_RUN_SECONDS = 0.02  # เวลาขั้นต่ำต่อรอบวัด (timeit.autorange ใช้ 0.2 วินาที ช้าเกินไปสำหรับ ~70 กรณี)
+
+
+class Case:
+    """กรณีทดสอบหนึ่งกรณี: ฟังก์ชันคำนวณแบบ cold และ warm ที่รับน้ำหนักเป็น argument"""
+    __slots__ = ("key", "cold", "warm")
+
+    def __init__(self, key, cold, warm):
+        self.key = key
+        self.cold = cold
+        self.warm = warm
+
+
+def parse_weights(text):
+    try:
+        start, stop, step = (float(part) for part in text.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("ใช้รูปแบบ start:stop:step เช่น 3:40:2.5")
+    if step <= 0 or stop < start:
+        raise argparse.ArgumentTypeError("step ต้องมากกว่า 0 และ stop ต้องไม่น้อยกว่า start")
+    count = int(round((stop - start) / step)) + 1
+    return tuple(round(start + i * step, 1) for i in range(count))
+
+
+def band_age(rule):
+    """อายุตัวแทนของกลุ่ม: กึ่งกลางช่วง หรือขอบล่าง +1 ปีถ้าไม่มีขอบบน"""
+    if rule.basis != "age":
+        return 5.0
+    if rule.hi == float("inf"):
+        return float(rule.lo + 1)
+    return round((rule.lo + rule.hi) / 2, 2)
+
+
+def build_cases(bot):
+    cases = []
+    templates = bot.COMPILED_TEMPLATES[bot.REPLY_LOCALE]
+
+    def render(result):
+        # ข้าม result.rendered: สร้างข้อความใหม่ทุกครั้ง
+        return bot.RENDERERS[type(result)](result, templates)
+
+    for drug_name, drug_info in bot.DRUG_DATABASE.items():
+        for indication in drug_info["indications"]:
+            cases.append(Case(
+                f"dose/{drug_name}/{indication}",
+                lambda w, d=drug_name, i=indication: render(bot._calculate_dose.__wrapped__(bot.TABLES_VERSION, d, i, w)),
+                lambda w, d=drug_name, i=indication: bot.render_reply(bot.calculate_dose(d, i, w)),
+            ))
+    for drug_name, drug_info in bot.SPECIAL_DRUGS.items():
+        for indication in drug_info["indications"]:
+            for rule in bot.SPECIAL_RULES.get((drug_name, indication), ()):
+                band = rule.group or f"{rule.lo}-{rule.hi}y"
+                age = band_age(rule)
+                cases.append(Case(
+                    f"special/{drug_name}/{indication}/{band}",
+                    lambda w, d=drug_name, i=indication, a=age: render(bot._calculate_special_drug(d, i, w, a)),
+                    lambda w, d=drug_name, i=indication, a=age: bot.render_reply(bot.calculate_special_drug(d, i, w, a)),
+                ))
+    return cases
+
+
+@contextmanager
+def uncached_special_body(bot):
+    """ให้ _calculate_special_drug คำนวณ SpecialDose ใหม่ (ไม่ผ่าน lru_cache) ระหว่างวัด cold"""
+    cached = bot._special_drug_body
+    bot._special_drug_body = cached.__wrapped__
+    try:
+        yield
+    finally:
+        bot._special_drug_body = cached
+
+
+def time_per_call(fn, weights, repeat):
+    def run():
+        for w in weights:
+            fn(w)
+
+    timer = timeit.Timer(run)  # timeit ปิด GC ระหว่างวัดให้อยู่แล้ว
+    number = 1
+    while timer.timeit(number) < MIN_RUN_SECONDS:
+        number *= 2
+    best = min(timer.repeat(repeat, number))
+    return best / (number * len(weights)) * 1e9
+
+
+def alloc_per_call(fn, weights):
+    """ค่าเฉลี่ยของ peak หน่วยความจำชั่วคราวต่อการเรียกหนึ่งครั้ง (ต้องเปิด tracemalloc ไว้แล้ว)"""
+    total = 0
+    for w in weights:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        result = fn(w)
+        total += tracemalloc.get_traced_memory()[1] - before
+        del result
+    return total / len(weights)
+
+
+def run_suite(bot, cases, weights, repeat):
+    results = {}
+    with uncached_special_body(bot):
+        for case in cases:
+            results[case.key] = {"cold_ns": time_per_call(case.cold, weights, repeat)}
+    for case in cases:
+        case.warm(weights[0])  # เติม cache ก่อนวัด warm
+        results[case.key]["warm_ns"] = time_per_call(case.warm, weights, repeat)
+
+    tracemalloc.start()
+    try:
+        with uncached_special_body(bot):
+            for case in cases:
+                results[case.key]["alloc_bytes"] = alloc_per_call(case.cold, weights)
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            kept = [case.cold(w) for case in cases for w in weights]
+            peak = tracemalloc.get_traced_memory()[1] - baseline
+            del kept
+    finally:
+        tracemalloc.stop()
+
+    for row in results.values():
+        for field in FIELDS:
+            row[field] = round(row[field], 1)
+    return results, peak
+
+
+def describe_environment(bot, weights, repeat):
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "formulary": os.path.basename(bot.FORMULARY_PATH),
+        "weights": list(weights),
+        "repeat": repeat,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def print_results(results, peak, calls):
+    width = max(len(key) for key in results) + 2
+    print(f"{'case':<{width}}{'cold ns/call':>14}{'warm ns/call':>14}{'alloc B/call':>14}")
+    print("-" * (width + 42))
+    for key, row in results.items():
+        print(f"{key:<{width}}{row['cold_ns']:>14,.0f}{row['warm_ns']:>14,.0f}{row['alloc_bytes']:>14,.0f}")
+    print(f"\n{len(results)} กรณี, คำนวณ cold ทั้งชุด {calls} ครั้ง: peak memory {peak / 1024:,.1f} KiB")
+
+
+def compare(results, peak, baseline, threshold, strict=False):
+    """
+    พิมพ์ส่วนต่างจาก baseline คืนรายการที่แย่ลงเกิน threshold
+    ตัดสินจาก geometric mean ของอัตราส่วนทุกกรณี (เวลารายกรณีแกว่งได้มากบนเครื่องที่มีงานอื่น)
+    ถ้า strict ให้นับรายกรณีด้วย
+    """
+    old_cases = baseline["cases"]
+    width = max(len(key) for key in results) + 2
+    print(f"{'case':<{width}}{'cold':>10}{'warm':>10}{'alloc':>10}")
+    print("-" * (width + 30))
+    log_ratios = {field: [] for field in FIELDS}
+    regressions = []
+    for key, row in results.items():
+        old = old_cases.get(key)
+        if old is None:
+            print(f"{key:<{width}}{'(ใหม่)':>10}")
+            continue
+        cells = []
+        for field in FIELDS:
+            if old[field] and row[field]:
+                log_ratios[field].append(math.log(row[field] / old[field]))
+            change = (row[field] - old[field]) / old[field] if old[field] else 0.0
+            mark = ""
+            if change > threshold:
+                mark = "!"
+                if strict:
+                    regressions.append((key, field, change))
+            cells.append(f"{change:+.1%}{mark}")
+        print(f"{key:<{width}}" + "".join(f"{cell:>10}" for cell in cells))
+    for key in old_cases.keys() - results.keys():
+        print(f"{key:<{width}}{'(หายไป)':>10}")
+
+    print()
+    for field, logs in log_ratios.items():
+        if not logs:
+            continue
+        change = math.exp(sum(logs) / len(logs)) - 1
+        print(f"geomean {field:<12}{change:+.1%}")
+        if change > threshold:
+            regressions.append(("geomean", field, change))
+    old_peak = baseline.get("peak_bytes")
+    if old_peak:
+        change = (peak - old_peak) / old_peak
+        print(f"peak memory {old_peak / 1024:,.1f} → {peak / 1024:,.1f} KiB ({change:+.1%})")
+        if change > threshold:
+            regressions.append(("peak_memory", "peak_bytes", change))
+    if baseline.get("environment", {}).get("python") != platform.python_version():
+        print(f"⚠️ baseline วัดบน Python {baseline.get('environment', {}).get('python')} ผลอาจเทียบกันไม่ได้")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="microbenchmark ของตัวคำนวณขนาดยา")
+    parser.add_argument("--weights", type=parse_weights, default=parse_weights(DEFAULT_WEIGHTS),
+                        help=f"ช่วงน้ำหนัก start:stop:step (kg) ค่าเริ่มต้น {DEFAULT_WEIGHTS}")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="จำนวนรอบวัด (เอาค่าที่เร็วที่สุด)")
+    parser.add_argument("--filter", help="วัดเฉพาะกรณีที่ชื่อมีข้อความนี้")
+    parser.add_argument("--save", help="บันทึกผลเป็นไฟล์ baseline (JSON)")
+    parser.add_argument("--compare", help="เทียบกับไฟล์ baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="สัดส่วนที่ถือว่าแย่ลง เช่น 0.1 = ช้าลงเกิน 10%%")
+    parser.add_argument("--strict", action="store_true", help="นับกรณีเดี่ยวที่แย่ลงเกิน threshold เป็น regression ด้วย")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "microbench-token")
+    os.environ.setdefault("LINE_CHANNEL_SECRET", "microbench-secret")
+    bot = load_app()
+
+    cases = build_cases(bot)
+    if args.filter:
+        cases = [case for case in cases if args.filter.lower() in case.key.lower()]
+    if not cases:
+        sys.exit("ไม่มีกรณีที่ตรงกับ --filter")
+
+    results, peak = run_suite(bot, cases, args.weights, args.repeat)
+    print_results(results, peak, len(cases) * len(args.weights))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({
+                "environment": describe_environment(bot, args.weights, args.repeat),
+                "peak_bytes": peak,
+                "cases": results,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"💾 บันทึก baseline ที่ {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("environment", {}).get("weights") != list(args.weights):
+            print("⚠️ ช่วงน้ำหนักไม่ตรงกับ baseline")
+        if args.filter:
+            # peak memory ของชุดย่อยเทียบกับทั้งชุดไม่ได้
+            baseline["cases"] = {key: row for key, row in baseline["cases"].items() if args.filter.lower() in key.lower()}
+            baseline.pop("peak_bytes", None)
+        print()
+        regressions = compare(results, peak, baseline, args.threshold, args.strict)
+        if regressions:
+            print(f"\n❌ แย่ลงเกิน {args.threshold:.0%}: " + ", ".join(f"{key} {field}" for key, field, _ in regressions))
+            return 1
+        print(f"\n✅ ไม่แย่ลงเกิน {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+ตัวเปิด server สำหรับ production: โหลด app-2.py และตารางยาที่ compile แล้วใน process แม่ครั้งเดียว
+แล้ว fork worker ออกไป (หน้า memory ที่ไม่ถูกแก้ใช้ร่วมกันแบบ copy-on-write)
+
+    python serve.py --workers 4 --threads 8          # WSGI (Flask) ด้วย gthread worker
+    python serve.py --asgi --workers 2               # ASGI (asgi.py) ด้วย uvicorn worker
+    kill -HUP <pid แม่>                              # reload ตารางยาในแม่ แล้วเปลี่ยน worker ใหม่ทีละชุดแบบ graceful
+
+ต้องติดตั้ง gunicorn (และ uvicorn ถ้าใช้ --asgi)
+"""
+import argparse
+import gc
+import logging
+import multiprocessing
+import os
+import sys
+
+from app_loader import load_app
+
+
+def preload(asgi):
+    # worker เบื้องหลัง (event worker, ตัวเฝ้าไฟล์ตารางยา) เริ่มใน post_fork ของแต่ละ worker ไม่ใช่ในแม่
+    os.environ["SERVER_PREFORK"] = "1"
+    bot = load_app()
+    bot.warm_picker_cache()
+    if asgi:
+        import asgi as asgi_module
+        application = asgi_module.app
+    else:
+        application = bot.app
+    # ย้าย object ที่โหลดแล้วออกจาก GC ไม่ให้ GC ของ worker ไปแตะ (และ copy) หน้า memory ที่แชร์กันอยู่
+    gc.freeze()
+    return bot, application
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="เปิด LINE bot แบบ pre-fork")
+    parser.add_argument("--bind", default=f"0.0.0.0:{os.environ.get('PORT', 5000)}")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count())))
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("WEB_THREADS", 4)),
+                        help="จำนวน thread ต่อ worker (โหมด WSGI)")
+    parser.add_argument("--asgi", action="store_true", help="ใช้ asgi.py กับ uvicorn worker")
+    parser.add_argument("--timeout", type=int, default=int(os.environ.get("WEB_TIMEOUT", 30)))
+    parser.add_argument("--graceful-timeout", type=int, default=int(os.environ.get("WEB_GRACEFUL_TIMEOUT", 30)))
+    parser.add_argument("--max-requests", type=int, default=int(os.environ.get("WEB_MAX_REQUESTS", 0)),
+                        help="เปลี่ยน worker ใหม่หลังรับครบกี่ request (0 = ไม่เปลี่ยน)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        sys.exit("ต้องติดตั้ง gunicorn ก่อน: pip install gunicorn")
+
+    bot, application = preload(args.asgi)
+
+    def post_fork(server, worker):
+        # thread ไม่ติดไปกับ fork: worker แต่ละตัวเริ่ม event worker และตัวเฝ้าไฟล์ตารางยาของตัวเอง
+        # (ASGI ไม่ใช้ event worker: asgi.py ส่ง event เข้า thread pool ของตัวเอง)
+        bot.start_background_workers(event_workers=not args.asgi)
+
+    def on_reload(server):
+        # SIGHUP: reload ตารางยาในแม่ก่อน worker ชุดใหม่จะถูก fork ออกไป
+        try:
+            bot.reload_formulary()
+            bot.warm_picker_cache()
+        except Exception as e:
+            logging.warning(f"⚠️ reload ตารางยาไม่สำเร็จ ใช้ชุดเดิมต่อ: {e}")
+
+    options = {
+        "bind": args.bind,
+        "workers": args.workers,
+        "timeout": args.timeout,
+        "graceful_timeout": args.graceful_timeout,
+        "max_requests": args.max_requests,
+        "max_requests_jitter": args.max_requests // 10,
+        "preload_app": True,
+        "post_fork": post_fork,
+        "on_reload": on_reload,
+    }
+    if args.asgi:
+        options["worker_class"] = "uvicorn.workers.UvicornWorker"
+    else:
+        options["worker_class"] = "gthread"
+        options["threads"] = args.threads
+
+    class PreforkApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return application
+
+    logging.info(f"🚀 เปิด server {args.bind} ({'ASGI' if args.asgi else 'WSGI'}), worker {args.workers} ตัว")
+    PreforkApplication().run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""
+ตัวคำนวณขนาดยารุ่นแรก (ก่อนมี rule index / template) ลอกมาทั้งฟังก์ชันเพื่อใช้เป็นค่าอ้างอิงใน test
+ต่างจากต้นฉบับแค่รับตารางยาเป็น argument (แทน global) และรับ indication ตรงๆ (แทน user_drug_selection)
+รูปแบบข้อมูลที่รุ่นแรกไม่รองรับ (fixed_dose_by_weight, range ใน sub-indication แบบ list ฯลฯ) จะ raise ออกไป
+"""
+import json
+import math
+
+
+def load_reference_tables(path):
+    """ตารางยาจาก formulary.json ในรูปแบบที่รุ่นแรกใช้ (concentration_mg_per_ml แทน strength_mg / strength_ml)"""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    tables = []
+    for section in ("drugs", "special_drugs"):
+        drugs = {}
+        for drug, info in data[section].items():
+            info = dict(info)
+            if "strength_mg" in info:
+                info["concentration_mg_per_ml"] = info.pop("strength_mg") / info.pop("strength_ml")
+            drugs[drug] = info
+        tables.append(drugs)
+    return tuple(tables)
+
+
+def get_indication_title(indication_dict):
+    """
+    คืนค่าชื่อย่อยของ indication จาก key ที่เหมาะสม เช่น label, sub_indication, title, name
+    """
+    for key in ["label", "sub_indication", "title", "name"]:
+        if key in indication_dict:
+            return indication_dict[key]
+    return None
+
+
+def calculate_dose(drug_database, drug, indication, weight):
+    drug_info = drug_database.get(drug)
+    if not drug_info:
+        return f"❌ ไม่พบข้อมูลยา {drug}"
+
+    indication_info = drug_info["indications"].get(indication)
+    if not indication_info:
+        return f"❌ ไม่พบ indication {indication} ใน {drug}"
+
+    conc = drug_info["concentration_mg_per_ml"]
+    bottle_size = drug_info["bottle_size_ml"]
+    total_ml = 0
+    reply_lines = [f"{drug} - {indication} (น้ำหนัก {weight} kg):"]
+
+    # ✅ รองรับกรณี indication เป็น dict ซ้อน (sub-indications)
+    if all(isinstance(v, dict) for v in indication_info.values()):
+        for sub_ind, sub_info in indication_info.items():
+            dose_per_kg = sub_info["dose_mg_per_kg_per_day"]
+            freqs = sub_info["frequency"] if isinstance(sub_info["frequency"], list) else [sub_info["frequency"]]
+            days = sub_info["duration_days"]
+            max_mg_day = sub_info.get("max_mg_per_day")
+            max_mg_per_dose = sub_info.get("max_mg_per_dose")
+            note = sub_info.get("note")
+
+            if isinstance(dose_per_kg, list):
+                min_dose, max_dose = dose_per_kg
+                min_total_mg_day = weight * min_dose
+                max_total_mg_day = weight * max_dose
+
+                if max_mg_day:
+                    min_total_mg_day = min(min_total_mg_day, max_mg_day)
+                    max_total_mg_day = min(max_total_mg_day, max_mg_day)
+
+                ml_per_day_min = min_total_mg_day / conc
+                ml_per_day_max = max_total_mg_day / conc
+                ml_total = ml_per_day_max * days
+                total_ml += ml_total
+
+                min_freq = min(freqs)
+                max_freq = max(freqs)
+                reply_lines.append(
+                    f"📌 {sub_ind}: {min_dose} – {max_dose} mg/kg/day → {min_total_mg_day:.0f} – {max_total_mg_day:.0f} mg/day ≈ "
+                    f"{ml_per_day_min:.1f} – {ml_per_day_max:.1f} ml/day, แบ่งวันละ {min_freq} – {max_freq} ครั้ง × {days} วัน "
+                    f"(ครั้งละ ~{ml_per_day_max / max_freq:.1f} – {ml_per_day_min / min_freq:.1f} ml)"
+                )
+            else:
+                total_mg_day = weight * dose_per_kg
+                if max_mg_day:
+                    total_mg_day = min(total_mg_day, max_mg_day)
+                ml_per_day = total_mg_day / conc
+                ml_total = ml_per_day * days
+                total_ml += ml_total
+
+                if len(freqs) == 1:
+                    freq = freqs[0]
+                    ml_per_dose = ml_per_day / freq
+                    if max_mg_per_dose:
+                        ml_per_dose = min(ml_per_dose, max_mg_per_dose / conc)
+                    reply_lines.append(
+                        f"📌 {sub_ind}: {dose_per_kg} mg/kg/day → {total_mg_day:.0f} mg/day ≈ {ml_per_day:.1f} ml/day, "
+                        f"ครั้งละ ~{ml_per_dose:.1f} ml × {freq} ครั้ง/วัน × {days} วัน"
+                    )
+                else:
+                    min_freq = min(freqs)
+                    max_freq = max(freqs)
+                    reply_lines.append(
+                        f"📌 {sub_ind}: {dose_per_kg} mg/kg/day → {total_mg_day:.0f} mg/day ≈ {ml_per_day:.1f} ml/day, "
+                        f"แบ่งวันละ {min_freq} – {max_freq} ครั้ง × {days} วัน (ครั้งละ ~{ml_per_day / max_freq:.1f} – {ml_per_day / min_freq:.1f} ml)"
+                    )
+
+            if note:
+                reply_lines.append(f"📝 หมายเหตุ: {note}")
+
+    # ✅ รองรับหลายช่วงวัน (list)
+    elif isinstance(indication_info, list):
+        for phase in indication_info:
+            title = get_indication_title(phase)
+            if title:
+                reply_lines.append(f"\n🔹 {title}")
+            dose_per_kg = phase["dose_mg_per_kg_per_day"]
+            freqs = phase["frequency"] if isinstance(phase["frequency"], list) else [phase["frequency"]]
+            days = phase["duration_days"]
+            max_mg_day = phase.get("max_mg_per_day")
+
+            total_mg_day = weight * dose_per_kg
+            if max_mg_day:
+                total_mg_day = min(total_mg_day, max_mg_day)
+
+            ml_per_day = total_mg_day / conc
+            ml_phase = ml_per_day * days
+            total_ml += ml_phase
+
+            if len(freqs) == 1:
+                freq = freqs[0]
+                ml_per_dose = ml_per_day / freq
+                if "max_mg_per_dose" in phase:
+                    ml_per_dose = min(ml_per_dose, phase["max_mg_per_dose"] / conc)
+                reply_lines.append(
+                    f"📆 {phase['day_range']}: {dose_per_kg} mg/kg/day → {total_mg_day:.0f} mg/day ≈ {ml_per_day:.1f} ml/day, "
+                    f"ครั้งละ ~{ml_per_dose:.1f} ml × {freq} ครั้ง/วัน × {days} วัน"
+                )
+            else:
+                min_freq = min(freqs)
+                max_freq = max(freqs)
+                reply_lines.append(
+                    f"📆 {phase['day_range']}: {dose_per_kg} mg/kg/day → {total_mg_day:.0f} mg/day ≈ {ml_per_day:.1f} ml/day, "
+                    f"แบ่งวันละ {min_freq} – {max_freq} ครั้ง × {days} วัน (ครั้งละ ~{ml_per_day / max_freq:.1f} – {ml_per_day / min_freq:.1f} ml)"
+                )
+
+    # ✅ กรณี indication เป็น dict ธรรมดา
+    else:
+        dose_per_kg = indication_info["dose_mg_per_kg_per_day"]
+        freqs = indication_info["frequency"] if isinstance(indication_info["frequency"], list) else [indication_info["frequency"]]
+        days = indication_info["duration_days"]
+        max_mg_day = indication_info.get("max_mg_per_day")
+
+        if isinstance(dose_per_kg, list):
+            min_dose, max_dose = dose_per_kg
+            min_total_mg_day = weight * min_dose
+            max_total_mg_day = weight * max_dose
+
+            if max_mg_day:
+                min_total_mg_day = min(min_total_mg_day, max_mg_day)
+                max_total_mg_day = min(max_total_mg_day, max_mg_day)
+
+            ml_per_day_min = min_total_mg_day / conc
+            ml_per_day_max = max_total_mg_day / conc
+            total_ml = ml_per_day_max * days
+
+            min_freq = min(freqs)
+            max_freq = max(freqs)
+            reply_lines.append(
+                f"ขนาดยา: {min_dose} – {max_dose} mg/kg/day → {min_total_mg_day:.0f} – {max_total_mg_day:.0f} mg/day ≈ "
+                f"{ml_per_day_min:.1f} – {ml_per_day_max:.1f} ml/day, แบ่งวันละ {min_freq} – {max_freq} ครั้ง × {days} วัน (ครั้งละ ~{ml_per_day_max / max_freq:.1f} – {ml_per_day_min / min_freq:.1f} ml)"
+            )
+        else:
+            total_mg_day = weight * dose_per_kg
+            if max_mg_day:
+                total_mg_day = min(total_mg_day, max_mg_day)
+
+            ml_per_day = total_mg_day / conc
+            total_ml = ml_per_day * days
+
+            if len(freqs) == 1:
+                freq = freqs[0]
+                ml_per_dose = ml_per_day / freq
+                if "max_mg_per_dose" in indication_info:
+                    ml_per_dose = min(ml_per_dose, indication_info["max_mg_per_dose"] / conc)
+                reply_lines.append(
+                    f"ขนาดยา: {dose_per_kg} mg/kg/day → {total_mg_day:.0f} mg/day ≈ {ml_per_day:.1f} ml/day, "
+                    f"ครั้งละ ~{ml_per_dose:.1f} ml × {freq} ครั้ง/วัน × {days} วัน"
+                )
+            else:
+                min_freq = min(freqs)
+                max_freq = max(freqs)
+                reply_lines.append(
+                    f"ขนาดยา: {dose_per_kg} mg/kg/day → {total_mg_day:.0f} mg/day ≈ {ml_per_day:.1f} ml/day, "
+                    f"แบ่งวันละ {min_freq} – {max_freq} ครั้ง × {days} วัน (ครั้งละ ~{ml_per_day / max_freq:.1f} – {ml_per_day / min_freq:.1f} ml)"
+                )
+
+        note = indication_info.get("note")
+        if note:
+            reply_lines.append(f"\n📝 หมายเหตุ: {note}")
+
+    bottles = math.ceil(total_ml / bottle_size)
+    reply_lines.append(f"\nรวมทั้งหมด {total_ml:.1f} ml → จ่าย {bottles} ขวด ({bottle_size} ml)")
+    return "\n".join(reply_lines)
+
+
+def calculate_special_drug(special_drugs, drug, indication, weight, age):
+    info = special_drugs[drug]
+
+    if drug == "Hydroxyzine" and indication == "Pruritus (weight_based)":
+        data = info["indications"][indication]
+        if weight <= 40:
+            profile = data["\u226440kg"]  # ≤ = less than or equal to
+            dose_per_kg = profile["dose_mg_per_kg_per_day"]
+            freqs = profile["frequency"] if isinstance(profile["frequency"], list) else [profile["frequency"]]
+            max_dose = profile["max_mg_per_dose"]
+
+            total_mg_day = weight * dose_per_kg
+            reply_lines = [f"{drug} - {indication} (\u226440kg):"]
+            for freq in freqs:
+                dose_per_time = min(total_mg_day / freq, max_dose)
+                reply_lines.append(f"💊 {total_mg_day:.1f} mg/day → {freq} ครั้ง/วัน → ครั้งละ ~{dose_per_time:.1f} mg")
+            return "\n".join(reply_lines)
+
+        else:
+            profile = data[">40kg"]
+            dose_range = profile["dose_mg_range"]
+            freqs = profile["frequency"] if isinstance(profile["frequency"], list) else [profile["frequency"]]
+            max_dose = profile["max_mg_per_dose"]
+
+            reply_lines = [f"{drug} - {indication} (>40kg):"]
+            for freq in freqs:
+                for dose in dose_range:
+                    dose_per_time = min(dose, max_dose)
+                    reply_lines.append(f"💊 {dose_per_time:.1f} mg × {freq} ครั้ง/วัน")
+            return "\n".join(reply_lines)
+    
+    if drug == "Cetirizine":
+        indication_info = info["indications"].get(indication)
+        if not indication_info:
+            return f"❌ ไม่พบข้อบ่งใช้ {indication}"
+
+        # ตรวจสอบ age_group ที่มีอยู่จริง
+        possible_groups = indication_info.keys()
+        
+        age_group = None
+        if age < 1:
+            age_group = "6_to_11_months"
+        elif 1 <= age < 2:
+            age_group = "12_to_23_months"
+        elif 2 <= age <= 5 and "2_to_5_years" in possible_groups:
+            age_group = "2_to_5_years"
+        elif 6 <= age <= 11 and "6_to_11_years" in possible_groups:
+            age_group = "6_to_11_years"
+        elif age >= 12 and "above_or_equal_12" in possible_groups:
+            age_group = "above_or_equal_12"
+        elif age > 5 and "above_5" in possible_groups:
+            age_group = "above_5"
+
+        group_data = indication_info.get(age_group)
+        if not group_data:
+            return f"❌ ไม่พบข้อมูลกลุ่มอายุที่เหมาะสม (อายุ {age} ปี)"
+
+        lines = [f"{drug} - {indication} (อายุ {age} ปี):"]
+        if "dose_mg" in group_data:
+            lines.append(f"💊 ขนาดยา: {group_data['dose_mg']} mg × {group_data['frequency']} ครั้ง/วัน")
+        elif "initial_dose_mg" in group_data:
+            options = group_data.get("options", [])
+            lines.append(f"💊 เริ่มต้น {group_data['initial_dose_mg']} mg × {group_data['frequency']} ครั้ง/วัน")
+            for opt in options:
+                lines.append(f"หรือ: {opt['dose_mg']} mg × {opt['frequency']} ครั้ง/วัน")
+        elif "dose_range_mg" in group_data:
+            for dose in group_data["dose_range_mg"]:
+                lines.append(f"💊 ขนาดยา: {dose} mg × {group_data['frequency']} ครั้ง/วัน")
+        elif "dose_mg_range" in group_data:
+            for dose in group_data["dose_mg_range"]:
+                lines.append(f"💊 ขนาดยา: {dose} mg × {group_data['frequency']} ครั้ง/วัน")
+        elif "dose_mg" in group_data and "frequency_options" in group_data:
+            for freq in group_data["frequency_options"]:
+                lines.append(f"💊 ขนาดยา: {group_data['dose_mg']} mg × {freq} ครั้ง/วัน")
+
+        return "\n".join(lines)
+    
+    if drug == "Ferrous drop":
+        indication_info = info["indications"][indication]["all_ages"]
+        dose_per_kg = indication_info["initial_dose_mg_per_kg_per_day"]
+        freqs = indication_info["frequency"]
+        max_range = indication_info["max_dose_range_mg_per_day"]
+        usual_max = indication_info.get("usual_max_mg_per_day")
+        absolute_max = indication_info.get("absolute_max_mg_per_day")
+
+        total_mg_day = weight * dose_per_kg
+        total_mg_day = min(max(total_mg_day, max_range[0]), max_range[1])
+        if absolute_max:
+            total_mg_day = min(total_mg_day, absolute_max)
+
+        reply_lines = [f"{drug} - {indication} (น้ำหนัก {weight} kg):"]
+        reply_lines.append(f"💊 {dose_per_kg} mg/kg/day → {total_mg_day:.1f} mg/day")
+
+        for freq in freqs:
+            reply_lines.append(f"→ {freq} ครั้ง/วัน → ครั้งละ ~{(total_mg_day / freq):.1f} mg")
+
+        if "note" in indication_info:
+            reply_lines.append(f"\n📌 หมายเหตุ: {indication_info['note']}")
+
+        return "\n".join(reply_lines)
+
+    # กรณีพิเศษอื่น ๆ เช่น Paracetamol (ใช้แบบเดิม)
+    indication_info = next(iter(info["indications"].values()))
+    for entry in indication_info:
+        if entry["min_age_years"] <= age < entry["max_age_years"]:
+            dose_per_kg = entry["dose_mg_per_kg_per_day"]
+            freq = entry["frequency"]
+            duration = entry["duration_days"]
+            max_dose = entry["max_mg_per_dose"]
+
+            total_mg_day = weight * dose_per_kg
+            dose_per_time = min(total_mg_day / freq, max_dose)
+
+            return (
+                f"{drug} (อายุ {age} ปี, น้ำหนัก {weight} kg):\n"
+                f"ขนาดยา: {dose_per_kg} mg/kg/day → {total_mg_day:.1f} mg/day\n"
+                f"แบ่ง {freq} ครั้ง/วัน → ครั้งละ ~{dose_per_time:.1f} mg เป็นเวลา {duration} วัน"
+            )
+
+    return f"❌ ไม่พบขนาดยาที่เหมาะสมสำหรับอายุ {age} ปีใน {drug}"
+
@@ -0,0 +1,51 @@
+"""
+โหลด app-2.py ครั้งเดียวต่อ session ด้วย token ทดสอบ (ไม่ได้ต่อ LINE จริง)
+ใส่ LINE_CHANNEL_SECRET ไว้ให้ test webhook เซ็น X-Line-Signature ได้
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test-token")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test-secret")
+os.environ.setdefault("FORMULARY_WATCH_SECONDS", "0")
+os.environ.setdefault("AUDIT_LOG_BACKEND", "off")
+
+from app_loader import load_app  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def bot():
+    return load_app()
+
+
+class FakeTime:
+    """นาฬิกาที่เดินเองไม่ได้ ใช้แทน module time ใน app: sleep() บันทึกเวลาที่รอแล้วเลื่อนนาฬิกาไปเท่านั้น"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(bot, monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(bot, "time", fake)
+    return fake
@@ -0,0 +1,92 @@
+import asyncio
+import json
+
+import pytest
+
+REMOTE = {"REMOTE_ADDR": "203.0.113.7"}
+
+
+@pytest.fixture
+def client(bot, monkeypatch):
+    monkeypatch.setattr(bot, "ADMIN_TOKEN", "admin-secret")
+    return bot.app.test_client()
+
+
+@pytest.mark.parametrize("path", ["/stats", "/metrics"])
+def test_remote_requires_admin_token(client, path):
+    assert client.get(path, environ_base=REMOTE).status_code == 403
+    assert client.get(path, environ_base=REMOTE, headers={"Authorization": "Bearer wrong"}).status_code == 403
+    assert client.get(path, environ_base=REMOTE, headers={"Authorization": "Bearer admin-secret"}).status_code == 200
+
+
+@pytest.mark.parametrize("path", ["/stats", "/metrics"])
+def test_local_is_allowed(client, path):
+    assert client.get(path, environ_base={"REMOTE_ADDR": "127.0.0.1"}).status_code == 200
+
+
+def test_remote_without_configured_token_is_refused(bot, monkeypatch):
+    monkeypatch.setattr(bot, "ADMIN_TOKEN", None)
+    assert not bot.admin_or_local("203.0.113.7", "Bearer ")
+
+
+def asgi_request(method, path, client_addr, headers=()):
+    pytest.importorskip("aiohttp")
+    asgi = pytest.importorskip("asgi")
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": path, "method": method, "headers": list(headers),
+             "query_string": b"", "client": (client_addr, 50000)}
+    asyncio.run(asgi.app(scope, receive, send))
+    return sent[0]["status"], b"".join(message.get("body", b"") for message in sent[1:])
+
+
+def asgi_get(path, client_addr, headers=()):
+    return asgi_request("GET", path, client_addr, headers)[0]
+
+
+def test_asgi_stats_requires_admin_token(bot, monkeypatch):
+    pytest.importorskip("aiohttp")
+    monkeypatch.setattr(bot, "ADMIN_TOKEN", "admin-secret")
+    assert asgi_get("/stats", "203.0.113.7") == 403
+    assert asgi_get("/stats", "203.0.113.7", [(b"authorization", b"Bearer admin-secret")]) == 200
+    assert asgi_get("/stats", "127.0.0.1") == 200
+
+
+def flask_reload(client, headers):
+    response = client.post("/admin/reload-formulary", environ_base=REMOTE, headers=headers)
+    return response.status_code, response.get_json(silent=True)
+
+
+def asgi_reload(client, headers):
+    status, body = asgi_request("POST", "/admin/reload-formulary", "203.0.113.7", [
+        (name.lower().encode(), value.encode()) for name, value in headers.items()
+    ])
+    return status, json.loads(body) if status != 403 else None
+
+
+@pytest.mark.parametrize("reload", [flask_reload, asgi_reload])
+def test_reload_formulary_requires_admin_token(bot, client, monkeypatch, reload):
+    calls = []
+    monkeypatch.setattr(bot, "reload_formulary", lambda: calls.append(1))
+    assert reload(client, {})[0] == 403
+    assert reload(client, {"Authorization": "Bearer wrong"})[0] == 403
+    monkeypatch.setattr(bot, "ADMIN_TOKEN", None)
+    assert reload(client, {"Authorization": "Bearer "})[0] == 403  # ไม่ตั้ง ADMIN_TOKEN = ปิด endpoint
+    assert calls == []
+
+
+@pytest.mark.parametrize("reload", [flask_reload, asgi_reload])
+def test_reload_formulary_reports_version_or_error(bot, client, monkeypatch, reload):
+    monkeypatch.setattr(bot, "reload_formulary", lambda: None)
+    assert reload(client, {"Authorization": "Bearer admin-secret"}) == (200, {"ok": True, "version": bot.TABLES_VERSION})
+
+    def broken():
+        raise ValueError("ตารางยาผิดรูปแบบ")
+    monkeypatch.setattr(bot, "reload_formulary", broken)
+    assert reload(client, {"Authorization": "Bearer admin-secret"}) == (400, {"ok": False, "error": "ตารางยาผิดรูปแบบ"})
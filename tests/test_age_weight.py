@@ -0,0 +1,16 @@
+import pytest
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("1 ปี 6 เดือน 12 กก", (1.5, 12.0)),
+    ("อายุ 3 น้ำหนัก 14.5", (3.0, 14.5)),
+    ("2 y 13.5 kg", (2.0, 13.5)),
+    ("อายุ 5 ขวบ", (5.0, None)),
+    ("6 months", (0.5, None)),
+    ("8 เดือน", (0.67, None)),
+    ("18 กก", (None, 18.0)),
+    ("18", (None, 18.0)),
+    ("ไม่มีตัวเลข", (None, None)),
+])
+def test_parse_age_weight(bot, text, expected):
+    assert bot.parse_age_weight(text) == expected
@@ -0,0 +1,79 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("aiohttp")
+asgi = pytest.importorskip("asgi")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_event(user_id, n):
+    return SimpleNamespace(reply_token=f"r{n}", source=SimpleNamespace(user_id=user_id), n=n)
+
+
+def test_events_are_dispatched_off_the_event_loop(bot, monkeypatch):
+    handled = []
+    replies = []
+
+    def dispatch(event):
+        handled.append((event.source.user_id, event.n, threading.current_thread().name))
+        bot.outbound.add(event.reply_token, [json.dumps({"type": "text", "text": f"ตอบ {event.n}"})])
+        bot.outbound.add(event.reply_token, [json.dumps({"type": "text", "text": "อีกข้อความ"})])
+
+    async def reply(reply_token, messages_json):
+        replies.append((reply_token, len(messages_json)))
+
+    monkeypatch.setattr(bot, "dispatch_event", dispatch)
+    monkeypatch.setattr(asgi.sender, "reply", reply)
+
+    async def run():
+        loop_thread = threading.current_thread().name
+        await asyncio.gather(*(asgi.handle_event(make_event(f"U{n % 2}", n)) for n in range(6)))
+        return loop_thread
+
+    loop_thread = asyncio.run(run())
+    assert all(thread != loop_thread and thread.startswith("asgi-dispatch") for _, _, thread in handled)
+    # event ของ user เดียวกันทำใน thread เดียวกันตามลำดับที่รับ
+    for user_id in ("U0", "U1"):
+        mine = [(n, thread) for uid, n, thread in handled if uid == user_id]
+        assert [n for n, _ in mine] == sorted(n for n, _ in mine)
+        assert len({thread for _, thread in mine}) == 1
+    # ข้อความของแต่ละ event รวมเป็น reply เดียว ไม่ถูกส่งตรงผ่าน outbound
+    assert sorted(replies) == [(f"r{n}", 2) for n in range(6)]
+
+
+LIFESPAN_SCRIPT = """
+import asyncio, json
+import asgi
+
+bot = asgi.bot
+state = {"imported": (len(bot.event_pool._runners), bot.dose_api_pool is not None)}
+messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+
+async def receive():
+    if len(messages) == 1:
+        state["started"] = (len(bot.event_pool._runners), bot.dose_api_pool is not None)
+    return messages.pop(0)
+
+async def send(message):
+    pass
+
+asyncio.run(asgi.app({"type": "lifespan"}, receive, send))
+print(json.dumps(state))
+"""
+
+
+def test_import_and_lifespan_start_only_dose_pool():
+    env = dict(os.environ, DOSE_API_WORKERS="1", EVENT_WORKERS="2", FORMULARY_WATCH_SECONDS="0")
+    env.pop("SERVER_PREFORK", None)
+    out = subprocess.run([sys.executable, "-c", LIFESPAN_SCRIPT], cwd=ROOT, env=env,
+                         capture_output=True, text=True, timeout=120, check=True).stdout
+    state = json.loads(out.strip().splitlines()[-1])
+    assert state == {"imported": [0, False], "started": [0, True]}
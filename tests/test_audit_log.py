@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def make_audit_log(bot, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "AUDIT_LOG_DIR", str(tmp_path))
+    logs = []
+
+    def make(queue_max=1000, flush_seconds=60):
+        log = bot.AuditLog("jsonl", flush_seconds, 100, queue_max)
+        logs.append(log)
+        return log
+
+    yield make
+    for log in logs:
+        log.close()
+
+
+def written(tmp_path):
+    return [json.loads(line) for path in sorted(tmp_path.glob("*.jsonl")) for line in path.read_text().splitlines()]
+
+
+def test_close_flushes_pending(bot, make_audit_log, tmp_path):
+    log = make_audit_log()
+    result = bot.calculate_warfarin(2.5, 28.0, "no")
+    log.record(bot.AUDIT_WARFARIN, (2.5, 28.0, "no"), result)
+    log.close()
+    entries = written(tmp_path)
+    assert len(entries) == 1
+    assert entries[0]["inputs"] == {"inr": 2.5, "twd": 28.0, "bleeding": "no"}
+    assert entries[0]["result"]["band"] == "2.0–3.0"
+
+
+def test_record_after_close_is_written(bot, make_audit_log, tmp_path):
+    log = make_audit_log()
+    log.close()
+    log.record(bot.AUDIT_WARFARIN, (4.5, 28.0, "no"), bot.calculate_warfarin(4.5, 28.0, "no"))
+    assert not log.pending
+    assert [entry["inputs"]["inr"] for entry in written(tmp_path)] == [4.5]
+
+
+def test_full_queue_drops_and_counts(bot, make_audit_log, tmp_path):
+    log = make_audit_log(queue_max=3)
+    result = bot.calculate_warfarin(2.5, 28.0, "no")
+    before = bot.AUDIT_RECORDS_TOTAL.values.get(("dropped",), 0)
+    log.thread = object()  # ไม่ให้ writer thread เริ่มเขียนระหว่างเติมคิว
+    for _ in range(5):
+        log.record(bot.AUDIT_WARFARIN, (2.5, 28.0, "no"), result)
+    log.extend([(0.0, bot.AUDIT_WARFARIN, 0, (2.5, 28.0, "no"), {"type": "warfarin"})] * 2)
+    assert len(log.pending) == 3
+    assert log.stats()["dropped"] == 4
+    assert bot.AUDIT_RECORDS_TOTAL.values[("dropped",)] - before == 4
+    log.thread = None
+    assert log.flush()
+    assert len(written(tmp_path)) == 3
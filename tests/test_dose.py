@@ -0,0 +1,171 @@
+"""
+ข้อความขนาดยาต้องตรงกับตัวคำนวณรุ่นแรก (tests/baseline_reference.py) ทุกตัวอักษร
+ยกเว้นกรณีที่ตั้งใจแก้: ช่วงอายุ 5.x ปี, Cetirizine อายุต่ำกว่า 6 เดือน
+และน้ำหนักที่ถึงขนาดสูงสุดต่อครั้ง (รุ่นแรกจำกัดแค่ครั้งละ แต่ mg/day และจำนวนขวดไม่จำกัด)
+"""
+import os
+
+import pytest
+
+import baseline_reference as reference
+
+REFERENCE_DRUGS, REFERENCE_SPECIAL = reference.load_reference_tables(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "formulary.json")
+)
+WEIGHTS = [w10 / 10 for w10 in range(20, 801, 37)]
+AGES = [0.2, 0.5, 0.75, 1, 1.5, 2, 3, 5, 6, 8, 11, 11.5, 12, 15]
+SPECIAL_WEIGHTS = [3.0, 8.5, 15.0, 22.3, 40.0, 40.1, 55.0]
+
+
+def reaches_dose_cap(bot, drug, indication, weight):
+    _, rules = bot.INDICATION_RULES.get((drug, indication), (None, ()))
+    return any(rule.max_mg_dose and weight * rule.dose_max > rule.max_mg_dose * rule.max_freq for rule in rules)
+
+
+@pytest.mark.parametrize("drug, indication", [
+    (drug, indication) for drug, info in REFERENCE_DRUGS.items() for indication in info["indications"]
+])
+def test_dose_matches_reference(bot, drug, indication):
+    compared = 0
+    for weight in WEIGHTS:
+        if reaches_dose_cap(bot, drug, indication, weight):
+            continue
+        try:
+            expected = reference.calculate_dose(REFERENCE_DRUGS, drug, indication, weight)
+        except (AttributeError, KeyError, TypeError):
+            continue  # รุ่นแรกคำนวณข้อมูลรูปแบบนี้ไม่ได้ (crash)
+        assert bot.render_reply(bot.calculate_dose(drug, indication, weight), "th") == expected, weight
+        compared += 1
+    if not compared:
+        pytest.skip("รุ่นแรกไม่รองรับรูปแบบข้อมูลของข้อบ่งใช้นี้")
+
+
+@pytest.mark.parametrize("drug, indication", [
+    (drug, indication) for drug, info in REFERENCE_SPECIAL.items() for indication in info["indications"]
+])
+def test_special_drug_matches_reference(bot, drug, indication):
+    compared = 0
+    for age in AGES:
+        for weight in SPECIAL_WEIGHTS:
+            try:
+                expected = reference.calculate_special_drug(REFERENCE_SPECIAL, drug, indication, weight, age)
+            except (AttributeError, KeyError, TypeError):
+                continue
+            result = bot.calculate_special_drug(drug, indication, weight, age)
+            if isinstance(result, bot.NoDoseResult) or expected.startswith("❌"):
+                continue  # ช่วงอายุที่แก้แล้ว ตรวจแยกด้านล่าง
+            assert bot.render_reply(result, "th") == expected, (age, weight)
+            compared += 1
+    if not compared:
+        pytest.skip("รุ่นแรกไม่รองรับรูปแบบข้อมูลของข้อบ่งใช้นี้")
+
+
+@pytest.mark.parametrize("age", [0.0, 0.2, 0.49])
+@pytest.mark.parametrize("indication", [
+    "Allergic rhinitis, perennial", "Anaphylaxis (adjunctive only)", "Urticaria, acute", "Urticaria, chronic spontaneous",
+])
+def test_cetirizine_under_six_months_has_no_dose(bot, indication, age):
+    result = bot.calculate_special_drug("Cetirizine", indication, 5.0, age)
+    assert isinstance(result, bot.NoDoseResult)
+    assert result.reason == "age_group"
+    assert str(age) in bot.render_reply(result, "th")
+
+
+@pytest.mark.parametrize("indication, group", [
+    ("Allergic rhinitis, perennial", "6_to_11_months"),
+    ("Anaphylaxis (adjunctive only)", "6_to_23_months"),
+    ("Urticaria, acute", "6_to_23_months"),
+    ("Urticaria, chronic spontaneous", "6_to_11_months"),
+])
+def test_cetirizine_six_months_is_covered(bot, indication, group):
+    result = bot.calculate_special_drug("Cetirizine", indication, 7.0, 0.5)
+    assert result.rule.group == group
+
+
+@pytest.mark.parametrize("age, group", [
+    (2, "2_to_5_years"), (5.0, "2_to_5_years"), (5.5, "2_to_5_years"), (5.99, "2_to_5_years"), (6, "above_5"),
+])
+def test_cetirizine_five_year_olds_use_two_to_five_band(bot, age, group):
+    for indication in ("Anaphylaxis (adjunctive only)", "Urticaria, acute"):
+        assert bot.calculate_special_drug("Cetirizine", indication, 18.0, age).rule.group == group
+    hay_fever = bot.calculate_special_drug("Cetirizine", "Allergic symptoms, hay fever", 18.0, age).rule.group
+    assert hay_fever == ("above_or_equal_6" if age >= 6 else "2_to_5_years")
+
+
+def test_paracetamol_switches_band_at_six(bot):
+    young = bot.calculate_special_drug("Paracetamol", "Fever", 20.0, 5.99)
+    old = bot.calculate_special_drug("Paracetamol", "Fever", 20.0, 6)
+    assert (young.rule.lo, young.rule.hi) == (0, 6)
+    assert (old.rule.lo, old.rule.hi) == (6, 18)
+
+
+def test_hydroxyzine_weight_band_edge(bot):
+    at_edge = bot.calculate_special_drug("Hydroxyzine", "Pruritus (weight_based)", 40.0, 10)
+    above = bot.calculate_special_drug("Hydroxyzine", "Pruritus (weight_based)", 40.1, 10)
+    assert at_edge.rule.kind == bot.SPECIAL_PER_KG_DAY_BY_WEIGHT
+    assert above.rule.kind == bot.SPECIAL_FIXED_BY_WEIGHT
+
+
+@pytest.mark.parametrize("weight, mg_day", [(10.0, 60), (30.0, 90), (50.0, 120)])
+def test_ferrous_drop_clamps_daily_dose(bot, weight, mg_day):
+    result = bot.calculate_special_drug("Ferrous drop", "Iron deficiency, treatment", weight, 3)
+    assert result.dose.mg_day == pytest.approx(mg_day)
+
+
+def test_unknown_drug_is_counted_as_unknown(bot):
+    before = bot.DOSE_CALCULATIONS_TOTAL.values.get((bot.UNKNOWN_LABEL, bot.UNKNOWN_LABEL), 0)
+    result = bot.calculate_dose("ไม่มียานี้", "ไข้", 10.0)
+    assert isinstance(result, bot.NoDoseResult) and result.reason == "drug"
+    result = bot.calculate_special_drug("Cetirizine", "ไม่มีข้อบ่งใช้นี้", 10.0, 3)
+    assert isinstance(result, bot.NoDoseResult) and result.reason == "special_indication"
+    assert bot.DOSE_CALCULATIONS_TOTAL.values[(bot.UNKNOWN_LABEL, bot.UNKNOWN_LABEL)] == before + 2
+    assert ("ไม่มียานี้", "ไข้") not in bot.DOSE_CALCULATIONS_TOTAL.values
+
+
+def test_int_and_float_weights_render_separately(bot):
+    as_int = bot.render_reply(bot.calculate_dose("Amoxicillin", "Pharyngitis/Tonsillitis", 17), "th")
+    as_float = bot.render_reply(bot.calculate_dose("Amoxicillin", "Pharyngitis/Tonsillitis", 17.0), "th")
+    assert "(น้ำหนัก 17 kg)" in as_int
+    assert "(น้ำหนัก 17.0 kg)" in as_float
+
+
+@pytest.mark.parametrize("drug, indication, weight, entry, expected", [
+    # 50 mg/kg/day × 60 kg = 3000 mg แต่ครั้งละไม่เกิน 500 mg × 3 ครั้ง = 1500 mg/day → 30 ml/day × 14 วัน
+    ("Amoxicillin", "Lyme disease (Borrelia spp. infection)", 60.0, 0, (1500, 30.0, 10.0, 420.0, 7)),
+    ("Amoxicillin", "Lyme disease (Borrelia spp. infection)", 60.0, 2, (1500, 30.0, 10.0, 840.0, 14)),
+    ("Amoxicillin", "Lyme disease (Borrelia spp. infection)", 20.0, 0, (1000, 20.0, 20 / 3, 280.0, 5)),  # ยังไม่ถึง cap
+    ("Amoxicillin", "Anthrax", 50.0, 0, (3000, 60.0, 20.0, 3600.0, 60)),
+    ("Amoxicillin", "Urinary tract infection", 40.0, 3, (1500, 30.0, 10.0, 300.0, 5)),
+    ("Amoxicillin", "Rhinosinusitis", 60.0, 1, (4000, 80.0, 40.0, 800.0, 14)),
+    ("Amoxicillin", "Helicobacter pylori eradication", 50.0, 0, (2000, 40.0, 20.0, 560.0, 10)),
+])
+def test_per_dose_cap_limits_daily_amount_and_bottles(bot, drug, indication, weight, entry, expected):
+    line = bot.calculate_dose(drug, indication, weight).lines[entry]
+    mg_day, ml_day, ml_dose, ml_total, bottles = expected
+    assert line.mg_day_max == pytest.approx(mg_day)
+    assert line.ml_day_max == pytest.approx(ml_day)
+    assert line.ml_dose_at_max_freq == pytest.approx(ml_dose)
+    assert line.ml_total == pytest.approx(ml_total)
+    assert line.bottles == bottles
+
+
+@pytest.mark.parametrize("indication, weight, mg_day, total_ml, bottles", [
+    ("Typhoid Fever", 70.0, 1000, 175.0, 12),       # 15 mg/kg × 70 = 1050 → ครั้งละไม่เกิน 1000 mg
+    ("Strep Pharyngitis", 50.0, 500, 62.5, 5),       # 12 mg/kg × 50 = 600 → 500
+    ("Asthma (Adjunct)", 60.0, 600, 210.0, 14),      # 3 ครั้ง/วัน: cap 1500 mg/day ยังไม่ถึง
+    ("Cystic Fibrosis (maintenance)", 60.0, 600, 210.0, 14),
+    ("Chlamydia", 60.0, 1000, 25.0, 2),
+])
+def test_azithromycin_single_daily_dose_cap(bot, indication, weight, mg_day, total_ml, bottles):
+    result = bot.calculate_dose("Azithromycin", indication, weight)
+    (line,) = result.lines
+    assert line.mg_day_max == pytest.approx(mg_day)
+    assert line.ml_dose_at_max_freq == pytest.approx(line.ml_day_max / line.rule.max_freq)
+    assert result.total_ml == pytest.approx(total_ml)
+    assert result.bottles == bottles
+
+
+def test_capped_reply_text_is_consistent(bot):
+    text = bot.render_reply(bot.calculate_dose("Amoxicillin", "Lyme disease (Borrelia spp. infection)", 60.0, 0), "th")
+    assert "50 mg/kg/day → 1500 mg/day ≈ 30.0 ml/day, ครั้งละ ~10.0 ml × 3 ครั้ง/วัน × 14 วัน" in text
+    assert "รวม 420.0 ml → จ่าย 7 ขวด (60 ml)" in text
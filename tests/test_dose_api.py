@@ -0,0 +1,146 @@
+import json
+
+import pytest
+
+AUTH = {"Authorization": "Bearer api-secret"}
+ROWS = [
+    {"id": 1, "drug": "Amoxicillin", "indication": "Pharyngitis/Tonsillitis", "weight": 15},
+    {"id": 2, "drug": "Cetirizine", "indication": "Urticaria, acute", "weight": 12.5, "age": 3},
+    {"id": 3, "drug": "Cetirizine", "indication": "Urticaria, acute", "weight": 12.5},
+    {"id": 4, "drug": "Amoxicillin", "indication": "ไม่มีข้อบ่งใช้นี้", "weight": 15},
+    {"id": 5, "drug": "Amoxicillin", "indication": "Pharyngitis/Tonsillitis", "weight": 500},
+    {"id": 6, "drug": "Cetirizine", "indication": "Urticaria, acute", "weight": 5, "age": 0.2},
+]
+
+
+@pytest.fixture
+def client(bot, monkeypatch):
+    monkeypatch.setattr(bot, "DOSE_API_TOKENS", ("old-secret", "api-secret"))
+    monkeypatch.setattr(bot, "dose_api_pool", None)
+    return bot.app.test_client()
+
+
+def post(client, body, content_type="application/x-ndjson", query="", headers=AUTH):
+    response = client.post(f"/api/dose{query}", data=body, content_type=content_type, headers=headers)
+    return response, [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def ndjson(rows):
+    return "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows).encode("utf-8")
+
+
+@pytest.mark.parametrize("headers", [{}, {"Authorization": "Bearer wrong"}, {"Authorization": "api-secret"}])
+def test_requires_token(client, headers):
+    response = client.post("/api/dose", data=ndjson(ROWS), content_type="application/x-ndjson", headers=headers)
+    assert response.status_code == 403
+
+
+def test_any_configured_token_is_accepted(client):
+    response, _ = post(client, ndjson(ROWS[:1]), headers={"Authorization": "Bearer old-secret"})
+    assert response.status_code == 200
+
+
+def test_ndjson_rows_in_order(bot, client):
+    response, lines = post(client, ndjson(ROWS))
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    assert [line["id"] for line in lines] == [1, 2, 3, 4, 5, 6]
+    assert [line["ok"] for line in lines] == [True, True, False, False, False, False]
+    assert [line.get("error") for line in lines[2:]] == ["invalid_row", "indication", "invalid_row", "age_group"]
+    assert lines[0]["result"] == bot.dose_result_json(bot.calculate_dose("Amoxicillin", "Pharyngitis/Tonsillitis", 15))
+    assert lines[1]["result"]["group"] == "2_to_5_years"
+    assert "text" not in lines[0]
+
+
+def test_json_array_matches_ndjson(client):
+    _, from_ndjson = post(client, ndjson(ROWS))
+    response, from_array = post(client, json.dumps(ROWS, ensure_ascii=False).encode("utf-8"), "application/json")
+    assert response.status_code == 200
+    assert from_array == from_ndjson
+
+
+def test_locale_adds_reply_text(bot, client):
+    _, lines = post(client, ndjson(ROWS[:2]), query="?locale=en")
+    assert lines[0]["text"] == bot.render_reply(bot.calculate_dose("Amoxicillin", "Pharyngitis/Tonsillitis", 15), "en")
+
+
+def test_unknown_locale_is_rejected(client):
+    response = client.post("/api/dose?locale=xx", data=ndjson(ROWS), content_type="application/x-ndjson", headers=AUTH)
+    assert response.status_code == 400
+    assert response.get_json()["ok"] is False
+
+
+def test_invalid_lines_do_not_stop_the_batch(client):
+    _, lines = post(client, b'{"id": 1, "drug": "Amoxicillin", "indication": "Pharyngitis/Tonsillitis", "weight": 15}\n'
+                            b'{not json\n[1, 2]\n\n' + ndjson(ROWS[1:2]))
+    assert [line.get("error") for line in lines] == [None, "invalid_json", "invalid_row", None]
+
+
+def test_broken_json_array_ends_with_error_line(client):
+    body = json.dumps(ROWS[:2])[:-1].encode("utf-8") + b", oops]"
+    response, lines = post(client, body, "application/json")
+    assert response.status_code == 200  # ส่ง header ไปก่อนอ่าน body ครบ
+    assert lines[-1]["error"] == "invalid_body"
+
+
+def test_row_limit(bot, client, monkeypatch):
+    monkeypatch.setattr(bot, "DOSE_API_MAX_ROWS", 3)
+    _, lines = post(client, ndjson(ROWS))
+    assert lines[-1]["error"] == "invalid_body"
+    assert len(lines) < len(ROWS) + 1
+
+
+def test_rows_are_counted(bot, client):
+    before = dict(bot.DOSE_API_ROWS_TOTAL.values)
+    post(client, ndjson(ROWS))
+    after = bot.DOSE_API_ROWS_TOTAL.values
+    assert after[("ok",)] - before.get(("ok",), 0) == 2
+    assert after[("error",)] - before.get(("error",), 0) == 4
+
+
+@pytest.mark.parametrize("body", [
+    json.dumps(ROWS, ensure_ascii=False),
+    json.dumps(ROWS, ensure_ascii=False, indent=2),
+    "[]",
+    " [ 1 , 2.5 , \"x\" , {\"a\": [1, {\"b\": \"]\"}]} ] ",
+])
+def test_json_array_reader_byte_by_byte(bot, body):
+    data = body.encode("utf-8")
+    reader = bot.JsonArrayRowReader()
+    rows = []
+    for i in range(len(data)):
+        rows.extend(reader.feed(data[i:i + 1]))
+    rows.extend(reader.close())
+    assert rows == json.loads(body)
+
+
+@pytest.mark.parametrize("body", ["{}", "[1, 2", "[1 2]", "[1] 2"])
+def test_json_array_reader_rejects(bot, body):
+    reader = bot.JsonArrayRowReader()
+    with pytest.raises(bot.DoseApiBodyError):
+        reader.feed(body.encode("utf-8"))
+        reader.close()
+
+
+def test_ndjson_reader_splits_across_chunks(bot):
+    reader = bot.NdjsonRowReader()
+    assert reader.feed(b'{"a": 1}\n{"b"') == [{"a": 1}]
+    assert reader.feed(b': 2}\n') == [{"b": 2}]
+    assert reader.feed(b'{"c": 3}') == []
+    assert reader.close() == [{"c": 3}]
+
+
+def test_pool_matches_inline(bot, monkeypatch):
+    monkeypatch.setattr(bot, "DOSE_API_CHUNK_ROWS", 2)
+    rows = ROWS * 3
+    inline = "".join(bot.stream_dose_results(bot.DoseRowBatcher("application/x-ndjson"), [ndjson(rows)], "th"))
+    pool = bot.DoseApiPool(1)
+    try:
+        monkeypatch.setattr(bot, "dose_api_pool", pool)
+        before = sum(bot.DOSE_CALCULATIONS_TOTAL.values.values())
+        pooled = "".join(bot.stream_dose_results(bot.DoseRowBatcher("application/x-ndjson"), [ndjson(rows)], "th"))
+        # metric ที่นับใน process ลูกถูกรวมกลับมาที่ process นี้
+        assert sum(bot.DOSE_CALCULATIONS_TOTAL.values.values()) - before == 4 * 3
+    finally:
+        pool.shutdown()
+    assert pooled == inline
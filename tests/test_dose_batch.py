@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+WEIGHTS = [w10 / 10 for w10 in range(20, 1001, 23)]
+FIELDS = {
+    "mg_day_min": "mg_day_min", "mg_day_max": "mg_day_max",
+    "ml_day_min": "ml_day_min", "ml_day_max": "ml_day_max",
+    "ml_dose_at_max_freq": "ml_dose_at_max_freq", "ml_dose_at_min_freq": "ml_dose_at_min_freq",
+    "total_ml": "ml_total",
+}
+
+
+def test_every_row_matches_calculate_dose(bot):
+    table = bot.calculate_dose_batch(WEIGHTS)
+    assert len(table) == len(bot.DOSE_RULES) * len(WEIGHTS)
+    results = {}
+    for row in table:
+        drug, indication, entry, weight = str(row["drug"]), str(row["indication"]), int(row["entry"]), float(row["weight"])
+        result = results.get((drug, indication, weight))
+        if result is None:
+            result = results[(drug, indication, weight)] = bot.calculate_dose(drug, indication, weight)
+        line = result.lines[entry]
+        where = (drug, indication, entry, weight)
+        if line.rule.fixed_doses and line.band is None:
+            # น้ำหนักไม่อยู่ในช่วงใด: batch เป็น NaN, calculate_dose เป็น 0
+            assert np.isnan(row["mg_day_max"]) and row["bottles"] == 0, where
+            continue
+        for column, attr in FIELDS.items():
+            assert row[column] == pytest.approx(getattr(line, attr)), (where, column)
+        bottles = line.bottles if result.layout == bot.LAYOUT_ALTERNATIVES else result.bottles
+        assert row["bottles"] == bottles, where
+
+
+def test_rows_respect_per_dose_cap(bot):
+    table = bot.calculate_dose_batch([60.0], [("Amoxicillin", "Lyme disease (Borrelia spp. infection)")])
+    row = table[0]
+    assert (row["mg_day_max"], row["ml_day_max"], row["ml_dose_at_max_freq"]) == pytest.approx((1500, 30.0, 10.0))
+    assert (row["total_ml"], row["bottles"]) == (pytest.approx(420.0), 7)
+
+
+def test_unknown_pair_is_rejected(bot):
+    with pytest.raises(ValueError):
+        bot.calculate_dose_batch([10.0], [("Amoxicillin", "ไม่มีข้อบ่งใช้นี้")])
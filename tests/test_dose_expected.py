@@ -0,0 +1,175 @@
+"""
+ข้อความที่คาดไว้ของข้อบ่งใช้ที่ตัวคำนวณรุ่นแรกคำนวณไม่ได้ (รูปแบบ list / phases / อายุ)
+ตัวเลขคิดจากสูตรใน formulary.json ด้วยมือ: Amoxicillin 50 mg/ml ขวด 60 ml, Azithromycin 40 mg/ml ขวด 15 ml
+"""
+import pytest
+
+AMOXICILLIN = {
+    "Pharyngitis/Tonsillitis": [
+        "📌 Group A Streptococcus: 50 mg/kg/day → 900 mg/day ≈ 18.0 ml/day, แบ่งวันละ 1 – 2 ครั้ง × 10 วัน (ครั้งละ ~9.0 – 18.0 ml)",
+        "รวม 180.0 ml → จ่าย 3 ขวด (60 ml)",
+        "📝 หมายเหตุ: 📌 ใช้ได้ทั้งแบบวันละครั้งหรือแบ่งวันละ 2 ครั้ง × 10 วัน ตามความสะดวก",
+    ],
+    "Otitis media, acute (AOM)": [
+        "📌 High-dose regimen: 80 – 90 mg/kg/day → 1440 – 1620 mg/day ≈ 28.8 – 32.4 ml/day, แบ่งวันละ 2 – 2 ครั้ง × 10 วัน (ครั้งละ ~16.2 – 14.4 ml)",
+        "รวม 324.0 ml → จ่าย 6 ขวด (60 ml)",
+        "📝 หมายเหตุ: เหมาะในสหรัฐอเมริกา หรือเมื่อมี S. pneumoniae ดื้อเพนนิซิลลิน",
+        "📌 Standard-dose regimen: 40 – 50 mg/kg/day → 720 – 900 mg/day ≈ 14.4 – 18.0 ml/day, แบ่งวันละ 2 – 2 ครั้ง × 7 วัน (ครั้งละ ~9.0 – 7.2 ml)",
+        "รวม 126.0 ml → จ่าย 3 ขวด (60 ml)",
+        "📝 หมายเหตุ: ใช้ได้เฉพาะในพื้นที่ที่เชื้อ S. pneumoniae ดื้อต่อ penicillin < 10% เท่านั้น",
+    ],
+    "Pneumonia, community acquired": [
+        "📌 Empiric therapy (bacterial pneumonia): 90 mg/kg/day → 1620 mg/day ≈ 32.4 ml/day, ครั้งละ ~16.2 ml × 2 ครั้ง/วัน × 5 วัน",
+        "รวม 162.0 ml → จ่าย 3 ขวด (60 ml)",
+        "📌 Group A Streptococcus, mild: 50 – 75 mg/kg/day → 900 – 1350 mg/day ≈ 18.0 – 27.0 ml/day, แบ่งวันละ 2 – 2 ครั้ง × 7 วัน (ครั้งละ ~13.5 – 9.0 ml)",
+        "รวม 189.0 ml → จ่าย 4 ขวด (60 ml)",
+        "📌 H. influenzae, mild: 75 – 100 mg/kg/day → 1350 – 1800 mg/day ≈ 27.0 – 36.0 ml/day, แบ่งวันละ 3 – 3 ครั้ง × 7 วัน (ครั้งละ ~12.0 – 9.0 ml)",
+        "รวม 252.0 ml → จ่าย 5 ขวด (60 ml)",
+        "📌 S. pneumoniae, MIC ≤2: 90 mg/kg/day → 1620 mg/day ≈ 32.4 ml/day, แบ่งวันละ 2 – 3 ครั้ง × 7 วัน (ครั้งละ ~10.8 – 16.2 ml)",
+        "รวม 226.8 ml → จ่าย 4 ขวด (60 ml)",
+        "📝 หมายเหตุ: เลือกความถี่ตาม MIC: 12 ชม หรือ 8 ชม",
+        "📌 S. pneumoniae, MIC = 2 mcg/mL: 90 – 100 mg/kg/day → 1620 – 1800 mg/day ≈ 32.4 – 36.0 ml/day, แบ่งวันละ 3 – 3 ครั้ง × 7 วัน (ครั้งละ ~12.0 – 10.8 ml)",
+        "รวม 252.0 ml → จ่าย 5 ขวด (60 ml)",
+        "📝 หมายเหตุ: ใช้เพื่อให้ time > MIC ได้ตามเป้าหมาย",
+    ],
+    "Anthrax": [
+        "📌 Postexposure prophylaxis, exposure to aerosolized spores: 75 mg/kg/day → 1350 mg/day ≈ 27.0 ml/day, ครั้งละ ~9.0 ml × 3 ครั้ง/วัน × 60 วัน",
+        "รวม 1620.0 ml → จ่าย 27 ขวด (60 ml)",
+        # ช่วง 7–10 วัน คิดปริมาณรวมจากวันมากสุด
+        "📌 Cutaneous, without systemic involvement: 75 mg/kg/day → 1350 mg/day ≈ 27.0 ml/day, ครั้งละ ~9.0 ml × 3 ครั้ง/วัน × 7–10 วัน",
+        "รวม 270.0 ml → จ่าย 5 ขวด (60 ml)",
+        "📝 หมายเหตุ: ใช้ในกรณี naturally acquired infection",
+        "📌 Systemic, oral step-down therapy: 75 mg/kg/day → 1350 mg/day ≈ 27.0 ml/day, ครั้งละ ~9.0 ml × 3 ครั้ง/วัน × 60 วัน",
+        "รวม 1620.0 ml → จ่าย 27 ขวด (60 ml)",
+        "📝 หมายเหตุ: เป็นส่วนหนึ่งของ combination therapy เพื่อให้ครบ 60 วัน",
+    ],
+    "Helicobacter pylori eradication": [
+        "📌 Standard-dose (weight-based): 50 mg/kg/day → 900 mg/day ≈ 18.0 ml/day, ครั้งละ ~9.0 ml × 2 ครั้ง/วัน × 14 วัน",
+        "รวม 252.0 ml → จ่าย 5 ขวด (60 ml)",
+        "📝 หมายเหตุ: ใช้ร่วมกับยาฆ่าเชื้อชนิดอื่นตาม guideline",
+        "📌 Standard-dose (fixed dosing): 500 mg/ครั้ง (น้ำหนัก 15–24.9 kg) → 1000 mg/day ≈ 20.0 ml/day, ครั้งละ ~10.0 ml × 2 ครั้ง/วัน × 14 วัน",
+        "รวม 280.0 ml → จ่าย 5 ขวด (60 ml)",
+        "📝 หมายเหตุ: Fixed dosing ตามน้ำหนักช่วง (twice daily × 14 วัน)",
+        "📌 High-dose (fixed dosing): 750 mg/ครั้ง (น้ำหนัก 15–24.9 kg) → 1500 mg/day ≈ 30.0 ml/day, ครั้งละ ~15.0 ml × 2 ครั้ง/วัน × 14 วัน",
+        "รวม 420.0 ml → จ่าย 7 ขวด (60 ml)",
+        "📝 หมายเหตุ: ใช้กรณีดื้อ clarithromycin และ metronidazole",
+    ],
+    "Lyme disease (Borrelia spp. infection)": [
+        "📌 Erythema migrans / Borrelial lymphocytoma: 50 mg/kg/day → 900 mg/day ≈ 18.0 ml/day, ครั้งละ ~6.0 ml × 3 ครั้ง/วัน × 14 วัน",
+        "รวม 252.0 ml → จ่าย 5 ขวด (60 ml)",
+        "📝 หมายเหตุ: รักษานาน 14 วัน",
+        "📌 Carditis: 50 mg/kg/day → 900 mg/day ≈ 18.0 ml/day, ครั้งละ ~6.0 ml × 3 ครั้ง/วัน × 21 วัน",
+        "รวม 378.0 ml → จ่าย 7 ขวด (60 ml)",
+        "📝 หมายเหตุ: รักษานาน 14–21 วัน",
+        "📌 Arthritis (initial, recurrent, or refractory): 50 mg/kg/day → 900 mg/day ≈ 18.0 ml/day, ครั้งละ ~6.0 ml × 3 ครั้ง/วัน × 28 วัน",
+        "รวม 504.0 ml → จ่าย 9 ขวด (60 ml)",
+        "📝 หมายเหตุ: รักษานาน 28 วัน",
+        "📌 Acrodermatitis chronica atrophicans: 50 mg/kg/day → 900 mg/day ≈ 18.0 ml/day, ครั้งละ ~6.0 ml × 3 ครั้ง/วัน × 28 วัน",
+        "รวม 504.0 ml → จ่าย 9 ขวด (60 ml)",
+        "📝 หมายเหตุ: รักษานาน 21–28 วัน",
+    ],
+    "Urinary tract infection": [
+        "📌 Infants: 50 mg/kg/day → 900 mg/day ≈ 18.0 ml/day, ครั้งละ ~9.0 ml × 2 ครั้ง/วัน × 7 วัน",
+        "รวม 126.0 ml → จ่าย 3 ขวด (60 ml)",
+        "📝 หมายเหตุ: 📌 แนะนำใช้เฉพาะในกรณีที่เชื้อไวต่อ amoxicillin",
+        "📌 Infants (severe): 100 mg/kg/day → 1800 mg/day ≈ 36.0 ml/day, ครั้งละ ~18.0 ml × 2 ครั้ง/วัน × 10 วัน",
+        "รวม 360.0 ml → จ่าย 6 ขวด (60 ml)",
+        "📝 หมายเหตุ: 📌 อาจใช้ในกรณี moderate/severe infection",
+        "📌 Children and Adolescents: 50 mg/kg/day → 900 mg/day ≈ 18.0 ml/day, ครั้งละ ~6.0 ml × 3 ครั้ง/วัน × 7 วัน",
+        "รวม 126.0 ml → จ่าย 3 ขวด (60 ml)",
+        "📝 หมายเหตุ: 📌 แนะนำระยะเวลา 7–14 วัน หรือ 3–5 วันใน cystitis ที่ไม่ซับซ้อน (≥2 ปี)",
+        # 100 mg/kg × 18 = 1800 เกินครั้งละ 500 mg × 3 ครั้ง → 1500 mg/day
+        "📌 Children and Adolescents (high dose): 100 mg/kg/day → 1500 mg/day ≈ 30.0 ml/day, ครั้งละ ~10.0 ml × 3 ครั้ง/วัน × 10 วัน",
+        "รวม 300.0 ml → จ่าย 5 ขวด (60 ml)",
+        "📝 หมายเหตุ: 📌 สำหรับ moderate/severe infection ที่ตอบสนองช้า",
+        "📌 Children (uncomplicated cystitis): 30 mg/kg/day → 540 mg/day ≈ 10.8 ml/day, ครั้งละ ~3.6 ml × 3 ครั้ง/วัน × 3 วัน",
+        "รวม 32.4 ml → จ่าย 1 ขวด (60 ml)",
+        "📝 หมายเหตุ: 📌 ใช้ได้ในเด็ก ≥2 ปี ที่มี uncomplicated cystitis",
+    ],
+    "Rhinosinusitis": [
+        "📌 Standard-dose regimen (พื้นที่ที่ S. pneumoniae ไวต่อ penicillin): 45 mg/kg/day → 810 mg/day ≈ 16.2 ml/day, ครั้งละ ~8.1 ml × 2 ครั้ง/วัน × 10 วัน",
+        "รวม 162.0 ml → จ่าย 3 ขวด (60 ml)",
+        "📝 หมายเหตุ: 📌 สำหรับผู้ป่วยที่ไม่ได้รับยาปฏิชีวนะใน 30 วันที่ผ่านมา และไม่ได้ไปศูนย์ดูแลเด็ก (AAP guideline)",
+        "📌 High-dose regimen (พื้นที่ที่ S. pneumoniae ดื้อต่อ penicillin ≥10%): 80 mg/kg/day → 1440 mg/day ≈ 28.8 ml/day, ครั้งละ ~14.4 ml × 2 ครั้ง/วัน × 10 วัน",
+        "รวม 288.0 ml → จ่าย 5 ขวด (60 ml)",
+        "📝 หมายเหตุ: 📌 แนะนำโดย IDSA และใช้ในพื้นที่ที่มีเชื้อดื้อมาก",
+    ],
+}
+
+# Day 1: 10 mg/kg = 180 mg = 4.5 ml, Day 2–5: 5 mg/kg = 90 mg = 2.25 ml × 4 → รวม 13.5 ml
+AZITHROMYCIN_FIVE_DAY = [
+    "📆 Day 1: 10 mg/kg/day → 180 mg/day ≈ 4.5 ml/day, ครั้งละ ~4.5 ml × 1 ครั้ง/วัน × 1 วัน",
+    "📆 Day 2–5: 5 mg/kg/day → 90 mg/day ≈ 2.2 ml/day, ครั้งละ ~2.2 ml × 1 ครั้ง/วัน × 4 วัน",
+    "",
+    "รวมทั้งหมด 13.5 ml → จ่าย 1 ขวด (15 ml)",
+]
+AZITHROMYCIN = {
+    "Pertussis": AZITHROMYCIN_FIVE_DAY,
+    "Pneumonia (Atypical)": AZITHROMYCIN_FIVE_DAY,
+    "Babesiosis": AZITHROMYCIN_FIVE_DAY,
+    "Cat Scratch Disease": AZITHROMYCIN_FIVE_DAY,
+    "Diarrhea (Shigella)": [
+        "📆 Day 1: 12 mg/kg/day → 216 mg/day ≈ 5.4 ml/day, ครั้งละ ~5.4 ml × 1 ครั้ง/วัน × 1 วัน",
+        "📆 Day 2–5: 5 mg/kg/day → 90 mg/day ≈ 2.2 ml/day, ครั้งละ ~2.2 ml × 1 ครั้ง/วัน × 4 วัน",
+        "",
+        "รวมทั้งหมด 14.4 ml → จ่าย 1 ขวด (15 ml)",
+    ],
+}
+
+
+@pytest.mark.parametrize("drug, indication, lines", [
+    *(("Amoxicillin", indication, lines) for indication, lines in AMOXICILLIN.items()),
+    *(("Azithromycin", indication, lines) for indication, lines in AZITHROMYCIN.items()),
+])
+def test_list_form_indication_text(bot, drug, indication, lines):
+    text = bot.render_reply(bot.calculate_dose(drug, indication, 18.0), "th")
+    assert text == "\n".join([f"{drug} - {indication} (น้ำหนัก 18.0 kg):", *lines])
+
+
+def test_list_form_covers_every_amoxicillin_indication(bot):
+    indications = {indication for drug, indication in bot.INDICATION_RULES if drug == "Amoxicillin"}
+    assert indications == set(AMOXICILLIN)
+
+
+@pytest.mark.parametrize("weight, day1_mg, rest_mg, total_ml, bottles", [
+    (60.0, 500, 250, 37.5, 3),   # 600 / 300 mg เกินเพดาน Day 1 500 mg, Day 2–5 250 mg
+    (5.0, 50, 25, 3.75, 1),
+])
+def test_azithromycin_phases_cap_each_day(bot, weight, day1_mg, rest_mg, total_ml, bottles):
+    result = bot.calculate_dose("Azithromycin", "Pertussis", weight)
+    day1, rest = result.lines
+    assert (day1.mg_day_max, rest.mg_day_max) == pytest.approx((day1_mg, rest_mg))
+    assert result.total_ml == pytest.approx(total_ml)
+    assert result.bottles == bottles
+
+
+def test_azithromycin_other_has_no_dose(bot):
+    result = bot.calculate_dose("Azithromycin", "Other", 18.0)
+    assert isinstance(result, bot.NoDoseResult)
+    assert bot.render_reply(result, "th") == "❌ ไม่พบ indication Other ใน Azithromycin"
+
+
+@pytest.mark.parametrize("indication, age, weight, lines", [
+    ("Anxiety", 3, 14.0, ["💊 ขนาดยา: 12.5 mg × 4 ครั้ง/วัน"]),
+    ("Anxiety", 5.99, 20.0, ["💊 ขนาดยา: 12.5 mg × 4 ครั้ง/วัน"]),
+    ("Anxiety", 8, 25.0, ["💊 ขนาดยา: 12.5 mg × 4 ครั้ง/วัน", "💊 ขนาดยา: 25 mg × 4 ครั้ง/วัน"]),
+    ("Pruritus (age-based)", 3, 14.0, ["💊 ขนาดยา: 12.5 mg × 3 – 4 ครั้ง/วัน"]),
+    ("Pruritus (age-based)", 6, 20.0, ["💊 ขนาดยา: 12.5 mg × 3 – 4 ครั้ง/วัน", "💊 ขนาดยา: 25 mg × 3 – 4 ครั้ง/วัน"]),
+])
+def test_hydroxyzine_age_based_text(bot, indication, age, weight, lines):
+    text = bot.render_reply(bot.calculate_special_drug("Hydroxyzine", indication, weight, age), "th")
+    assert text == "\n".join([f"Hydroxyzine - {indication} (อายุ {age} ปี):", *lines])
+
+
+@pytest.mark.parametrize("indication, weight, line", [
+    ("Pruritus from opioid", 14.0, "💊 0.5 mg/kg/ครั้ง → ครั้งละ ~7.0 mg × 6 ครั้ง/วัน"),
+    ("Pruritus from opioid", 25.0, "💊 0.5 mg/kg/ครั้ง → ครั้งละ ~12.5 mg × 6 ครั้ง/วัน"),
+    ("Pruritus from opioid", 120.0, "💊 0.5 mg/kg/ครั้ง → ครั้งละ ~50.0 mg × 6 ครั้ง/วัน"),  # เพดาน 50 mg/ครั้ง
+    ("Sedation", 14.0, "💊 0.6 mg/kg/ครั้ง → ครั้งละ ~8.4 mg"),
+    ("Sedation", 25.0, "💊 0.6 mg/kg/ครั้ง → ครั้งละ ~15.0 mg"),
+    ("Sedation", 200.0, "💊 0.6 mg/kg/ครั้ง → ครั้งละ ~100.0 mg"),  # เพดาน 100 mg/ครั้ง
+])
+def test_hydroxyzine_all_ages_text(bot, indication, weight, line):
+    for age in (3, 8):
+        text = bot.render_reply(bot.calculate_special_drug("Hydroxyzine", indication, weight, age), "th")
+        assert text == f"Hydroxyzine - {indication} (น้ำหนัก {weight} kg):\n{line}"
@@ -0,0 +1,99 @@
+import csv
+import json
+
+import pytest
+
+import dosebatch
+
+ROWS = [
+    {"id": "a1", "drug": "Amoxicillin", "indication": "Pharyngitis/Tonsillitis", "weight": "15", "age": "", "entry": ""},
+    {"id": "", "drug": "Cetirizine", "indication": "Urticaria, acute", "weight": "12.5", "age": "3", "entry": ""},
+    {"id": "", "drug": "Cetirizine", "indication": "Urticaria, acute", "weight": "12.5", "age": "", "entry": ""},
+    {"id": "", "drug": "Amoxicillin", "indication": "Anthrax", "weight": "20", "age": "", "entry": "1"},
+    {"id": "", "drug": "Amoxicillin", "indication": "Pharyngitis/Tonsillitis", "weight": "สิบห้า", "age": "", "entry": ""},
+]
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = tmp_path / "prescriptions.csv"
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:  # Excel บันทึก CSV พร้อม BOM
+        writer = csv.DictWriter(f, fieldnames=list(ROWS[0]))
+        writer.writeheader()
+        writer.writerows(ROWS)
+    return path
+
+
+def test_coerce_row_converts_numbers():
+    row = dosebatch.coerce_row({"weight": " 12.5 ", "age": "", "entry": "2", "drug": "Amoxicillin"})
+    assert row == {"weight": 12.5, "age": None, "entry": 2, "drug": "Amoxicillin"}
+
+
+def test_coerce_row_keeps_bad_values_for_row_error():
+    assert dosebatch.coerce_row({"weight": "สิบห้า", "entry": "1.5"}) == {"weight": "สิบห้า", "entry": "1.5"}
+    # ค่าจาก Parquet เป็นตัวเลขอยู่แล้ว ไม่แตะ
+    assert dosebatch.coerce_row({"weight": 15, "age": None}) == {"weight": 15, "age": None}
+
+
+def test_read_chunks_splits_and_numbers_rows(csv_path):
+    chunks = list(dosebatch.read_chunks(str(csv_path), 2))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    rows = [row for chunk in chunks for row in chunk]
+    assert [row["id"] for row in rows] == ["a1", 2, 3, 4, 5]  # ลำดับแถวต่อเนื่องข้ามชุด
+    assert rows[0]["drug"] == "Amoxicillin"  # BOM ไม่ติดไปกับชื่อ column แรก
+    assert (rows[1]["weight"], rows[1]["age"], rows[3]["entry"]) == (12.5, 3.0, 1)
+
+
+def test_read_parquet_chunks(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = tmp_path / "prescriptions.parquet"
+    pq.write_table(pa.table({"drug": ["Amoxicillin"] * 3, "indication": ["Anthrax"] * 3, "weight": [10.0, 20.0, 30.0]}), path)
+    chunks = list(dosebatch.read_chunks(str(path), 2))
+    assert [[row["id"] for row in chunk] for chunk in chunks] == [[1, 2], [3]]
+    assert chunks[1][0]["weight"] == 30.0
+
+
+@pytest.mark.parametrize("argv", [
+    ["--workers", "-1"],
+    ["--chunk-rows", "0"],
+])
+def test_parse_args_rejects_bad_numbers(csv_path, argv):
+    with pytest.raises(SystemExit) as exc:
+        dosebatch.parse_args([str(csv_path), *argv])
+    assert exc.value.code == 2
+
+
+def test_parse_args_rejects_missing_file(tmp_path):
+    with pytest.raises(SystemExit) as exc:
+        dosebatch.parse_args([str(tmp_path / "ไม่มีไฟล์.csv")])
+    assert exc.value.code == 2
+
+
+def expected_output(bot, csv_path, locale=None):
+    rows = [row for chunk in dosebatch.read_chunks(str(csv_path), len(ROWS)) for row in chunk]
+    return bot.evaluate_dose_rows(rows, locale)[0]
+
+
+@pytest.mark.parametrize("workers", [0, 1])
+def test_main_writes_same_ndjson_as_api(bot, csv_path, tmp_path, workers):
+    output = tmp_path / "doses.ndjson"
+    dosebatch.main([str(csv_path), "-o", str(output), "--workers", str(workers), "--chunk-rows", "2", "--quiet"])
+    text = output.read_text(encoding="utf-8")
+    assert text == expected_output(bot, csv_path)
+    lines = [json.loads(line) for line in text.splitlines()]
+    assert [line["id"] for line in lines] == ["a1", 2, 3, 4, 5]
+    assert [line["ok"] for line in lines] == [True, True, False, True, False]
+
+
+def test_main_writes_stdout_with_locale(bot, csv_path, capsys):
+    dosebatch.main([str(csv_path), "--workers", "0", "--locale", "en", "--quiet"])
+    captured = capsys.readouterr()
+    assert captured.out == expected_output(bot, csv_path, "en")
+    assert "5 แถว (error 2)" in captured.err
+
+
+def test_main_rejects_unknown_locale(csv_path):
+    with pytest.raises(SystemExit) as exc:
+        dosebatch.main([str(csv_path), "--workers", "0", "--locale", "xx"])
+    assert "xx" in str(exc.value.code)
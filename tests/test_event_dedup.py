@@ -0,0 +1,154 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_dedup(bot, request, tmp_path):
+    def make(window_seconds=600, max_events=100):
+        if request.param == "memory":
+            return bot.MemoryEventDedup(window_seconds, max_events)
+        return bot.SQLiteEventDedup(str(tmp_path / "dedup.sqlite3"), window_seconds, max_events)
+    return make
+
+
+def test_second_add_in_window_is_duplicate(make_dedup, clock):
+    dedup = make_dedup(window_seconds=600)
+    assert dedup.add("e1") is True
+    clock.now += 599
+    assert dedup.add("e1") is False
+    assert dedup.add("e2") is True
+
+
+def test_duplicate_does_not_extend_window(make_dedup, clock):
+    dedup = make_dedup(window_seconds=600)
+    dedup.add("e1")
+    clock.now += 300
+    assert dedup.add("e1") is False
+    clock.now += 300  # ครบ window นับจากครั้งแรก
+    assert dedup.add("e1") is True
+    clock.now += 599
+    assert dedup.add("e1") is False
+
+
+def test_forget_lets_redelivery_through(make_dedup, clock):
+    dedup = make_dedup()
+    dedup.add("e1")
+    dedup.forget("e1")
+    dedup.forget("never-seen")  # ไม่มีอยู่ก็ไม่ error
+    assert dedup.add("e1") is True
+    assert dedup.add("e1") is False
+
+
+def test_memory_dedup_drops_oldest_beyond_max_events(bot, clock):
+    dedup = bot.MemoryEventDedup(600, 3)
+    for n in range(4):
+        assert dedup.add(f"e{n}") is True
+        clock.now += 1
+    assert len(dedup) == 3
+    assert dedup.add("e0") is True  # ถูกลบไปแล้ว จึงรับใหม่ (และดัน e1 ออก)
+    assert [dedup.add(f"e{n}") for n in (2, 3)] == [False, False]
+    assert dedup.add("e1") is True
+
+
+def test_memory_dedup_drops_expired_on_add(bot, clock):
+    dedup = bot.MemoryEventDedup(600, 100)
+    dedup.add("e1")
+    dedup.add("e2")
+    clock.now += 600
+    dedup.add("e3")
+    assert len(dedup) == 1
+
+
+def test_sqlite_purge_drops_expired_then_oldest(bot, tmp_path, clock):
+    dedup = bot.SQLiteEventDedup(str(tmp_path / "dedup.sqlite3"), 600, 2)
+    dedup.add("expired")
+    clock.now += 300
+    for n in range(3):
+        dedup.add(f"e{n}")
+        clock.now += 1
+    clock.now += 297  # "expired" หมดเวลาพอดี
+    assert len(dedup) == 4
+    dedup.purge()
+    assert len(dedup) == 2
+    assert [dedup.add(f"e{n}") for n in (1, 2)] == [False, False]
+    assert dedup.add("e0") is True
+
+
+def test_sqlite_purges_every_n_writes(bot, tmp_path, clock):
+    dedup = bot.SQLiteEventDedup(str(tmp_path / "dedup.sqlite3"), 600, 2)
+    dedup.PURGE_EVERY = 4
+    for n in range(3):
+        dedup.add(f"e{n}")
+        clock.now += 1
+    assert len(dedup) == 3
+    dedup.add("e3")
+    assert len(dedup) == 2
+
+
+def test_sqlite_dedup_is_shared_between_workers(bot, tmp_path, clock):
+    path = str(tmp_path / "dedup.sqlite3")
+    assert bot.SQLiteEventDedup(path, 600, 100).add("e1") is True
+    assert bot.SQLiteEventDedup(path, 600, 100).add("e1") is False
+
+
+def test_event_dedup_is_abstract(bot):
+    with pytest.raises(TypeError):
+        bot.EventDedup()
+
+
+@pytest.mark.parametrize("redelivery, label", [(True, "true"), (False, "false")])
+def test_duplicate_event_is_counted(bot, monkeypatch, redelivery, label):
+    monkeypatch.setattr(bot, "event_dedup", bot.MemoryEventDedup(600, 100))
+    event = SimpleNamespace(webhook_event_id=f"e-{label}", delivery_context=SimpleNamespace(is_redelivery=redelivery))
+    before = bot.DUPLICATE_EVENTS_TOTAL.values.get((label,), 0)
+    assert bot.is_duplicate_event(event) is False
+    assert bot.is_duplicate_event(event) is True
+    assert bot.is_duplicate_event(SimpleNamespace(webhook_event_id=None)) is False
+    assert bot.DUPLICATE_EVENTS_TOTAL.values[(label,)] == before + 1
+
+
+def webhook_body(*event_ids):
+    events = [{
+        "type": "message", "mode": "active", "timestamp": 1700000000000, "replyToken": f"reply-{event_id}",
+        "source": {"type": "user", "userId": "U-dedup"}, "webhookEventId": event_id,
+        "deliveryContext": {"isRedelivery": False},
+        "message": {"id": event_id, "type": "text", "text": "เมนู", "quoteToken": "q"},
+    } for event_id in event_ids]
+    return json.dumps({"destination": "U-bot", "events": events}).encode("utf-8")
+
+
+def signed_post(client, body):
+    secret = os.environ["LINE_CHANNEL_SECRET"].encode("utf-8")
+    signature = base64.b64encode(hmac.new(secret, body, hashlib.sha256).digest()).decode("ascii")
+    return client.post("/callback", data=body, content_type="application/json", headers={"X-Line-Signature": signature})
+
+
+class FakePool:
+    def __init__(self, accept):
+        self.accept = accept
+        self.submitted = []
+
+    def submit(self, event):
+        if len(self.submitted) >= self.accept:
+            return False
+        self.submitted.append(event.webhook_event_id)
+        return True
+
+
+def test_rejected_events_are_forgotten(bot, monkeypatch):
+    monkeypatch.setattr(bot, "event_dedup", bot.MemoryEventDedup(600, 100))
+    client = bot.app.test_client()
+    body = webhook_body("e1", "e2", "e3")
+    monkeypatch.setattr(bot, "event_pool", FakePool(accept=1))
+    assert signed_post(client, body).status_code == 503
+    # LINE ส่งซ้ำ: e1 รับไปแล้วจึงถูกตัด e2, e3 ที่คิวเต็มได้ประมวลผล
+    pool = FakePool(accept=10)
+    monkeypatch.setattr(bot, "event_pool", pool)
+    assert signed_post(client, body).status_code == 200
+    assert pool.submitted == ["e2", "e3"]
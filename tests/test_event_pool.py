@@ -0,0 +1,33 @@
+from types import SimpleNamespace
+
+import pytest
+
+
+def make_event(user_id, n):
+    return SimpleNamespace(source=SimpleNamespace(user_id=user_id), n=n)
+
+
+@pytest.mark.parametrize("mode", ["thread", "process"])
+def test_worker_metrics_reach_this_process(bot, mode):
+    def dispatch(event):
+        bot.calculate_dose("Amoxicillin", "Anthrax", 10.0 + event.n)
+        if event.n == 3:
+            raise RuntimeError("พัง")
+
+    key = ("Amoxicillin", "Anthrax")
+    before = bot.DOSE_CALCULATIONS_TOTAL.values.get(key, 0)
+    pool = bot.EventWorkerPool(dispatch, 2, 20, mode)
+    try:
+        for n in range(6):
+            assert pool.submit(make_event(f"U{n % 3}", n))
+    finally:
+        pool.shutdown()
+    # process ลูกนับแล้วส่งกลับมา และค่าที่ติดไปตอน fork ไม่ถูกนับซ้ำ
+    assert bot.DOSE_CALCULATIONS_TOTAL.values[key] - before == 6
+    stats = pool.stats()
+    assert (stats["processed"], stats["failed"], stats["enqueued"]) == (5, 1, 6)
+
+
+def test_unknown_mode_is_rejected(bot):
+    with pytest.raises(ValueError):
+        bot.EventWorkerPool(lambda event: None, 1, 10, "greenlet")
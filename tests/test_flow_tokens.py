@@ -0,0 +1,63 @@
+import pytest
+
+
+@pytest.mark.parametrize("state", [
+    ("Amoxicillin", None, None, None),
+    ("Amoxicillin", "Pharyngitis/Tonsillitis", None, None),
+    ("Cetirizine", "Urticaria, acute", None, None),
+    ("Cetirizine", "Urticaria, acute", None, 3.5),
+])
+def test_round_trip(bot, state):
+    token = bot.encode_flow_token(*state)
+    assert bot.decode_flow_token(token) == state
+
+
+def test_alternatives_entry_round_trip(bot):
+    drug, indication = next(
+        key for key, (layout, rules) in bot.INDICATION_RULES.items() if layout == bot.LAYOUT_ALTERNATIVES and len(rules) > 1
+    )
+    token = bot.encode_flow_token(drug, indication, 1)
+    assert bot.decode_flow_token(token) == (drug, indication, 1, None)
+    assert bot.decode_flow_token(bot.encode_flow_token(drug, indication, 99)) is None
+    # ข้อบ่งใช้ที่ไม่ใช่ alternatives ไม่มี entry ให้เลือก
+    drug, indication = next(key for key, (layout, _) in bot.INDICATION_RULES.items() if layout == bot.LAYOUT_SINGLE)
+    assert bot.decode_flow_token(bot.encode_flow_token(drug, indication, 0)) is None
+
+
+def test_tampered_token_is_rejected(bot):
+    version, payload, signature = bot.encode_flow_token("Amoxicillin", "Pharyngitis/Tonsillitis").split(".")
+    forged = bot._b64encode(b'["Amoxicillin","Otitis media, acute (AOM)"]')
+    assert bot.decode_flow_token(f"{version}.{forged}.{signature}") is None
+    flipped = ("A" if signature[0] != "A" else "B") + signature[1:]
+    assert bot.decode_flow_token(f"{version}.{payload}.{flipped}") is None
+    assert bot.decode_flow_token(f"s0.{payload}.{signature}") is None
+
+
+@pytest.mark.parametrize("token", ["", "s1", "s1.a.b.c", "s1.!!!.???", "ไม่ใช่ token"])
+def test_malformed_token_is_rejected(bot, token):
+    assert bot.decode_flow_token(token) is None
+
+
+@pytest.mark.parametrize("state", [
+    ("ไม่มียานี้", None, None, None),
+    ("Amoxicillin", "ไม่มีข้อบ่งใช้นี้", None, None),
+    ("Cetirizine", "ไม่มีข้อบ่งใช้นี้", None, None),
+    ("Cetirizine", "Urticaria, acute", None, 19),
+    ("Cetirizine", "Urticaria, acute", None, -1),
+])
+def test_state_outside_tables_is_rejected(bot, state):
+    assert bot.decode_flow_token(bot.encode_flow_token(*state)) is None
+
+
+def test_every_action_fits_line_limit(bot):
+    for (drug, indication), (layout, rules) in bot.INDICATION_RULES.items():
+        entries = range(len(rules)) if layout == bot.LAYOUT_ALTERNATIVES else [None]
+        for entry in entries:
+            action = bot.flow_action(indication, indication, drug, indication, entry)
+            assert len(action["data"]) <= bot.LINE_ACTION_MAX_CHARS
+            assert len(action["fillInText"]) <= bot.LINE_ACTION_MAX_CHARS
+            assert bot.router.classify(action["fillInText"] + "12")[0] == "flow_step"
+    for drug, indication in bot.SPECIAL_RULES:
+        action = bot.flow_action(indication, indication, drug, indication, age=17.99)
+        assert len(action["data"]) <= bot.LINE_ACTION_MAX_CHARS
+        assert len(action["fillInText"]) <= bot.LINE_ACTION_MAX_CHARS
@@ -0,0 +1,110 @@
+import json
+import shutil
+
+import pytest
+
+
+@pytest.fixture
+def formulary_copy(bot, tmp_path):
+    path = tmp_path / "formulary.json"
+    shutil.copy(bot.FORMULARY_PATH, path)
+    return path
+
+
+def write_formulary(path, edit):
+    data = json.loads(path.read_text(encoding="utf-8"))
+    edit(data)
+    path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    return str(path)
+
+
+def test_load_formulary_matches_loaded_tables(bot, formulary_copy, tmp_path):
+    snapshot = tmp_path / "formulary.bin"
+    tables = bot.load_formulary(str(formulary_copy), str(snapshot))
+    assert tables == (bot.DRUG_DATABASE, bot.SPECIAL_DRUGS)
+    assert snapshot.exists()
+    # ครั้งที่ 2 อ่านจาก snapshot
+    assert bot.load_formulary(str(formulary_copy), str(snapshot)) == tables
+
+
+def test_changed_file_ignores_stale_snapshot(bot, formulary_copy, tmp_path):
+    snapshot = str(tmp_path / "formulary.bin")
+    bot.load_formulary(str(formulary_copy), snapshot)
+    path = write_formulary(formulary_copy, lambda data: data["drugs"]["Amoxicillin"].update(bottle_size_ml=999))
+    drugs, _ = bot.load_formulary(path, snapshot)
+    assert drugs["Amoxicillin"]["bottle_size_ml"] == 999
+
+
+def test_strength_becomes_concentration(bot):
+    assert bot.DRUG_DATABASE["Amoxicillin"]["concentration_mg_per_ml"] == pytest.approx(250 / 5)
+    assert "strength_mg" not in bot.DRUG_DATABASE["Amoxicillin"]
+
+
+@pytest.mark.parametrize("edit, message", [
+    (lambda data: data.pop("special_drugs"), "special_drugs"),
+    (lambda data: data["drugs"]["Amoxicillin"].update(strength_mg=0), "strength_mg"),
+    (lambda data: data["drugs"]["Amoxicillin"].pop("bottle_size_ml"), "bottle_size_ml"),
+    (lambda data: data["drugs"]["Amoxicillin"].update(common_indications=["ไม่มี"]), "common_indications"),
+    (lambda data: data["drugs"]["Amoxicillin"]["indications"].update(Test={
+        "dose_mg_per_kg_per_day": 50, "frequency": 0, "duration_days": 10,
+    }), "frequency"),
+    (lambda data: data["drugs"]["Amoxicillin"]["indications"].update(Test={
+        "dose_mg_per_kg_per_day": 50, "frequency": 2, "duration_days": 10, "dose": 1,
+    }), "ไม่รู้จัก key dose"),
+    (lambda data: data["drugs"]["Amoxicillin"]["indications"].update(Test={
+        "dose_mg_per_kg_per_day": [90, 45], "frequency": 2, "duration_days": 10,
+    }), "แบบช่วง"),
+    (lambda data: data["special_drugs"]["Cetirizine"]["indications"].update(Test={"7_to_9_years": {"dose_mg": 5}}),
+     "ไม่รู้จักกลุ่ม"),
+])
+def test_invalid_formulary_is_rejected(bot, formulary_copy, tmp_path, edit, message):
+    path = write_formulary(formulary_copy, edit)
+    with pytest.raises(bot.FormularyError, match=message):
+        bot.load_formulary(path, str(tmp_path / "formulary.bin"))
+
+
+def test_rule_index_covers_every_indication(bot):
+    for drug, info in bot.DRUG_DATABASE.items():
+        for indication, value in info["indications"].items():
+            if value == bot.INDICATION_OTHERS:
+                assert (drug, indication) not in bot.INDICATION_RULES
+                continue
+            layout, rules = bot.INDICATION_RULES[(drug, indication)]
+            if isinstance(value, dict):
+                entries = [value]
+                assert layout == bot.LAYOUT_SINGLE
+            else:
+                entries = value
+                assert layout in (bot.LAYOUT_PHASES, bot.LAYOUT_ALTERNATIVES)
+            assert len(rules) == len(entries)
+            for idx, rule in enumerate(rules):
+                assert bot.DOSE_RULES[(drug, indication, idx)] is rule
+    for drug, info in bot.SPECIAL_DRUGS.items():
+        for indication in info["indications"]:
+            assert bot.SPECIAL_RULES[(drug, indication)]
+
+
+def test_reload_swaps_tables_and_bumps_version(bot):
+    drugs, special = bot.DRUG_DATABASE, bot.SPECIAL_DRUGS
+    version = bot.TABLES_VERSION
+    before = bot.render_reply(bot.calculate_dose("Amoxicillin", "Pharyngitis/Tonsillitis", 15.0), "th")
+    changed = dict(drugs)
+    changed["Amoxicillin"] = dict(drugs["Amoxicillin"], bottle_size_ml=drugs["Amoxicillin"]["bottle_size_ml"] * 2)
+    try:
+        bot.reload_drug_tables(changed, special)
+        assert bot.TABLES_VERSION == version + 1
+        after = bot.render_reply(bot.calculate_dose("Amoxicillin", "Pharyngitis/Tonsillitis", 15.0), "th")
+        assert after != before
+    finally:
+        bot.reload_drug_tables(drugs, special)
+    assert bot.render_reply(bot.calculate_dose("Amoxicillin", "Pharyngitis/Tonsillitis", 15.0), "th") == before
+
+
+def test_reload_keeps_old_tables_when_compile_fails(bot):
+    version = bot.TABLES_VERSION
+    special = dict(bot.SPECIAL_DRUGS)
+    special["Cetirizine"] = dict(special["Cetirizine"], indications={"Test": {"7_to_9_years": {"dose_mg": 5}}})
+    with pytest.raises(bot.FormularyError):
+        bot.reload_drug_tables(bot.DRUG_DATABASE, special)
+    assert bot.TABLES_VERSION == version
+    assert ("Cetirizine", "Urticaria, acute") in bot.SPECIAL_RULES
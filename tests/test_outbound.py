@@ -0,0 +1,151 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+import urllib3
+
+
+class FakeLine:
+    """pool manager จำลอง: ตอบตาม responses ทีละตัว (status หรือ (status, Retry-After) หรือ exception)"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.bodies = []
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        self.bodies.append(json.loads(body))
+        response = self.responses.pop(0) if self.responses else 200
+        if isinstance(response, Exception):
+            raise response
+        status, retry_after = response if isinstance(response, tuple) else (response, None)
+        return SimpleNamespace(status=status, reason=f"HTTP {status}", headers={"Retry-After": retry_after} if retry_after else {})
+
+
+@pytest.fixture
+def jitter(bot, monkeypatch):
+    """สุ่มได้ค่ามากสุดของช่วงเสมอ และจำช่วงที่ถูกสุ่ม"""
+    ranges = []
+
+    def uniform(low, high):
+        ranges.append((low, high))
+        return high
+    monkeypatch.setattr(bot, "random", SimpleNamespace(uniform=uniform))
+    return ranges
+
+
+def make_dispatcher(bot, line, max_retries=3, retry_base=0.2):
+    return bot.OutboundDispatcher(line, "http://line.test/reply", "token", max_retries, retry_base)
+
+
+def text(n):
+    return json.dumps({"type": "text", "text": f"ข้อความ {n}"}, ensure_ascii=False)
+
+
+def test_messages_in_scope_are_sent_in_one_call(bot, clock):
+    line = FakeLine()
+    dispatcher = make_dispatcher(bot, line)
+    with dispatcher.collect("r1"):
+        dispatcher.add("r1", [text(1)])
+        with dispatcher.collect("r1"):  # scope ซ้อนของ token เดียวกันรวมเข้ากับ scope นอก
+            dispatcher.add("r1", [text(2), text(3)])
+        assert line.bodies == []
+    assert line.bodies == [{"replyToken": "r1", "messages": [json.loads(text(n)) for n in (1, 2, 3)]}]
+    assert dispatcher.stats()["calls"] == 1
+
+
+def test_other_token_is_sent_immediately(bot, clock):
+    line = FakeLine()
+    dispatcher = make_dispatcher(bot, line)
+    with dispatcher.collect("r1"):
+        dispatcher.add("r2", [text(1)])
+        assert [body["replyToken"] for body in line.bodies] == ["r2"]
+        dispatcher.add("r1", [text(2)])
+    assert [body["replyToken"] for body in line.bodies] == ["r2", "r1"]
+
+
+def test_unsent_scope_keeps_messages(bot, clock):
+    line = FakeLine()
+    dispatcher = make_dispatcher(bot, line)
+    with dispatcher.collect("r1", send=False) as scope:
+        dispatcher.add("r1", [text(1)])
+    assert scope.messages == [text(1)]
+    assert line.bodies == []
+
+
+def test_failed_handler_sends_nothing(bot, clock):
+    line = FakeLine()
+    dispatcher = make_dispatcher(bot, line)
+    with pytest.raises(RuntimeError):
+        with dispatcher.collect("r1"):
+            dispatcher.add("r1", [text(1)])
+            raise RuntimeError("พัง")
+    assert line.bodies == []
+    dispatcher.add("r1", [text(2)])  # scope ถูกล้างแล้ว ส่งทันที
+    assert len(line.bodies) == 1
+
+
+def test_empty_scope_makes_no_call(bot, clock):
+    line = FakeLine()
+    with make_dispatcher(bot, line).collect("r1"):
+        pass
+    assert line.bodies == []
+
+
+def test_more_than_five_messages_are_cut(bot, clock):
+    line = FakeLine()
+    dispatcher = make_dispatcher(bot, line)
+    with dispatcher.collect("r1"):
+        dispatcher.add("r1", [text(n) for n in range(7)])
+    assert len(line.bodies) == 1
+    assert [m["text"] for m in line.bodies[0]["messages"]] == [f"ข้อความ {n}" for n in range(bot.REPLY_MAX_MESSAGES)]
+    assert dispatcher.stats()["dropped_messages"] == 2
+
+
+@pytest.mark.parametrize("failure", [500, 503, 429, urllib3.exceptions.NewConnectionError(None, "ต่อไม่ได้")])
+def test_retryable_failures_back_off_with_full_jitter(bot, clock, jitter, failure):
+    line = FakeLine(failure, failure, 200)
+    dispatcher = make_dispatcher(bot, line, retry_base=0.2)
+    dispatcher.reply("r1", [text(1)])
+    assert len(line.bodies) == 3
+    assert jitter == [(0, 0.2), (0, 0.4)]
+    assert clock.sleeps == pytest.approx([0.2, 0.4])
+    stats = dispatcher.stats()
+    assert (stats["calls"], stats["retries"], stats["failed"]) == (3, 2, 0)
+
+
+@pytest.mark.parametrize("retry_after, delay", [("2", 2), ("30", 5), ("soon", 0.2)])
+def test_retry_after_is_honoured_up_to_limit(bot, clock, jitter, retry_after, delay):
+    line = FakeLine((429, retry_after), 200)
+    make_dispatcher(bot, line, retry_base=0.2).reply("r1", [text(1)])
+    assert clock.sleeps == pytest.approx([delay])
+
+
+def test_client_error_is_not_retried(bot, clock, jitter):
+    from linebot.v3.messaging import ApiException
+    line = FakeLine(400)
+    dispatcher = make_dispatcher(bot, line)
+    with pytest.raises(ApiException):
+        dispatcher.reply("r1", [text(1)])
+    assert len(line.bodies) == 1
+    assert clock.sleeps == []
+    assert dispatcher.stats()["failed"] == 1
+
+
+def test_gives_up_after_max_retries(bot, clock, jitter):
+    from linebot.v3.messaging import ApiException
+    line = FakeLine(*[503] * 10)
+    dispatcher = make_dispatcher(bot, line, max_retries=2)
+    with pytest.raises(ApiException):
+        dispatcher.reply("r1", [text(1)])
+    assert len(line.bodies) == 3
+    assert dispatcher.stats()["retries"] == 2
+    assert dispatcher.stats()["failed"] == 1
+
+
+def test_stats_report_latency_percentiles(bot, clock):
+    dispatcher = make_dispatcher(bot, FakeLine())
+    assert "latency_ms" not in dispatcher.stats()
+    for elapsed in (0.01, 0.02, 0.03):
+        dispatcher.record(0, elapsed, 200, "OK", None)
+    latency = dispatcher.stats()["latency_ms"]
+    assert (latency["p50"], latency["max"]) == (20.0, 30.0)
@@ -0,0 +1,75 @@
+import pytest
+
+
+@pytest.mark.parametrize("text, intent, args", [
+    ("คำนวณยา warfarin", "start_warfarin", {}),
+    ("คำนวณยา WARFARIN", "start_warfarin", {}),
+    ("คำนวณยาเด็ก", "start_pediatric", {}),
+    ("คำนวณขนาดยาเด็ก", "start_pediatric", {}),
+    ("เลือกยาใหม่", "reset_drug", {}),
+    ("เลือกยา: Amoxicillin", "select_drug", {"drug": "Amoxicillin"}),
+    ("Indication: Fever", "select_indication", {"indication": "Fever"}),
+    ("MoreIndication: Cetirizine", "more_indication", {"more_drug": "Cetirizine"}),
+    ("สวัสดี", None, {}),
+    ("คำนวณยา warfarin ด้วย", None, {}),
+])
+def test_classify(bot, text, intent, args):
+    assert bot.router.classify(text) == (intent, args)
+
+
+def test_classify_flow_token(bot):
+    token = bot.encode_flow_token("Amoxicillin", "Pharyngitis/Tonsillitis")
+    text = f"{bot.flow_fill_in_text('Amoxicillin', 'Pharyngitis/Tonsillitis', token)}15"
+    assert bot.router.classify(text) == ("flow_step", {"flow_token": token, "flow_input": "\nน้ำหนัก 15"})
+
+
+class FakeSessions:
+    def __init__(self, sessions):
+        self.sessions = sessions
+
+    def get(self, user_id):
+        return self.sessions.get(user_id)
+
+
+@pytest.fixture
+def toy_router(bot, monkeypatch):
+    monkeypatch.setattr(bot, "sessions", FakeSessions({"in-flow": {"flow": "ask"}}))
+    router = bot.IntentRouter()
+    calls = []
+
+    @router.intent("restart", r"เริ่มใหม่", always=True)
+    def restart(event, user_id, session):
+        calls.append(("restart", session))
+
+    @router.intent("pick", r"เลือก:\s*(?P<choice>.*)")
+    def pick(event, user_id, session, choice):
+        calls.append(("pick", choice))
+        return False if choice == "ไม่รับ" else None
+
+    @router.flow("ask")
+    def ask(event, user_id, session, text):
+        calls.append(("ask", text))
+
+    @router.default
+    def fallback(event, user_id, session, text):
+        calls.append(("fallback", text))
+
+    return router, calls
+
+
+@pytest.mark.parametrize("user_id, text, expected", [
+    ("idle", "เลือก: ก", ("pick", "ก")),
+    ("idle", "อื่นๆ", ("fallback", "อื่นๆ")),
+    ("in-flow", "เลือก: ก", ("ask", "เลือก: ก")),
+    ("in-flow", "เริ่มใหม่", ("restart", None)),
+])
+def test_dispatch(toy_router, user_id, text, expected):
+    router, calls = toy_router
+    router.dispatch(None, user_id, text)
+    assert calls == [expected]
+
+
+def test_handler_can_decline_to_fallback(toy_router):
+    router, calls = toy_router
+    router.dispatch(None, "idle", "เลือก: ไม่รับ")
+    assert calls == [("pick", "ไม่รับ"), ("fallback", "เลือก: ไม่รับ")]
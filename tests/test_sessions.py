@@ -0,0 +1,100 @@
+import pytest
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_store(bot, request, tmp_path):
+    def make(ttl_seconds=60, max_users=100):
+        if request.param == "memory":
+            return bot.MemorySessionStore(ttl_seconds, max_users)
+        return bot.SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"), ttl_seconds, max_users)
+    return make
+
+
+def test_get_returns_copy(make_store, clock):
+    store = make_store()
+    store.set("u1", {"flow": "warfarin", "step": "ask_twd", "inr": 2.5})
+    record = store.get("u1")
+    record["step"] = "ask_bleeding"
+    assert store.get("u1") == {"flow": "warfarin", "step": "ask_twd", "inr": 2.5}
+
+
+def test_missing_and_deleted(make_store, clock):
+    store = make_store()
+    assert store.get("u1") is None
+    store.delete("u1")  # ไม่มีอยู่ก็ไม่ error
+    store.set("u1", {"drug": "Amoxicillin"})
+    store.delete("u1")
+    assert store.get("u1") is None
+
+
+def test_ttl_expires_and_set_renews(make_store, clock):
+    store = make_store(ttl_seconds=60)
+    store.set("u1", {"drug": "Amoxicillin"})
+    clock.now += 59
+    assert store.get("u1") == {"drug": "Amoxicillin"}
+    store.set("u1", {"drug": "Amoxicillin", "indication": "Anthrax"})  # ต่ออายุ
+    clock.now += 59
+    assert store.get("u1") == {"drug": "Amoxicillin", "indication": "Anthrax"}
+    clock.now += 1
+    assert store.get("u1") is None
+
+
+def test_memory_store_evicts_least_recently_used(bot, clock):
+    store = bot.MemorySessionStore(60, 2)
+    store.set("u1", {"n": 1})
+    store.set("u2", {"n": 2})
+    store.get("u1")  # u1 ถูกใช้ล่าสุด u2 จึงถูกลบก่อน
+    store.set("u3", {"n": 3})
+    assert len(store) == 2
+    assert store.get("u2") is None
+    assert (store.get("u1"), store.get("u3")) == ({"n": 1}, {"n": 3})
+
+
+def test_memory_store_drops_expired_on_read(bot, clock):
+    store = bot.MemorySessionStore(60, 10)
+    store.set("u1", {"n": 1})
+    clock.now += 60
+    assert len(store) == 1
+    assert store.get("u1") is None
+    assert len(store) == 0
+
+
+def test_sqlite_purge_drops_expired_then_oldest(bot, tmp_path, clock):
+    store = bot.SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"), 60, 2)
+    store.set("expired", {"n": 0})
+    clock.now += 30
+    for n, user_id in enumerate(("u1", "u2", "u3"), 1):
+        store.set(user_id, {"n": n})
+        clock.now += 1
+    clock.now += 27  # "expired" หมดอายุพอดี
+    assert len(store) == 4
+    store.purge()
+    assert len(store) == 2
+    assert [store.get(user_id) for user_id in ("u1", "u2", "u3")] == [None, {"n": 2}, {"n": 3}]
+
+
+def test_sqlite_purges_every_n_writes(bot, tmp_path, clock):
+    store = bot.SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"), 60, 2)
+    store.PURGE_EVERY = 4
+    for n in range(3):
+        store.set(f"u{n}", {"n": n})
+        clock.now += 1
+    assert len(store) == 3
+    store.set("u3", {"n": 3})
+    assert len(store) == 2
+
+
+def test_sqlite_store_is_shared_between_instances(bot, tmp_path, clock):
+    path = str(tmp_path / "sessions.sqlite3")
+    bot.SQLiteSessionStore(path, 60, 10).set("u1", {"drug": "ยาไทย"})
+    assert bot.SQLiteSessionStore(path, 60, 10).get("u1") == {"drug": "ยาไทย"}
+
+
+def test_session_store_is_abstract(bot):
+    with pytest.raises(TypeError):
+        bot.SessionStore()
+
+
+def test_unknown_backend_is_rejected(bot):
+    with pytest.raises(ValueError):
+        bot.create_session_store("redis")
@@ -0,0 +1,50 @@
+import string
+
+import pytest
+
+VALUES = {"drug": "Amoxicillin", "mg": 123.456, "ml": 2.5, "n": 3, "note": "100% ตาม ฉลาก", "items": {"a": "x"}}
+
+
+@pytest.mark.parametrize("template", [
+    "",
+    "ไม่มี field",
+    "{drug}",
+    "{mg:.1f} mg → {ml:.2f} ml",
+    "{mg:g} / {n:d} ครั้ง",
+    "{n:.0f}% ของ {note}",
+    "50% {{ปีกกา}} {drug}",
+    "{mg:.3e}",
+    "{mg:>10.1f}",   # ไม่มีใน printf ใช้ format_map
+    "{drug!r}",
+    "{items[a]}",
+])
+def test_compile_template_matches_str_format(bot, template):
+    assert bot.compile_template(template)(**VALUES) == template.format_map(VALUES)
+
+
+def test_unused_keywords_are_ignored(bot):
+    assert bot.compile_template("{drug}")(drug="A", extra=1) == "A"
+
+
+def test_missing_keyword_raises(bot):
+    with pytest.raises(KeyError):
+        bot.compile_template("{drug} {mg:.1f}")(drug="A")
+
+
+@pytest.mark.parametrize("locale", ["en"])
+def test_locales_define_the_same_templates(bot, locale):
+    th, other = bot.REPLY_TEMPLATES["th"], bot.REPLY_TEMPLATES[locale]
+    assert set(other) == set(th)
+    assert set(bot.REPLY_WORDS[locale]) == set(bot.REPLY_WORDS["th"])
+    for name, template in th.items():
+        fields = {field for _, field, _, _ in string.Formatter().parse(template) if field}
+        assert {field for _, field, _, _ in string.Formatter().parse(other[name]) if field} == fields, name
+
+
+def test_render_reply_is_cached_per_locale(bot):
+    result = bot.calculate_dose("Amoxicillin", "Pharyngitis/Tonsillitis", 15.0)
+    th = bot.render_reply(result, "th")
+    en = bot.render_reply(result, "en")
+    assert th != en
+    assert result.rendered == {"th": th, "en": en}
+    assert bot.render_reply(result, "th") is th
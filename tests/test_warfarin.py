@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+# ค่ารอบขอบช่วง INR ทุกช่วง รวมค่าที่ลงท้าย 5 ซึ่ง round() ปัดไปหาเลขคู่ (1.95, 2.05, 3.05, ...)
+BAND_EDGE_INRS = sorted({
+    round(start + delta, 3)
+    for start in (1.5, 2.0, 3.1, 4.0, 5.0)
+    for delta in (-0.1, -0.06, -0.05, -0.04, -0.01, 0.0, 0.01, 0.04, 0.05, 0.06)
+} | {0.5, 1.0, 1.45, 1.95, 2.05, 2.95, 3.05, 3.95, 4.95, 9.9})
+
+
+def test_inr_tenths_rounds_half_up(bot):
+    assert bot.inr_tenths(1.95) == 2.0
+    assert bot.inr_tenths(1.94) == 1.9
+    assert bot.inr_tenths(3.05) == 3.1
+    assert bot.inr_tenths(4.95) == 5.0
+
+
+@pytest.mark.parametrize("inr", BAND_EDGE_INRS)
+def test_batch_band_matches_scalar(bot, inr):
+    batch = bot.adjust_warfarin_batch([inr], [28.0])[0]
+    scalar = bot.adjust_warfarin(inr, 28.0)
+    assert bot.WARFARIN_BANDS[batch["band"]][1] == scalar.label
+    for field in ("twd_min", "twd_max"):
+        expected = getattr(scalar, field)
+        if expected is None:
+            assert np.isnan(batch[field])
+        else:
+            assert batch[field] == pytest.approx(expected)
+
+
+def test_batch_bleeding_overrides_band(bot):
+    result = bot.adjust_warfarin_batch([2.5, 2.5], [28.0, 28.0], bleeding=[True, False])
+    assert result["band"][0] == -1
+    assert np.isnan(result["twd_min"][0])
+    assert bot.WARFARIN_BANDS[result["band"][1]][1] == bot.adjust_warfarin(2.5, 28.0).label
+
+
+@pytest.mark.parametrize("inrs, twds", [
+    ([2.5, float("nan")], [28.0, 28.0]),
+    ([0.0], [28.0]),
+    ([-1.0], [28.0]),
+    ([float("inf")], [28.0]),
+    ([20.1], [28.0]),
+    ([2.5], [float("nan")]),
+    ([2.5], [0.0]),
+    ([2.5], [-7.0]),
+    ([2.5], [140.5]),
+])
+def test_batch_rejects_out_of_range_values(bot, inrs, twds):
+    with pytest.raises(ValueError):
+        bot.adjust_warfarin_batch(inrs, twds)
+
+
+def test_batch_accepts_range_limits(bot):
+    result = bot.adjust_warfarin_batch([bot.WARFARIN_MAX_INR, 0.1], [bot.WARFARIN_MAX_TWD, 0.1])
+    assert bot.WARFARIN_BANDS[result["band"][0]][1] == bot.adjust_warfarin(bot.WARFARIN_MAX_INR, 140.0).label
+    assert bot.WARFARIN_BANDS[result["band"][1]][1] == bot.adjust_warfarin(0.1, 0.1).label
+
+
+def test_exact_schedule_meets_target(bot):
+    adjustment = bot.calculate_warfarin(2.5, 28.0, "no")
+    assert adjustment.schedule.total_mg == 28.0
+    assert adjustment.schedule.miss == 0
+    assert "ตัวอย่างการจัดยา 28 mg/สัปดาห์" in bot.render_reply(adjustment, "th")
+
+
+def test_inexact_schedule_is_labelled_approximate(bot):
+    # INR 4.5, TWD 28 → ขนาดใหม่ 25.2 mg แต่เม็ด 2/3/5 mg จัดได้ใกล้สุด 25 mg
+    adjustment = bot.calculate_warfarin(4.5, 28.0, "no")
+    assert adjustment.schedule.total_mg == 25.0
+    assert adjustment.schedule.miss == pytest.approx(0.2)
+    text = bot.render_reply(adjustment, "en")
+    assert "Approximate schedule for 25 mg/week" in text
+    assert "off by 0.2 mg" in text
+    assert bot.warfarin_result_json(adjustment)["schedule"]["approximate"] is True
+
+
+def test_hold_days_precede_schedule(bot):
+    text = bot.render_reply(bot.calculate_warfarin(4.2, 35.0, "no"), "th")
+    assert text.index("หยุดยา 1 วันก่อน") < text.index("ตัวอย่างการจัดยา")
+    assert "หยุดยา 1 วันก่อน" not in bot.render_reply(bot.calculate_warfarin(3.5, 17.0, "no"), "th")
+
+
+def test_far_off_schedule_is_skipped(bot):
+    # TWD 0.5 mg: เม็ดยาครึ่งเม็ดเล็กสุดได้ 7 mg/สัปดาห์
+    adjustment = bot.calculate_warfarin(2.5, 0.5, "no")
+    assert adjustment.schedule is None
+    assert adjustment.schedule_skipped
+    assert "ไม่มีตัวอย่างการจัดยา" in bot.render_reply(adjustment, "th")
+    assert bot.warfarin_result_json(adjustment)["schedule_skipped"] is True
+
+
+@pytest.mark.parametrize("text", ["nan", "inf", "-inf", "0", "-2.5", "20.1", "2,5", ""])
+def test_parse_warfarin_value_rejects(bot, text):
+    assert bot.parse_warfarin_value(text, bot.WARFARIN_MAX_INR) is None
+
+
+@pytest.mark.parametrize("text, value", [("2.5", 2.5), (" 1.0 ", 1.0), ("20", 20.0)])
+def test_parse_warfarin_value_accepts(bot, text, value):
+    assert bot.parse_warfarin_value(text, bot.WARFARIN_MAX_INR) == value